@@ -1,25 +1,41 @@
 import os
-import socket
 import sys
+import time
+
+# Make the shared `common` package importable when run as client/2nd_client.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 import type_effect
+from session import STRIPE_MIN_SIZE, FramedClient, NotFramedServer, RemoteError, ServerBusy
 
 IP = "172.20.10.6"
 PORT = 4450
 ADDR = (IP, PORT)
-SIZE = 1024
-CHUNK_SIZE = 65536  # 64KB chunks
-FORMAT = "utf-8"
+RECONNECT_ATTEMPTS = 5
 
 
-def receive_response(conn: socket.socket):
-    try:
-        return conn.recv(SIZE).decode(FORMAT).strip()
-    except Exception:
-        return "Failed to receive response."
+def with_reconnect(session: FramedClient, action):
+    """Run action(); if the connection drops, reconnect and run it again.
+
+    Uploads and downloads resume from where they stopped, so a retry only
+    sends the missing bytes.
+    """
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        try:
+            return action()
+        except (ConnectionError, TimeoutError) as e:
+            if attempt == RECONNECT_ATTEMPTS:
+                raise
+            type_effect.type_print(f"Connection lost ({e}). Reconnecting...")
+            time.sleep(getattr(e, "retry_after", None) or min(2 ** attempt, 10))
+            try:
+                session.reconnect()
+            except OSError as e:  # includes ServerBusy; the next attempt waits and retries
+                type_effect.type_print(f"Reconnect failed: {e}")
 
 
 #upload
-def handle_upload(conn: socket.socket, path: str, sub: str = None):
+def handle_upload(session: FramedClient, path: str, sub: str = None):
     """Upload a file or folder to the server."""
     if not os.path.exists(path):
         type_effect.type_print("File or folder does not exist.")
@@ -29,126 +45,164 @@ def handle_upload(conn: socket.socket, path: str, sub: str = None):
         # If folder is empty
         if not any(os.scandir(path)):
             folder_name = os.path.basename(path) if not sub else sub
-            conn.send(f"UPLOAD_EMPTY@{folder_name}".encode(FORMAT))
-            response = receive_response(conn)
-            type_effect.type_print(f"{response}")
+            try:
+                type_effect.type_print(session.make_dir(folder_name))
+            except RemoteError as e:
+                type_effect.type_print(f"ERR@{e}")
             return
 
-        # Non-empty folder
-        for root, _, files in os.walk(path):
-            rel_path = os.path.relpath(root, path)
-            if rel_path == ".":
-                rel_path = ""
-            for file in files:
-                file_path = os.path.join(root, file)
-                sub_folder = os.path.join(sub or os.path.basename(path), rel_path)
-                upload_single_file(conn, file_path, sub_folder)
-        type_effect.type_print("Folder uploaded successfully.")
+        # Non-empty folder: one UPLOAD_TREE streams every file in one go
+        try:
+            summary = session.upload_tree(path, sub or os.path.basename(path))
+        except RemoteError as e:
+            type_effect.type_print(f"ERR@{e}")
+            return
+        for rel in summary["changed"]:
+            type_effect.type_print(f"ERR@{rel} changed while uploading; please upload it again.")
+        type_effect.type_print(f"Folder uploaded successfully ({summary['files']} files, "
+                               f"{summary['bytes']} bytes in {summary['seconds']:.2f}s).")
     else:
-        upload_single_file(conn, path, sub)
+        upload_single_file(session, path, sub)
 
 
 
-def upload_single_file(conn: socket.socket, filename: str, sub: str = None):
+def upload_single_file(session: FramedClient, filename: str, sub: str = None):
     """Upload a single file to the server."""
-    base_name = os.path.basename(filename)
-    if sub:
-        conn.send(f"UPLOAD@{base_name}@{sub}".encode(FORMAT))
-    else:
-        conn.send(f"UPLOAD@{base_name}".encode(FORMAT))
-
-    # Wait for server READY
-    if receive_response(conn) != "READY":
-        type_effect.type_print("Server not ready for upload.")
-        return
+    try:
+        if "dedup" in session.features:
+            # Only chunks the server doesn't already store are sent.
+            reply = with_reconnect(session, lambda: session.upload_dedup(filename, sub=sub))
+            type_effect.type_print(f"{reply['message']} ({reply['reused']} of {reply['size']} "
+                                   f"bytes already on the server)")
+        else:
+            type_effect.type_print(with_reconnect(session, lambda: session.resume_upload(filename, sub=sub)))
+    except RemoteError as e:
+        type_effect.type_print(f"ERR@{e}")
 
-    filesize = os.path.getsize(filename)
-    conn.send(str(filesize).encode(FORMAT))
 
-    if receive_response(conn) != "OK":
-        type_effect.type_print("Server rejected file size.")
+#Download
+def handle_download(session: FramedClient, filenames: list):
+    if len(filenames) == 1:
+        # A single large file is striped over several connections; anything
+        # smaller goes over this one, resuming from its .part file.
+        try:
+            size = with_reconnect(session, lambda: session.remote_size(filenames[0]))
+            if size is not None and size >= STRIPE_MIN_SIZE:
+                with_reconnect(session, lambda: session.download_striped(filenames[0]))
+            else:
+                with_reconnect(session, lambda: session.download(filenames[0]))
+        except (RemoteError, OSError) as e:
+            type_effect.type_print(f"ERR@{filenames[0]}: {e}")
+            return
+        type_effect.type_print(f"Downloaded '{filenames[0]}' successfully!")
         return
 
-    # Send file in chunks
-    with open(filename, "rb") as f:
-        while chunk := f.read(CHUNK_SIZE):
-            conn.sendall(chunk)
-
-    type_effect.type_print(receive_response(conn))
+    # Several names are fetched concurrently over the one connection; after a
+    # reconnect the ones that failed resume from their .part files.
+    results = dict(session.download_many(filenames))
+    retry = [name for name, result in results.items() if isinstance(result, ConnectionError)]
+    if retry:
+        try:
+            results.update(with_reconnect(session, lambda: _download_or_raise(session, retry)))
+        except ConnectionError as e:
+            type_effect.type_print(f"ERR@{e}")
+
+    for filename in filenames:
+        result = results[filename]
+        if isinstance(result, Exception):
+            type_effect.type_print(f"ERR@{filename}: {result}")
+        else:
+            type_effect.type_print(f"Downloaded '{filename}' successfully!")
 
 
-#Download
-def handle_download(conn: socket.socket, filename: str):
-    conn.send(f"DOWNLOAD@{filename}".encode(FORMAT))
-    resp = receive_response(conn)
+def _download_or_raise(session: FramedClient, filenames: list) -> list:
+    results = session.download_many(filenames)
+    for _, result in results:
+        if isinstance(result, ConnectionError):
+            raise result
+    return results
 
-    if not resp.startswith("OK"):
-        type_effect.type_print(resp)
-        return
 
-    parts = resp.split("@", 2)
-    if len(parts) < 2:
-        type_effect.type_print("Malformed size response from server.")
-        return
+#Dir
+def handle_dir(session: FramedClient, args: list):
+    """DIR [folder] [pattern] [-r]: list a folder, optionally filtered and recursive."""
+    recursive = "-r" in args
+    args = [a for a in args if a != "-r"]
+    folder = args[0] if args else ""
+    pattern = args[1] if len(args) > 1 else None
+    count = 0
     try:
-        filesize = int(parts[1])
-    except ValueError:
-        type_effect.type_print("Invalid file size received.")
+        for path, kind, size, _ in session.list_dir(folder, recursive, pattern):
+            if count == 0:
+                type_effect.type_print("Files on server:")
+            print(f"{path}/ — [DIR]" if kind == "dir" else f"{path} — {size:,} bytes")
+            count += 1
+    except RemoteError as e:
+        type_effect.type_print(f"ERR@{e}")
         return
+    if count == 0:
+        type_effect.type_print("No files found.")
 
-    conn.send("READY".encode(FORMAT))
-
-    received = 0
-    with open(filename, "wb") as f:
-        while received < filesize:
-            chunk_size = min(CHUNK_SIZE, filesize - received)
-            chunk = conn.recv(chunk_size)
-            if not chunk:
-                raise ConnectionError("Connection lost during download")
-            f.write(chunk)
-            received += len(chunk)
 
-    type_effect.type_print(f"Downloaded '{filename}' successfully!")
+#Verify
+def handle_verify(session: FramedClient, name: str, local_path: str = None):
+    """VERIFY <remote> [local]: show the server's digest, or compare it with a local file."""
+    if local_path and not os.path.isfile(local_path):
+        type_effect.type_print(f"Local file '{local_path}' not found.")
+        return
+    try:
+        type_effect.type_print(session.verify(name, local_path).get("message", ""))
+    except RemoteError as e:
+        type_effect.type_print(f"ERR@{e}")
 
 
 #Delete
-def handle_delete(conn: socket.socket, filename: str):
-    conn.send(f"DELETE@{filename}".encode(FORMAT))
-    type_effect.type_print(receive_response(conn))
+def handle_delete(session: FramedClient, filename: str):
+    try:
+        type_effect.type_print(session.delete(filename))
+    except RemoteError as e:
+        type_effect.type_print(f"ERR@{e}")
 
 
-def main():
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def connect() -> FramedClient:
+    """Connect, waiting out a busy server (ERR@BUSY) a few times."""
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        try:
+            return FramedClient.connect(ADDR)
+        except ServerBusy as e:
+            if attempt == RECONNECT_ATTEMPTS:
+                raise
+            type_effect.type_print(f"{e}...")
+            time.sleep(e.retry_after)
 
-    # Optimize socket BEFORE connecting
-    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Disable Nagle's algorithm
-    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)  # 64KB receive buffer
-    client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)  # 64KB send buffer
 
-    client.connect(ADDR)
+def main():
+    try:
+        session = connect()
+    except NotFramedServer as e:
+        type_effect.type_print(f"{e}. Please update the server.")
+        return
+    except ServerBusy as e:
+        type_effect.type_print(f"{e}. Please try again later.")
+        return
 
     #Greeting
-    welcome = client.recv(SIZE).decode(FORMAT)
-    cmd, msg = welcome.split("@", 1)
-    if cmd == "OK":
-        type_effect.type_print(msg)
+    type_effect.type_print(session.welcome)
 
     #Login
     username = input("Username: ")
     password = input("Password: ")
-    client.send(f"LOGIN@{username}@{password}".encode(FORMAT))
-
-    login_resp = client.recv(SIZE).decode(FORMAT)
-    parts = login_resp.split("@")
-    if len(parts) < 2 or parts[0] != "OK" or parts[1] != "AUTH_SUCCESS":
+    try:
+        login_msg = session.login(username, password)
+    except RemoteError:
         type_effect.type_print("Authentication failed.")
-        client.close()
+        session.close()
         return
     type_effect.spacing()
     type_effect.type_print("Login successful! You are connected to the server.")
     type_effect.spacing()
-    if len(parts) > 2:
-        type_effect.type_print("@".join(parts[2:]))      # any extra welcome text
+    if login_msg:
+        type_effect.type_print(login_msg)      # any extra welcome text
 
     #Commands
     while True:
@@ -160,12 +214,10 @@ def main():
         cmd = parts[0].upper()
 
         if cmd == "HELP":
-            client.send("HELP".encode(FORMAT))
-            type_effect.type_print(receive_response(client))
+            type_effect.type_print(session.help())
 
         elif cmd == "LOGOUT":
-            client.send("LOGOUT".encode(FORMAT))
-            type_effect.type_print(receive_response(client))
+            type_effect.type_print(session.logout())
             break
 
         elif cmd == "UPLOAD":
@@ -174,30 +226,38 @@ def main():
                 continue
             filename = parts[1]
             subfolder = parts[2] if len(parts) >= 3 else None
-            handle_upload(client, filename, subfolder)
+            handle_upload(session, filename, subfolder)
 
 
         elif cmd == "DOWNLOAD":
             if len(parts) < 2:
-                type_effect.type_print("Usage: DOWNLOAD <filename>")
+                type_effect.type_print("Usage: DOWNLOAD <filename> [<filename> ...]")
                 continue
-            handle_download(client, parts[1])
+            handle_download(session, cmd_line.split()[1:])
 
         elif cmd == "DELETE":
             if len(parts) < 2:
                 type_effect.type_print("Usage: DELETE <filename>")
                 continue
-            handle_delete(client, parts[1])
+            handle_delete(session, parts[1])
 
         elif cmd == "DIR":
-            client.send("DIR".encode(FORMAT))
-            type_effect.type_print(receive_response(client))
+            handle_dir(session, cmd_line.split()[1:])
+
+        elif cmd == "VERIFY":
+            if len(parts) < 2:
+                type_effect.type_print("Usage: VERIFY <filename> [local file]")
+                continue
+            handle_verify(session, parts[1], parts[2] if len(parts) >= 3 else None)
+
+        elif cmd == "STATS":
+            type_effect.type_print(session.stats().get("message", ""))
 
         else:
             type_effect.type_print("Unknown command. Type HELP.")
 
     type_effect.type_print("Disconnected from the server.")
-    client.close()
+    session.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,896 @@
+# session.py
+# Client side of the framed protocol (common/framing.py): connects, negotiates
+# the protocol version, logs in and runs requests.
+#
+# After the handshake a reader thread routes incoming frames to per-request
+# queues by request id, and outgoing frames are written under a send lock.
+# Any number of threads can therefore run requests on one connection at the
+# same time; upload_many()/download_many() use that to keep N transfers in
+# flight with their DATA frames interleaved.
+import json
+import mmap
+import os
+import posixpath
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import buffers, checksums, chunking, compression, delta, framing
+from common.framing import Op
+
+SIZE = 1024
+CHUNK_SIZE = 65536  # 64KB chunks
+SOCKET_BUFFER_SIZE = 65536
+FORMAT = "utf-8"
+IN_FLIGHT = 8  # concurrent transfers used by upload_many()/download_many()
+DELTA_MIN_SIZE = 1048576  # re-uploads at least this big are sent as a delta
+STRIPE_SIZE = 8 * 1048576  # byte range fetched per request by download_striped()
+STRIPE_MIN_SIZE = 64 * 1048576  # smaller files gain little from striping; download() them
+MAX_STRIPES = 8            # connections download_striped() may open
+STRIPE_RAMP_INTERVAL = 0.5  # seconds between "add another connection?" checks
+STRIPE_RAMP_GAIN = 1.10     # ...which needs this much more throughput than before
+
+
+class RemoteError(Exception):
+    """The server answered a request with an ERR frame."""
+
+
+class NotFramedServer(ConnectionError):
+    """The server did not answer HELLO; it only speaks the old text protocol."""
+
+
+class ServerBusy(ConnectionError):
+    """The server turned the connection away (ERR@BUSY); retry after retry_after seconds."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Server busy, retry in {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+class FramedClient:
+    def __init__(self, sock: socket.socket, timeout: float = None):
+        self.sock = sock
+        self.addr = None
+        self.timeout = timeout
+        self._credentials = None  # kept so reconnect() can log in again
+        self.token = None         # session token; reconnects use it instead of the password
+        self.welcome = ""
+        self.version = None
+        self.features = set()  # optional server capabilities announced in HELLO
+        self.codecs = []       # compression codecs the server supports
+        self.compress = True   # negotiate compression for uploads/downloads
+        self._next_request_id = 0
+        self._id_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._replies = {}  # request id -> queue of frames
+        self._replies_lock = threading.Lock()
+        self._closed = None  # exception that ended the reader thread
+        self._reader = None
+        self._frames = None  # the reader thread's FrameReader
+
+    @staticmethod
+    def _open_socket(addr, timeout: float = None) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Optimize socket BEFORE connecting
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Disable Nagle's algorithm
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(addr)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @classmethod
+    def connect(cls, addr, timeout: float = None) -> "FramedClient":
+        client = cls(cls._open_socket(addr, timeout), timeout)
+        client.addr = addr
+        client._start()
+        return client
+
+    def _start(self):
+        """Handshake on self.sock, then hand the socket to the reader thread."""
+        try:
+            self.hello()
+        except Exception:
+            self.sock.close()
+            raise
+        # From here on timeouts apply per reply (see recv_reply), not to the
+        # reader thread's blocking recv.
+        self.sock.settimeout(None)
+        self._reader = threading.Thread(target=self._read_loop, args=(self.sock,), daemon=True)
+        self._reader.start()
+
+    def reconnect(self):
+        """Replace a dropped connection with a new one and log in again
+        (with the session token if the server still accepts it).
+
+        Requests that were in flight on the old connection fail with
+        ConnectionError; callers retry them (uploads and downloads resume).
+        """
+        self.close()
+        sock = self._open_socket(self.addr, self.timeout)
+        with self._replies_lock:
+            for replies in self._replies.values():
+                replies.put(None)
+            self._replies = {}
+            self.sock = sock
+            self._closed = None
+        self._reader = None
+        self._start()
+        self._relogin()
+
+    def _relogin(self):
+        if self.token:
+            try:
+                self.resume()
+                return
+            except RemoteError:
+                pass  # expired, or the server restarted
+        if self._credentials:
+            self.login(*self._credentials)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    # ------------------------------------------------------------------
+    # Frame plumbing
+    # ------------------------------------------------------------------
+    def new_request_id(self) -> int:
+        """Allocate a request (stream) id and start collecting its replies."""
+        with self._id_lock:
+            self._next_request_id = (self._next_request_id + 1) & 0xFFFFFFFF
+            request_id = self._next_request_id
+        with self._replies_lock:
+            self._replies[request_id] = queue.Queue()
+        return request_id
+
+    def finish_request(self, request_id: int):
+        with self._replies_lock:
+            self._replies.pop(request_id, None)
+
+    def sendall(self, data):
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def send_frame(self, op: int, request_id: int, payload=b"", flags: int = 0):
+        with self._send_lock:
+            framing.send_frame(self.sock, op, request_id, payload, flags)
+
+    def send_json(self, op: int, request_id: int, **args):
+        self.sendall(framing.pack_json(op, request_id, args))
+
+    def _read_loop(self, sock: socket.socket):
+        reader = self._frames = framing.FrameReader(sock)
+        try:
+            while True:
+                frame = reader.read_frame()
+                with self._replies_lock:
+                    replies = self._replies.get(frame.request_id)
+                if replies is not None:
+                    replies.put(frame)
+        except Exception as e:
+            with self._replies_lock:
+                if sock is not self.sock:
+                    return  # replaced by reconnect()
+                self._closed = e if isinstance(e, ConnectionError) else ConnectionError(str(e))
+                for replies in self._replies.values():
+                    replies.put(None)
+
+    def has_reply(self, request_id: int) -> bool:
+        with self._replies_lock:
+            replies = self._replies.get(request_id)
+        return replies is not None and not replies.empty()
+
+    def recv_reply(self, request_id: int) -> framing.Frame:
+        if self._reader is None:
+            # Still in the handshake: read synchronously.
+            frame = framing.recv_frame(self.sock)
+            if frame.request_id != request_id:
+                raise framing.ProtocolError(
+                    f"Reply for request {frame.request_id} while waiting for {request_id}")
+        else:
+            with self._replies_lock:
+                replies = self._replies.get(request_id)
+            if replies is None:
+                raise framing.ProtocolError(f"Request {request_id} is not active")
+            if self._closed is not None and replies.empty():
+                raise self._closed
+            try:
+                frame = replies.get(timeout=self.timeout)
+            except queue.Empty:
+                raise socket.timeout(f"No reply to request {request_id}")
+            if frame is None:
+                raise self._closed or ConnectionError("Connection was replaced")
+        if frame.op == Op.ERR:
+            body = frame.json()
+            if body.get("message") == "BUSY":
+                raise ServerBusy(float(body.get("retry_after", 1)))
+            raise RemoteError(body.get("message", "Request failed"))
+        return frame
+
+    def call(self, op: int, **args) -> dict:
+        """Send one control request and return the JSON body of its OK reply."""
+        request_id = self.new_request_id()
+        try:
+            self.send_json(op, request_id, **args)
+            return self.recv_reply(request_id).json()
+        finally:
+            self.finish_request(request_id)
+
+    # ------------------------------------------------------------------
+    # Session
+    # ------------------------------------------------------------------
+    def hello(self):
+        welcome = self.sock.recv(SIZE).decode(FORMAT)
+        cmd, _, msg = welcome.partition("@")
+        if welcome.startswith("ERR@BUSY"):
+            _, _, retry_after = msg.partition("@")
+            raise ServerBusy(float(retry_after or 1))
+        if cmd != "OK":
+            raise ConnectionError(welcome or "Connection closed by server")
+        self.welcome = msg
+
+        request_id = self.new_request_id()
+        self.send_json(Op.HELLO, request_id, versions=list(framing.SUPPORTED_VERSIONS))
+        try:
+            frame = self.recv_reply(request_id)
+        except (framing.ProtocolError, ConnectionError) as e:
+            raise NotFramedServer(f"Server does not speak the framed protocol ({e})")
+        finally:
+            self.finish_request(request_id)
+        if frame.op != Op.HELLO:
+            raise framing.ProtocolError(f"Expected HELLO, got {framing.op_name(frame.op)}")
+        reply = frame.json()
+        self.version = reply["version"]
+        self.features = set(reply.get("features", []))
+        self.codecs = reply.get("codecs", [])
+
+    def login(self, username: str, password: str) -> str:
+        reply = self.call(Op.LOGIN, username=username, password=password)
+        self._credentials = (username, password)
+        self.token = reply.get("token")
+        return reply.get("message", "")
+
+    def resume(self, token: str = None) -> str:
+        """Log in with a session token from an earlier login (default: ours).
+
+        Raises RemoteError if the server no longer accepts it; the connection
+        stays open for login().
+        """
+        reply = self.call(Op.LOGIN, token=token or self.token)
+        self.token = reply.get("token")
+        return reply.get("message", "")
+
+    def logout(self) -> str:
+        return self.call(Op.LOGOUT).get("message", "")
+
+    def help(self) -> str:
+        return self.call(Op.HELP).get("message", "")
+
+    def dir(self) -> str:
+        return self.call(Op.DIR).get("message", "")
+
+    def list_dir(self, path: str = "", recursive: bool = False, pattern: str = None,
+                 prefix: str = None, page_size: int = None):
+        """Yield [path, "dir" | "file", size, mtime] for every entry, page by page.
+
+        Entries arrive in DATA frames as the server streams each page, so
+        large listings are never squeezed into one reply.
+        """
+        offset = 0
+        while offset is not None:
+            args = {"path": path, "offset": offset}
+            if recursive:
+                args["recursive"] = True
+            if pattern:
+                args["pattern"] = pattern
+            if prefix:
+                args["prefix"] = prefix
+            if page_size:
+                args["limit"] = page_size
+            request_id = self.new_request_id()
+            try:
+                self.send_json(Op.DIR, request_id, **args)
+                self.recv_reply(request_id)
+                while True:
+                    frame = self.recv_reply(request_id)
+                    if frame.op == Op.END:
+                        offset = frame.json().get("next")
+                        break
+                    yield from frame.json().get("entries", [])
+            finally:
+                self.finish_request(request_id)
+
+    def delete(self, name: str) -> str:
+        return self.call(Op.DELETE, name=name).get("message", "")
+
+    def make_dir(self, name: str) -> str:
+        return self.call(Op.UPLOAD_EMPTY, name=name).get("message", "")
+
+    def stats(self) -> dict:
+        return self.call(Op.STATS)
+
+    def ping(self, payload: bytes = b"") -> bytes:
+        request_id = self.new_request_id()
+        try:
+            self.send_frame(Op.PING, request_id, payload)
+            frame = self.recv_reply(request_id)
+        finally:
+            self.finish_request(request_id)
+        if frame.op != Op.PONG:
+            raise framing.ProtocolError(f"Expected PONG, got {framing.op_name(frame.op)}")
+        return frame.payload
+
+    # ------------------------------------------------------------------
+    # Transfers
+    # ------------------------------------------------------------------
+    def upload(self, path: str, name: str = None, sub: str = None, offset: int = 0,
+               codec: str = "auto", upload_id: str = None) -> str:
+        """Upload a local file, starting at byte offset when resuming the
+        server's upload upload_id (from UPLOAD_STATUS).
+
+        DATA frames follow the request immediately. codec "auto" compresses
+        with the first codec the server offers if a sample of the file is
+        worth it; None sends raw bytes; a codec name forces that codec.
+        The bytes read are hashed as they go out and the digest follows in
+        an END frame; the server keeps the file only if its own digest of
+        what it received matches.
+        """
+        name = name or os.path.basename(path)
+        filesize = os.path.getsize(path)
+        request_id = self.new_request_id()
+        try:
+            with open(path, "rb") as f:
+                if codec == "auto":
+                    codec = None
+                    if self.compress and self.codecs and filesize > offset:
+                        f.seek(offset)
+                        codec = compression.choose(f.read(compression.SAMPLE_SIZE), self.codecs)
+                encoder = compression.Encoder(codec) if codec else None
+                chunk_size = encoder.codec.chunk_size if encoder else CHUNK_SIZE
+
+                args = {"name": name, "size": filesize, "verify": True}
+                if sub:
+                    args["sub"] = sub
+                if offset:
+                    args["offset"] = offset
+                    if upload_id:
+                        args["upload_id"] = upload_id
+                if codec:
+                    args["codec"] = codec
+                self.send_json(Op.UPLOAD, request_id, **args)
+
+                hasher = checksums.file_hasher(path, offset) if offset else checksums.new()
+                sent = offset
+                f.seek(offset)
+                # Every chunk is read into the same pooled buffer and sent
+                # from it before the next one is read.
+                with buffers.lease(chunk_size) as buf:
+                    while sent < filesize:
+                        if self.has_reply(request_id):
+                            break  # refused early; the server drops the rest
+                        n = f.readinto(buf[:min(chunk_size, filesize - sent)])
+                        if not n:
+                            raise IOError(f"'{path}' shrank while uploading")
+                        chunk = buf[:n]
+                        hasher.update(chunk)
+                        self.send_frame(Op.DATA, request_id, encoder.encode(chunk) if encoder else chunk)
+                        sent += n
+                    else:
+                        self.send_json(Op.END, request_id, digest=hasher.hexdigest())
+
+            return self.recv_reply(request_id).json().get("message", "")
+        finally:
+            self.finish_request(request_id)
+
+    def resume_upload(self, path: str, name: str = None, sub: str = None) -> str:
+        """Upload path, continuing an earlier interrupted upload when possible.
+
+        The server reports how many bytes it holds and their digest; we only
+        resume if our own file has the same prefix. If nothing is pending but
+        the server already has an older copy, only the differences are sent
+        (upload_delta).
+        """
+        name = name or os.path.basename(path)
+        filesize = os.path.getsize(path)
+        status = self.call(Op.UPLOAD_STATUS, name=name, sub=sub, size=filesize)
+        offset = status.get("offset", 0)
+        if offset and status.get("digest") != checksums.file_digest(path, offset):
+            offset = 0
+        existing = status.get("existing_size")
+        if not offset and existing and min(existing, filesize) >= DELTA_MIN_SIZE:
+            try:
+                return self.upload_delta(path, name, sub).get("message", "")
+            except RemoteError:
+                pass  # e.g. the file changed while we read it; send it whole
+        return self.upload(path, name, sub, offset, upload_id=status.get("upload_id"))
+
+    def upload_delta(self, path: str, name: str = None, sub: str = None) -> dict:
+        """Re-upload path as an rsync-style delta against the server's copy.
+
+        Returns the server's reply (message, size, copied, literal).
+        """
+        name = name or os.path.basename(path)
+        filesize = os.path.getsize(path)
+        digest = checksums.file_digest(path)
+        request_id = self.new_request_id()
+        try:
+            args = {"name": name, "size": filesize, "delta": True, "digest": digest}
+            if sub:
+                args["sub"] = sub
+            self.send_json(Op.UPLOAD, request_id, **args)
+            ack = self.recv_reply(request_id).json()
+            table = {}
+            if ack.get("blocks"):
+                table = delta.parse_signatures(self.recv_reply(request_id).payload)
+
+            with open(path, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for instruction in delta.instructions(data, ack["block_size"], table):
+                    if self.has_reply(request_id):
+                        break  # refused
+                    self.send_frame(Op.DATA, request_id, instruction)
+
+            return self.recv_reply(request_id).json()
+        finally:
+            self.finish_request(request_id)
+
+    def upload_dedup(self, path: str, name: str = None, sub: str = None) -> dict:
+        """Upload path to a server with the "dedup" feature, sending only new chunks.
+
+        The file is split into content-defined chunks and their ids are sent
+        first; the server answers with the ones it is missing. Since stored
+        chunks persist, retrying an interrupted upload only sends what is
+        still missing. Returns the server's reply (message, size, sent, reused).
+        """
+        name = name or os.path.basename(path)
+        chunks, offsets = [], []
+        size = 0
+        hasher = checksums.new()
+        with open(path, "rb") as f:
+            for data in chunking.split(f):
+                chunks.append([chunking.chunk_id(data), len(data)])
+                offsets.append(size)
+                size += len(data)
+                hasher.update(data)
+
+        request_id = self.new_request_id()
+        try:
+            args = {"name": name, "size": size, "chunks": chunks, "digest": hasher.hexdigest()}
+            if sub:
+                args["sub"] = sub
+            self.send_json(Op.UPLOAD_CHUNKS, request_id, **args)
+            missing = self.recv_reply(request_id).json().get("missing", [])
+
+            with open(path, "rb") as f:
+                for index in missing:
+                    if self.has_reply(request_id):
+                        break  # refused (e.g. a chunk changed on disk)
+                    f.seek(offsets[index])
+                    self.send_frame(Op.DATA, request_id, f.read(chunks[index][1]))
+
+            return self.recv_reply(request_id).json()
+        finally:
+            self.finish_request(request_id)
+
+    def download(self, name: str, dest: str = None) -> int:
+        """Download a remote file into dest (default: its base name). Returns its size.
+
+        Data is written to dest + ".part" and renamed when complete. If a
+        .part file is already there the download resumes after it, provided
+        the server's copy starts with the same bytes. The received bytes are
+        hashed as they arrive and checked against the server's digest (sent
+        in its reply, or in END); a mismatch discards the .part file.
+        """
+        dest = dest or os.path.basename(name)
+        part = dest + ".part"
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+
+        request_id = self.new_request_id()
+        try:
+            args = {"name": name}
+            hasher = checksums.new()
+            if offset:
+                hasher = checksums.file_hasher(part, offset)
+                args["offset"] = offset
+                args["prefix_digest"] = hasher.copy().hexdigest()
+            if self.compress:
+                args["accept"] = compression.available()
+            self.send_json(Op.DOWNLOAD, request_id, **args)
+            reply = self.recv_reply(request_id).json()
+            filesize = int(reply["size"])
+            if int(reply.get("offset", 0)) != offset:
+                offset, hasher = 0, checksums.new()  # our prefix was rejected
+
+            received = offset
+            trailer = {}
+            with open(part, "r+b" if offset else "wb") as f:
+                f.truncate(offset)
+                f.seek(offset)
+                for data in self._recv_data(request_id, reply.get("codec"), filesize - offset, trailer):
+                    f.write(data)
+                    hasher.update(data)
+                    received += len(data)
+        finally:
+            self.finish_request(request_id)
+
+        if received != filesize:
+            raise ConnectionError(f"Download incomplete: {received} of {filesize} bytes")
+        expected = reply.get("digest") or trailer.get("digest")
+        if expected and hasher.hexdigest() != expected:
+            os.remove(part)
+            raise ConnectionError(f"Checksum mismatch downloading '{name}'; discarded")
+        os.replace(part, dest)
+        return received
+
+    def _recv_data(self, request_id: int, codec: str, limit: int, trailer: dict = None):
+        """Yield the raw bytes of a download's DATA frames until END.
+
+        Compressed payloads are decoded; limit is the most raw bytes the
+        transfer may produce. The END frame's fields go into trailer.
+        """
+        decoder = compression.Decoder(codec) if codec else None
+        while True:
+            frame = self.recv_reply(request_id)
+            if frame.op == Op.END:
+                if trailer is not None:
+                    trailer.update(frame.json())
+                return
+            if frame.op != Op.DATA:
+                raise framing.ProtocolError(f"Unexpected {framing.op_name(frame.op)} during download")
+            data = frame.payload
+            if decoder is not None:
+                data = decoder.decode(data, limit)
+            limit -= len(data)
+            yield data
+            # The caller has written the data out by now; the reader can
+            # receive a later DATA frame into the same buffer.
+            self._frames.recycle(frame.payload)
+
+    def download_range(self, name: str, fd: int, offset: int, length: int, progress=None):
+        """Download length bytes of name from offset straight into fd at the same offset.
+
+        progress, if given, is called with the size of every piece written.
+        Returns (remote file size, bytes received, the file's digest or None).
+        """
+        request_id = self.new_request_id()
+        try:
+            args = {"name": name, "offset": offset, "length": length}
+            if self.compress:
+                args["accept"] = compression.available()
+            self.send_json(Op.DOWNLOAD, request_id, **args)
+            reply = self.recv_reply(request_id).json()
+            expected = int(reply["length"])
+            received = 0
+            for data in self._recv_data(request_id, reply.get("codec"), expected):
+                _write_at(fd, data, offset + received)
+                received += len(data)
+                if progress is not None:
+                    progress(len(data))
+        finally:
+            self.finish_request(request_id)
+        if received != expected:
+            raise ConnectionError(f"Range download incomplete: {received} of {expected} bytes")
+        return int(reply["size"]), received, reply.get("digest")
+
+    def open_stripe(self) -> "FramedClient":
+        """Another connection to the same server, logged in as the same user."""
+        client = FramedClient.connect(self.addr, self.timeout)
+        client.token, client._credentials = self.token, self._credentials
+        try:
+            client._relogin()
+        except Exception:
+            client.close()
+            raise
+        return client
+
+    def remote_size(self, name: str):
+        """Size of the remote file name, from a listing of its folder (None if there is none)."""
+        name = name.replace("\\", "/").strip("/")
+        for path, kind, size, _ in self.list_dir(posixpath.dirname(name), prefix=name):
+            if path == name and kind == "file":
+                return size
+        return None
+
+    def download_striped(self, name: str, dest: str = None, max_stripes: int = MAX_STRIPES) -> int:
+        """Download a large file over several connections in parallel. Returns its size.
+
+        One TCP stream with small socket buffers can't fill a link with a
+        large bandwidth-delay product; K streams can. The file is fetched in
+        STRIPE_SIZE byte ranges, each written at its offset in a preallocated
+        file. Connections are added one at a time while each addition still
+        raises the total throughput by STRIPE_RAMP_GAIN, up to max_stripes.
+        Ranges arrive out of order, so the assembled file is hashed once at
+        the end and checked against the server's digest.
+
+        If the download fails, dest + ".stripes" and a .json listing the
+        ranges already written stay behind, and the next call only fetches
+        the rest (starting over if the remote file's size changed).
+        """
+        dest = dest or os.path.basename(name)
+        tmp = dest + ".stripes"
+        state_path = tmp + ".json"
+        state = _read_stripe_state(state_path) if os.path.isfile(tmp) else None
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        fd = os.open(tmp, flags if state else flags | os.O_TRUNC, 0o644)
+        size, digest = (state["size"], state.get("digest")) if state else (None, None)
+        done = set(state["done"]) if state else set()
+        try:
+            # The first missing range, on this connection, also tells us the
+            # file size (and whether it is still the file we started on).
+            first = min(set(range(0, size, STRIPE_SIZE)) - done, default=None) if state else 0
+            if first is not None:
+                remote_size, received, remote_digest = self.download_range(name, fd, first, STRIPE_SIZE)
+                if remote_size != size or (digest and remote_digest and remote_digest != digest):
+                    done.clear()
+                size, digest = remote_size, remote_digest or digest
+                done.add(first)
+            ranges = [(offset, min(STRIPE_SIZE, size - offset))
+                      for offset in range(0, size, STRIPE_SIZE) if offset not in done]
+            if ranges:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, max(size, os.fstat(fd).st_size))
+                _StripedDownload(self, name, fd, ranges, max_stripes, done).run()
+            os.ftruncate(fd, size)
+            if digest is None:
+                digest = self.verify(name)["digest"]  # the server hashes it once and keeps it
+            if checksums.file_digest(tmp) != digest:
+                os.close(fd)
+                fd = None
+                for path in (tmp, state_path):
+                    os.remove(path)
+                raise ConnectionError(f"Checksum mismatch downloading '{name}'; discarded")
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+                if size is not None:
+                    _write_stripe_state(state_path, size, digest, done)
+                else:
+                    os.remove(tmp)  # nothing was received (e.g. no such file)
+            raise
+        os.close(fd)
+        os.replace(tmp, dest)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return size
+
+    def verify(self, name: str, local_path: str = None) -> dict:
+        """The server's digest of a remote file (digest, algorithm, size, computed).
+
+        With local_path, the local file's digest is sent along and the reply
+        also carries "match".
+        """
+        args = {"name": name}
+        if local_path:
+            args["digest"] = checksums.file_digest(local_path)
+        return self.call(Op.VERIFY, **args)
+
+    def upload_tree(self, local_dir: str, root: str) -> dict:
+        """Upload a whole folder as one UPLOAD_TREE request.
+
+        Sends a manifest of every folder and file, then streams all file
+        contents back to back (tar-like) in CHUNK_SIZE DATA frames, an END
+        frame with the digest of every file, and waits for a single summary
+        reply. A file that changed size while being read gets no digest, so
+        the server drops it. Returns that summary; those files are listed
+        under "changed".
+        """
+        dirs, files, paths = [], [], []
+        for current, subdirs, names in os.walk(local_dir):
+            rel_dir = os.path.relpath(current, local_dir)
+            rel_dir = "" if rel_dir == "." else rel_dir.replace(os.sep, "/")
+            if rel_dir:
+                dirs.append(rel_dir)
+            for name in names:
+                path = os.path.join(current, name)
+                files.append([f"{rel_dir}/{name}" if rel_dir else name, os.path.getsize(path)])
+                paths.append(path)
+
+        request_id = self.new_request_id()
+        changed, digests = [], []
+        try:
+            self.send_json(Op.UPLOAD_TREE, request_id, root=root, dirs=dirs, files=files, verify=True)
+
+            # Files are read back to back into one pooled frame buffer, which
+            # is sent each time it fills.
+            with buffers.lease(CHUNK_SIZE) as buf:
+                used = 0
+                for path, (rel, size) in zip(paths, files):
+                    if self.has_reply(request_id):
+                        break  # manifest refused
+                    hasher = checksums.new()
+                    with open(path, "rb") as f:
+                        remaining = size
+                        while remaining:
+                            want = min(CHUNK_SIZE - used, remaining)
+                            n = f.readinto(buf[used:used + want]) if hasher is not None else 0
+                            if n:
+                                hasher.update(buf[used:used + n])
+                            else:
+                                # Shrank. The manifest promised `size` bytes, so
+                                # the rest of the stream is padded, even if the
+                                # file grows back; without a digest the server
+                                # drops the file.
+                                hasher = None
+                                buf[used:used + want] = bytes(want)
+                                n = want
+                            used += n
+                            remaining -= n
+                            if used == CHUNK_SIZE:
+                                self.send_frame(Op.DATA, request_id, buf)
+                                used = 0
+                        if os.fstat(f.fileno()).st_size != size:
+                            hasher = None  # grew (or shrank and grew back) while we read it
+                    if hasher is None:
+                        changed.append(rel)
+                    digests.append(hasher.hexdigest() if hasher else None)
+                if not self.has_reply(request_id):
+                    if used:
+                        self.send_frame(Op.DATA, request_id, buf[:used])
+                    self.send_json(Op.END, request_id, digests=digests)
+
+            summary = self.recv_reply(request_id).json()
+        finally:
+            self.finish_request(request_id)
+        summary["changed"] = sorted(changed)
+        return summary
+
+    def upload_many(self, items, in_flight: int = IN_FLIGHT) -> list:
+        """Upload (path, sub) pairs with up to in_flight uploads on the wire.
+
+        Returns [(path, message_or_exception)] in the order given.
+        """
+        def one(item):
+            path, sub = item
+            try:
+                return path, self.upload(path, sub=sub)
+            except (RemoteError, OSError) as e:
+                return path, e
+
+        with ThreadPoolExecutor(max_workers=max(1, in_flight)) as pool:
+            return list(pool.map(one, items))
+
+    def download_many(self, names, in_flight: int = IN_FLIGHT) -> list:
+        """Download remote names into the current directory, in_flight at a time.
+
+        Returns [(name, size_or_exception)] in the order given.
+        """
+        def one(name):
+            try:
+                return name, self.download(name, name)
+            except (RemoteError, OSError) as e:
+                return name, e
+
+        with ThreadPoolExecutor(max_workers=max(1, in_flight)) as pool:
+            return list(pool.map(one, names))
+
+
+def _write_at(fd: int, data, offset: int):
+    """os.pwrite(), or seek + write where there is none (Windows)."""
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+        return
+    view = memoryview(data)
+    with _seek_lock:  # stripes share the descriptor and its file position
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+_seek_lock = threading.Lock()
+
+
+def _read_stripe_state(path: str):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        return {"size": int(state["size"]), "digest": state.get("digest"),
+                "done": [int(offset) for offset in state["done"]]}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_stripe_state(path: str, size: int, digest: str, done):
+    with open(path, "w") as f:
+        json.dump({"size": size, "digest": digest, "done": sorted(done)}, f)
+
+
+class _StripedDownload:
+    """Workers pulling byte ranges off a shared list, one per connection.
+
+    The offset of every range written is added to done. received counts
+    bytes as they are written, so the ramp sees progress within a range.
+    """
+
+    def __init__(self, client: FramedClient, name: str, fd: int, ranges: list, max_stripes: int,
+                 done: set):
+        self.client = client
+        self.name = name
+        self.fd = fd
+        self.done = done
+        self.ranges = list(reversed(ranges))  # pop() takes the lowest offset
+        self.max_stripes = max(1, max_stripes)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.errors = []
+        self.workers = []
+        self.connections = []
+
+    def next_range(self):
+        with self.lock:
+            return self.ranges.pop() if self.ranges else None
+
+    def work(self, conn: FramedClient):
+        while True:
+            item = self.next_range()
+            if item is None:
+                return
+            offset, length = item
+            try:
+                conn.download_range(self.name, self.fd, offset, length, self.progress)
+            except Exception as e:
+                with self.lock:
+                    self.ranges.append(item)  # another connection retries it
+                    self.errors.append(e)
+                return
+            with self.lock:
+                self.done.add(offset)
+
+    def progress(self, n: int):
+        with self.lock:
+            self.received += n
+
+    def start_worker(self, conn: FramedClient):
+        worker = threading.Thread(target=self.work, args=(conn,), daemon=True)
+        self.workers.append(worker)
+        worker.start()
+
+    def alive(self) -> bool:
+        return any(worker.is_alive() for worker in self.workers)
+
+    def run(self):
+        self.start_worker(self.client)
+        best_rate = 0.0
+        ramping = True
+        try:
+            while self.alive():
+                before, start = self.received, time.perf_counter()
+                for worker in self.workers:
+                    worker.join(STRIPE_RAMP_INTERVAL / len(self.workers))
+                rate = (self.received - before) / (time.perf_counter() - start)
+                if not ramping or not self.ranges or len(self.workers) >= self.max_stripes:
+                    continue
+                if not rate:
+                    continue  # nothing arrived yet (e.g. a new connection logging in)
+                if best_rate and rate < best_rate * STRIPE_RAMP_GAIN:
+                    ramping = False  # the last connection didn't help; hold here
+                    continue
+                best_rate = rate
+                try:
+                    conn = self.client.open_stripe()
+                except OSError as e:
+                    self.errors.append(e)
+                    ramping = False
+                    continue
+                self.connections.append(conn)
+                self.start_worker(conn)
+        finally:
+            for conn in self.connections:
+                try:
+                    conn.logout()
+                except (RemoteError, OSError):
+                    pass
+                conn.close()
+        if self.ranges:
+            raise self.errors[0] if self.errors else ConnectionError("Striped download stopped early")
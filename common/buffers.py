@@ -0,0 +1,80 @@
+# buffers.py
+# Reusable byte buffers for the transfer loops on client and server.
+#
+# conn.recv(n) and f.read(n) return a new bytes object per call, and joining
+# pieces with += copies them again. Transfer loops instead lease a
+# preallocated bytearray, fill it with recv_into()/readinto() and hand
+# memoryview slices of it to write(), hash update() and sendall(), none of
+# which copy. A leased buffer is reused as soon as it goes back, so nothing
+# may keep a view of it (queue it, store it) past the lease.
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+DEFAULT_SIZE = 65536
+KEEP_BYTES = 8 * 1048576  # idle memory a pool holds on to; the rest is left to the GC
+
+
+class BufferPool:
+    """A free list of bytearrays of one size, safe to share between threads."""
+
+    def __init__(self, size: int = DEFAULT_SIZE, keep: int = None):
+        self.size = size
+        self.keep = keep if keep is not None else max(1, KEEP_BYTES // size)
+        self._free = deque()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.created += 1
+        return bytearray(self.size)
+
+    def release(self, buf: bytearray):
+        with self._lock:
+            if len(self._free) < self.keep:
+                self._free.append(buf)
+
+    @contextmanager
+    def lease(self):
+        """A memoryview of a pooled buffer, returned to the pool on exit."""
+        buf = self.acquire()
+        view = memoryview(buf)
+        try:
+            yield view
+        finally:
+            view.release()
+            self.release(buf)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "created": self.created, "reused": self.reused,
+                    "idle": len(self._free)}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def pool(size: int = DEFAULT_SIZE) -> BufferPool:
+    """The process-wide pool of `size` byte buffers."""
+    with _pools_lock:
+        p = _pools.get(size)
+        if p is None:
+            p = _pools[size] = BufferPool(size)
+        return p
+
+
+def lease(size: int = DEFAULT_SIZE):
+    """`with buffers.lease(n) as view:` a pooled n byte buffer."""
+    return pool(size).lease()
+
+
+def stats() -> list:
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [p.stats() for p in pools]
@@ -0,0 +1,47 @@
+# checksums.py
+# Content digests shared by client and server (BLAKE2b via hashlib).
+import hashlib
+
+from common import buffers
+
+ALGORITHM = "blake2b-256"
+READ_SIZE = 1048576
+
+
+def new():
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_digest(path: str, length: int = None) -> str:
+    """Hex digest of the first `length` bytes of path (the whole file if None)."""
+    with open(path, "rb") as f:
+        return stream_digest(f, length)
+
+
+def stream_digest(f, length: int = None) -> str:
+    """Hex digest of the next `length` bytes of an open file (the rest if None)."""
+    return update_from(new(), f, length).hexdigest()
+
+
+def file_hasher(path: str, length: int = None):
+    """A hash object fed with the first `length` bytes of path, ready for more.
+
+    Used when a transfer resumes: the prefix already on disk is hashed once
+    and the rest is added as it streams in.
+    """
+    with open(path, "rb") as f:
+        return update_from(new(), f, length)
+
+
+def update_from(h, f, length: int = None):
+    """Feed h the next `length` bytes of an open file (the rest if None)."""
+    remaining = length
+    with buffers.lease(READ_SIZE) as buf:
+        while remaining is None or remaining > 0:
+            n = f.readinto(buf if remaining is None else buf[:min(READ_SIZE, remaining)])
+            if not n:
+                break
+            h.update(buf[:n])
+            if remaining is not None:
+                remaining -= n
+    return h
@@ -0,0 +1,116 @@
+# chunking.py
+# Content-defined chunking (FastCDC-style gear hash) shared by the client and
+# the chunked storage backend. Cut points depend on the bytes themselves, not
+# on their offsets, so inserting or removing data in the middle of a file only
+# changes the chunks around the edit; the rest still hash the same and are
+# deduplicated. Both sides must use the same parameters to find the same cuts.
+#
+# With numpy the hash is computed for a block of positions at a time; without
+# it cut_point() falls back to a much slower byte loop that finds the same
+# cuts.
+import hashlib
+import re
+
+from common import checksums
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MIN_SIZE = 16 * 1024
+AVG_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+READ_SIZE = 1048576
+STEP = 16384  # positions hashed at once by the numpy search
+CHUNK_ID = re.compile(r"[0-9a-f]{64}")
+
+# 256 fixed pseudo-random 32-bit values, one per byte value.
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=4).digest(), "big")
+        for i in range(256)]
+
+# Normalized chunking: a harder mask before AVG_SIZE and an easier one after
+# keeps chunk sizes close to the average. The masks test the high bits, which
+# depend on the last 32 bytes rather than only the last few.
+MASK_S = ((1 << 18) - 1) << 14
+MASK_L = ((1 << 14) - 1) << 18
+
+_GEAR = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+
+def cut_point(data, n: int) -> int:
+    """Length of the first chunk of data[:n]."""
+    if n <= MIN_SIZE:
+        return n
+    if numpy is not None:
+        return _cut_point_numpy(data, n)
+    gear = GEAR
+    h = 0
+    i = MIN_SIZE
+    normal = min(n, AVG_SIZE)
+    for b in data[MIN_SIZE:normal]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        i += 1
+        if not h & MASK_S:
+            return i
+    end = min(n, MAX_SIZE)
+    for b in data[normal:end]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        i += 1
+        if not h & MASK_L:
+            return i
+    return end
+
+
+def _hashes(data, start: int, stop: int):
+    """The gear hash after each byte of data[start:stop], as cut_point()'s
+    loop has it: over the last 32 bytes, none before MIN_SIZE."""
+    first = max(MIN_SIZE, start - 31)
+    h = _GEAR[numpy.frombuffer(data, numpy.uint8, stop - first, first)]
+    # h[i] = sum(gear[b[i - k]] << k for k < 32), built by doubling the span.
+    for shift in (1, 2, 4, 8, 16):
+        h[shift:] += h[:-shift] << numpy.uint32(shift)
+    return h[start - first:]
+
+
+def _cut_point_numpy(data, n: int) -> int:
+    normal = min(n, AVG_SIZE)
+    end = min(n, MAX_SIZE)
+    start = MIN_SIZE
+    while start < end:
+        stop = min(normal if start < normal else end, start + STEP)
+        mask = numpy.uint32(MASK_S if start < normal else MASK_L)
+        hits = numpy.flatnonzero((_hashes(data, start, stop) & mask) == 0)
+        if hits.size:
+            return start + int(hits[0]) + 1
+        start = stop
+    return end
+
+
+def split(f):
+    """Yield the content-defined chunks of an open binary file."""
+    buf = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buf) < MAX_SIZE:
+            data = f.read(READ_SIZE)
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        n = cut_point(buf, len(buf))
+        yield bytes(buf[:n])
+        del buf[:n]
+
+
+def chunk_id(data) -> str:
+    """Name of a chunk in the store: the hex digest of its bytes."""
+    h = checksums.new()
+    h.update(data)
+    return h.hexdigest()
+
+
+def is_chunk_id(value) -> bool:
+    """Whether value is a chunk id as chunk_id() writes it (it becomes a file name)."""
+    return isinstance(value, str) and CHUNK_ID.fullmatch(value) is not None
@@ -0,0 +1,216 @@
+# compression.py
+# On-the-wire compression for UPLOAD / DOWNLOAD DATA frames.
+#
+# A codec turns raw chunks into DATA payloads that can each be decoded as
+# soon as they arrive: zlib keeps one stream and sync-flushes every frame
+# (history carries over, so the ratio stays close to one-shot compression);
+# lzma can't sync-flush, so every frame is its own small .xz block and the
+# codec uses bigger frames to make up for it. Raw sizes and offsets never
+# change meaning: compression is invisible outside the DATA payloads.
+#
+# Codecs are pluggable: register_codec() adds one, and peers negotiate per
+# transfer from the names both sides support.
+import lzma
+import threading
+import time
+import zlib
+
+SAMPLE_SIZE = 65536
+MIN_SAVING = 0.10  # compress only if the sample shrinks by at least this much
+
+# Leading bytes of formats that are already compressed.
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",          # gzip
+    b"PK\x03\x04",        # zip, docx, jar, ...
+    b"\x89PNG",           # png
+    b"\xff\xd8\xff",      # jpeg
+    b"GIF8",              # gif
+    b"\xfd7zXZ\x00",      # xz
+    b"BZh",               # bzip2
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"Rar!",              # rar
+    b"OggS",              # ogg
+    b"fLaC",              # flac
+    b"ID3",               # mp3
+)
+
+
+class DecompressionError(ValueError):
+    """A compressed payload was corrupt or larger than allowed."""
+
+
+class Codec:
+    """Interface: a name, a preferred raw frame size, and stream factories."""
+    name = None
+    chunk_size = 262144
+
+    def encoder(self):
+        raise NotImplementedError
+
+    def decoder(self):
+        raise NotImplementedError
+
+
+class _ZlibEncoder:
+    def __init__(self, level):
+        self._z = zlib.compressobj(level)
+
+    def encode(self, data) -> bytes:
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+
+class _ZlibDecoder:
+    def __init__(self):
+        self._z = zlib.decompressobj()
+
+    def decode(self, payload, limit: int) -> bytes:
+        try:
+            data = self._z.decompress(payload, limit + 1)
+        except zlib.error as e:
+            raise DecompressionError(str(e))
+        if len(data) > limit or self._z.unconsumed_tail:
+            raise DecompressionError("Compressed frame expands past the announced size")
+        return data
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    chunk_size = 262144
+    level = 1  # fast; text still shrinks several times over
+
+    def encoder(self):
+        return _ZlibEncoder(self.level)
+
+    def decoder(self):
+        return _ZlibDecoder()
+
+
+class _LzmaEncoder:
+    def __init__(self, preset):
+        self.preset = preset
+
+    def encode(self, data) -> bytes:
+        return lzma.compress(data, preset=self.preset, check=lzma.CHECK_NONE)
+
+
+class _LzmaDecoder:
+    def decode(self, payload, limit: int) -> bytes:
+        d = lzma.LZMADecompressor()
+        try:
+            data = d.decompress(payload, max_length=limit + 1)
+        except lzma.LZMAError as e:
+            raise DecompressionError(str(e))
+        if len(data) > limit or not d.eof:
+            raise DecompressionError("Compressed frame expands past the announced size")
+        return data
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+    chunk_size = 1048576
+    preset = 1
+
+    def encoder(self):
+        return _LzmaEncoder(self.preset)
+
+    def decoder(self):
+        return _LzmaDecoder()
+
+
+CODECS = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(ZlibCodec())
+register_codec(LzmaCodec())
+
+
+def available() -> list:
+    return list(CODECS)
+
+
+def get(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported codec '{name}'")
+
+
+def worth_compressing(sample) -> bool:
+    """Sample the start of a transfer: skip known compressed formats, and
+    anything a fast zlib pass can't shrink by MIN_SAVING."""
+    sample = bytes(sample[:SAMPLE_SIZE])
+    if len(sample) < 512 or sample.startswith(COMPRESSED_MAGIC):
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def choose(sample, offered, preferred: str = None):
+    """Codec name to use for a transfer starting with sample, or None.
+
+    offered is the peer's codec list in its order of preference.
+    """
+    names = [name for name in offered if name in CODECS]
+    if preferred in names:
+        names = [preferred]
+    if not names or not worth_compressing(sample):
+        return None
+    return names[0]
+
+
+# ----------------------------------------------------------------------
+# Stats: raw vs wire bytes and CPU seconds, per codec and direction.
+# ----------------------------------------------------------------------
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(codec: str, direction: str, raw: int, wire: int, cpu: float):
+    with _stats_lock:
+        s = _stats.setdefault((codec, direction), {"raw_bytes": 0, "wire_bytes": 0, "cpu_seconds": 0.0})
+        s["raw_bytes"] += raw
+        s["wire_bytes"] += wire
+        s["cpu_seconds"] += cpu
+
+
+def stats() -> dict:
+    """{"zlib/compress": {"raw_bytes", "wire_bytes", "cpu_seconds", "ratio"}, ...}"""
+    with _stats_lock:
+        return {
+            f"{codec}/{direction}": dict(s, cpu_seconds=round(s["cpu_seconds"], 6),
+                                         ratio=round(s["raw_bytes"] / s["wire_bytes"], 3) if s["wire_bytes"] else 0.0)
+            for (codec, direction), s in _stats.items()
+        }
+
+
+class Encoder:
+    """Streaming encoder that records its bytes and CPU time."""
+
+    def __init__(self, name: str):
+        self.codec = get(name)
+        self._encoder = self.codec.encoder()
+
+    def encode(self, data) -> bytes:
+        start = time.thread_time()
+        payload = self._encoder.encode(data)
+        _record(self.codec.name, "compress", len(data), len(payload), time.thread_time() - start)
+        return payload
+
+
+class Decoder:
+    """Streaming decoder that records its bytes and CPU time."""
+
+    def __init__(self, name: str):
+        self.codec = get(name)
+        self._decoder = self.codec.decoder()
+
+    def decode(self, payload, limit: int) -> bytes:
+        """Raw bytes of one DATA payload; raises if they would exceed limit."""
+        start = time.thread_time()
+        data = self._decoder.decode(payload, limit)
+        _record(self.codec.name, "decompress", len(data), len(payload), time.thread_time() - start)
+        return data
@@ -0,0 +1,144 @@
+# delta.py
+# rsync-style delta transfer for re-uploading a modified file.
+#
+# The server splits its current copy into fixed-size blocks and sends one
+# signature per block: a rolling Adler-32 (cheap to slide one byte at a time)
+# and a short BLAKE2b digest. The client slides a block-sized window over its
+# local file; wherever the weak and then the strong checksum match a block it
+# emits COPY(block), everything in between goes out as LITERAL bytes. The
+# server rebuilds the file from its old blocks and the literals, and checks
+# the digest of the whole result before renaming it into place.
+#
+# The sliding search runs in Python at a few MB/s, so it only pays while it
+# finds blocks. Once GIVE_UP_AFTER bytes or more were searched and more than
+# MAX_UNMATCHED of them had no match, the rest of the file goes out as
+# literals without searching, about as fast as a plain upload.
+import hashlib
+import math
+import struct
+import zlib
+
+MOD_ADLER = 65521
+MIN_BLOCK = 2048
+MAX_BLOCK = 131072
+MAX_LITERAL = 262144
+READ_SIZE = 1048576
+GIVE_UP_AFTER = 1048576  # bytes searched before the search may be given up
+MAX_UNMATCHED = 0.5      # ...when more than this fraction of the file so far had no match
+
+SIGNATURE = struct.Struct("!I8s")   # weak Adler-32, strong 8-byte BLAKE2b
+COPY = struct.Struct("!cII")        # b"C", first block index, block count
+LITERAL = b"L"                      # b"L" followed by the literal bytes
+
+
+def block_size(size: int) -> int:
+    """Block size for a file of `size` bytes (about sqrt(size), like rsync)."""
+    n = math.isqrt(max(size, 1))
+    n = (n + 1023) // 1024 * 1024
+    return max(MIN_BLOCK, min(MAX_BLOCK, n))
+
+
+def strong(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+def signatures(f, block: int) -> bytes:
+    """Packed signatures of every full block of an open file, from its start."""
+    out = bytearray()
+    f.seek(0)
+    while True:
+        data = f.read(block)
+        if len(data) < block:
+            return bytes(out)  # a short tail block is always sent as a literal
+        out += SIGNATURE.pack(zlib.adler32(data), strong(data))
+
+
+def parse_signatures(payload) -> dict:
+    """{weak: {strong: block index}} for looking up a window's checksums."""
+    table = {}
+    for index, (weak, digest) in enumerate(SIGNATURE.iter_unpack(payload)):
+        table.setdefault(weak, {}).setdefault(digest, index)
+    return table
+
+
+def instructions(data, block: int, table: dict):
+    """Yield encoded COPY / LITERAL instructions that rebuild `data`.
+
+    data is any indexable buffer (bytes, mmap) holding the new file.
+    Consecutive block copies are merged into one COPY. The search stops
+    when the file turns out to be mostly new (see MAX_UNMATCHED); what is
+    left is then sent as literals.
+    """
+    n = len(data)
+    pos = literal_start = 0
+    weak = None
+    copy_start = copy_count = 0
+    literal = 0  # bytes already sent as literals
+    check_at = GIVE_UP_AFTER
+
+    def flush_literal(end):
+        for start in range(literal_start, end, MAX_LITERAL):
+            yield LITERAL + data[start:min(end, start + MAX_LITERAL)]
+
+    while table and pos + block <= n:
+        if pos >= check_at:
+            check_at = pos + block
+            if literal + pos - literal_start > MAX_UNMATCHED * pos:
+                break
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + block])
+        candidates = table.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong(data[pos:pos + block]))
+            if index is not None:
+                if literal_start < pos:
+                    if copy_count:
+                        yield COPY.pack(b"C", copy_start, copy_count)
+                        copy_count = 0
+                    yield from flush_literal(pos)
+                    literal += pos - literal_start
+                if copy_count and index == copy_start + copy_count:
+                    copy_count += 1
+                else:
+                    if copy_count:
+                        yield COPY.pack(b"C", copy_start, copy_count)
+                    copy_start, copy_count = index, 1
+                pos += block
+                literal_start = pos
+                weak = None
+                continue
+        if pos + block < n:
+            # Slide the window one byte: drop data[pos], take in data[pos + block].
+            out, new = data[pos], data[pos + block]
+            a = ((weak & 0xFFFF) - out + new) % MOD_ADLER
+            b = ((weak >> 16) - block * out + a - 1) % MOD_ADLER
+            weak = (b << 16) | a
+        pos += 1
+
+    if copy_count:
+        yield COPY.pack(b"C", copy_start, copy_count)
+    yield from flush_literal(n)
+
+
+def parse_instruction(payload):
+    """("copy", first block, count) or ("literal", bytes)."""
+    if payload[:1] == LITERAL:
+        return "literal", payload[1:]
+    if len(payload) == COPY.size and payload[:1] == b"C":
+        _, index, count = COPY.unpack(payload)
+        return "copy", index, count
+    raise ValueError("Bad delta instruction")
+
+
+def copy_blocks(src, dest, hasher, offset: int, length: int) -> int:
+    """Copy length bytes of src at offset to dest, feeding hasher. Returns bytes copied."""
+    src.seek(offset)
+    copied = 0
+    while copied < length:
+        data = src.read(min(READ_SIZE, length - copied))
+        if not data:
+            break
+        dest.write(data)
+        hasher.update(data)
+        copied += len(data)
+    return copied
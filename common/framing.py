@@ -0,0 +1,393 @@
+# framing.py
+# Length-prefixed binary framing shared by the client, the server engines and
+# the test tools. Every message is one frame:
+#
+#   magic "FS" | version u8 | opcode u8 | flags u16 | request id u32 | length u32
+#
+# followed by `length` payload bytes. Control frames carry a small JSON object
+# (FLAG_JSON); DATA frames carry raw file bytes. Because every frame states its
+# own length, messages can no longer be split or glued together by TCP the way
+# the recv(SIZE)-delimited text protocol allowed.
+#
+# Handshake: the server always opens with the text welcome. A framed client
+# answers with a HELLO frame listing the versions it speaks and the server
+# replies with HELLO naming the chosen one. A client that answers with
+# "LOGIN@user@pass" instead is served by the legacy text protocol.
+import asyncio
+import enum
+import json
+import socket
+import struct
+from typing import NamedTuple
+
+from common import buffers
+
+MAGIC = b"FS"
+VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+
+HEADER = struct.Struct("!2sBBHII")
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 32 * 1024 * 1024
+LARGE_KEEP_BYTES = 1048576  # recycled large payloads a frame reader holds on to (at least one)
+
+FLAG_JSON = 0x0001
+
+LENGTH_PREFIX = struct.Struct("!I")
+
+
+class Op(enum.IntEnum):
+    HELLO = 1
+    LOGIN = 2
+    LOGOUT = 3
+    HELP = 4
+    PING = 5
+    PONG = 6
+    DIR = 7
+    DELETE = 8
+    UPLOAD = 9
+    UPLOAD_EMPTY = 10
+    DOWNLOAD = 11
+    THROUGHPUT = 12
+    DATA = 13
+    END = 14
+    ACK = 15
+    OK = 16
+    ERR = 17
+    UPLOAD_TREE = 18
+    UPLOAD_STATUS = 19
+    UPLOAD_CHUNKS = 20
+    STATS = 21
+    VERIFY = 22
+
+
+class ProtocolError(Exception):
+    """The peer sent something that is not a valid frame."""
+
+
+class Frame(NamedTuple):
+    op: int
+    request_id: int
+    flags: int
+    payload: bytes
+
+    def json(self) -> dict:
+        if not self.payload:
+            return {}
+        try:
+            return json.loads(self.payload)
+        except ValueError as e:
+            raise ProtocolError(f"Bad JSON payload in {op_name(self.op)} frame: {e}")
+
+
+def op_name(op: int) -> str:
+    try:
+        return Op(op).name
+    except ValueError:
+        return f"OP_{op}"
+
+
+def is_framed(first_bytes: bytes) -> bool:
+    """True when the first bytes a client sent start a frame, not a text command."""
+    return first_bytes[:1] == MAGIC[:1]
+
+
+def pack_header(op: int, request_id: int, length: int, flags: int = 0) -> bytes:
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame payload too large ({length} bytes)")
+    return HEADER.pack(MAGIC, VERSION, op, flags, request_id, length)
+
+
+def pack_frame(op: int, request_id: int = 0, payload=b"", flags: int = 0) -> bytes:
+    return pack_header(op, request_id, len(payload), flags) + payload
+
+
+def pack_json(op: int, request_id: int = 0, obj: dict = None) -> bytes:
+    return pack_frame(op, request_id, json.dumps(obj or {}).encode("utf-8"), FLAG_JSON)
+
+
+def parse_header(header) -> tuple:
+    """Validate a header and return (op, flags, request_id, length)."""
+    magic, version, op, flags, request_id, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic {magic!r}")
+    if version not in SUPPORTED_VERSIONS:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame payload too large ({length} bytes)")
+    return op, flags, request_id, length
+
+
+# ----------------------------------------------------------------------------
+# Blocking sockets
+# ----------------------------------------------------------------------------
+
+def recv_into_exact(conn: socket.socket, view: memoryview):
+    """Fill the writable buffer `view` from the socket, without copying."""
+    n = len(view)
+    received = 0
+    while received < n:
+        # Most reads complete at once; only slice the view for the rest.
+        count = conn.recv_into(view[received:] if received else view)
+        if not count:
+            raise ConnectionError("Connection closed while reading data")
+        received += count
+
+
+def recv_exact(conn: socket.socket, n: int) -> bytearray:
+    """Receive exactly n bytes into one preallocated buffer (returned as is,
+    not copied into bytes)."""
+    data = bytearray(n)
+    recv_into_exact(conn, memoryview(data))
+    return data
+
+
+def _recv_length(conn: socket.socket) -> int:
+    prefix = bytearray(LENGTH_PREFIX.size)
+    recv_into_exact(conn, memoryview(prefix))
+    return LENGTH_PREFIX.unpack(prefix)[0]
+
+
+def recv_length_prefixed(conn: socket.socket) -> bytearray:
+    """Receive one legacy 4-byte length prefixed message (THROUGHPUT chunks)."""
+    length = _recv_length(conn)
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Message too large ({length} bytes)")
+    return recv_exact(conn, length)
+
+
+def recv_length_prefixed_into(conn: socket.socket, buf: bytearray) -> int:
+    """Receive one length prefixed message into buf (grown if too small); returns its length.
+
+    The prefix is read into buf too, so a message costs no allocation.
+    """
+    if len(buf) < LENGTH_PREFIX.size:
+        buf.extend(bytes(LENGTH_PREFIX.size - len(buf)))
+    _recv_into_start(conn, buf, LENGTH_PREFIX.size)
+    length = LENGTH_PREFIX.unpack_from(buf)[0]
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Message too large ({length} bytes)")
+    if length > len(buf):
+        buf.extend(bytes(length - len(buf)))
+    if length:
+        _recv_into_start(conn, buf, length)
+    return length
+
+
+def _recv_into_start(conn: socket.socket, buf: bytearray, n: int):
+    """Fill buf[:n]. Small messages usually arrive whole, so try one plain
+    recv_into first and only build a memoryview for the rest."""
+    received = conn.recv_into(buf, n)
+    if received < n:
+        if not received:
+            raise ConnectionError("Connection closed while reading data")
+        with memoryview(buf) as view:
+            recv_into_exact(conn, view[received:n])
+
+
+def pack_length_prefixed(payload: bytes) -> bytes:
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+
+def recv_frame(conn: socket.socket) -> Frame:
+    """One frame, read with exactly-sized recv calls (nothing read ahead, so
+    the socket can be handed to a FrameReader or another owner afterwards)."""
+    op, flags, request_id, length = parse_header(recv_exact(conn, HEADER_SIZE))
+    payload = recv_exact(conn, length) if length else b""
+    return Frame(op, request_id, flags, payload)
+
+
+def send_frame(conn: socket.socket, op: int, request_id: int = 0, payload=b"", flags: int = 0):
+    if len(payload) < 65536:
+        conn.sendall(pack_frame(op, request_id, payload, flags))
+    else:
+        # Don't copy large DATA payloads just to prepend 14 bytes.
+        conn.sendall(pack_header(op, request_id, len(payload), flags))
+        conn.sendall(payload)
+
+
+def send_json(conn: socket.socket, op: int, request_id: int = 0, obj: dict = None):
+    conn.sendall(pack_json(op, request_id, obj))
+
+
+# ----------------------------------------------------------------------------
+# asyncio (non-blocking sockets driven by loop.sock_* calls)
+# ----------------------------------------------------------------------------
+
+async def async_recv_into_exact(loop, conn: socket.socket, view: memoryview):
+    n = len(view)
+    received = 0
+    while received < n:
+        count = await loop.sock_recv_into(conn, view[received:] if received else view)
+        if not count:
+            raise ConnectionError("Connection closed while reading data")
+        received += count
+
+
+async def async_recv_exact(loop, conn: socket.socket, n: int) -> bytearray:
+    data = bytearray(n)
+    await async_recv_into_exact(loop, conn, memoryview(data))
+    return data
+
+
+async def async_recv_length_prefixed(loop, conn: socket.socket) -> bytearray:
+    length = LENGTH_PREFIX.unpack(await async_recv_exact(loop, conn, LENGTH_PREFIX.size))[0]
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Message too large ({length} bytes)")
+    return await async_recv_exact(loop, conn, length)
+
+
+async def async_recv_length_prefixed_into(loop, conn: socket.socket, buf: bytearray) -> int:
+    if len(buf) < LENGTH_PREFIX.size:
+        buf.extend(bytes(LENGTH_PREFIX.size - len(buf)))
+    with memoryview(buf) as view:
+        await async_recv_into_exact(loop, conn, view[:LENGTH_PREFIX.size])
+        length = LENGTH_PREFIX.unpack_from(view)[0]
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Message too large ({length} bytes)")
+    if length > len(buf):
+        buf.extend(bytes(length - len(buf)))
+    with memoryview(buf) as view:
+        await async_recv_into_exact(loop, conn, view[:length])
+    return length
+
+
+class _ReadBuffer:
+    """Fixed receive buffer shared by the frame readers.
+
+    The socket is read with recv_into() straight into one preallocated
+    bytearray, as much as is waiting, and frames are cut out of it: no
+    bytes object per recv, no += joining. Unread bytes are moved to the
+    front only when a frame would run past the end. A payload of bufsize
+    bytes or more is received into a bytearray of its own instead, taken
+    from a small pool of buffers of that size: a consumer that is done with
+    such a payload hands it back with recycle() and the next frame of the
+    same size is received into it. (One that doesn't leaves it to the GC.)
+    """
+
+    def __init__(self, initial: bytes, bufsize: int):
+        self.bufsize = max(bufsize, len(initial))
+        self._buf = bytearray(self.bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = len(initial)
+        self._view[:self._end] = initial
+        self._large = None  # BufferPool for large payloads of the last size seen
+
+    def _room(self, n: int) -> memoryview:
+        """Where the next recv_into() goes, once n bytes from _start will fit."""
+        if self._start + n > self.bufsize:
+            available = self._end - self._start
+            self._view[:available] = self._view[self._start:self._end]
+            self._start, self._end = 0, available
+        return self._view[self._end:]
+
+    def _take(self, n: int) -> memoryview:
+        view = self._view[self._start:self._start + n]
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0
+        return view
+
+    def _take_large(self, n: int) -> tuple:
+        """A bytearray(n) holding what is buffered, and how much that was."""
+        pool = self._large
+        if pool is None or pool.size != n:
+            # Frames of one transfer share a size; a new size starts a new pool.
+            pool = self._large = buffers.BufferPool(n, keep=max(1, LARGE_KEEP_BYTES // n))
+        data = pool.acquire()
+        received = self._end - self._start
+        data[:received] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        return data, received
+
+    def recycle(self, payload):
+        """Hand back a payload this reader returned, once nothing refers to it
+        any more, so a later frame is received into it."""
+        pool = self._large
+        if pool is not None and type(payload) is bytearray and len(payload) == pool.size:
+            pool.release(payload)
+
+
+class FrameReader(_ReadBuffer):
+    """Buffered frame reader for a blocking socket (see _ReadBuffer).
+
+    Payloads under bufsize are returned as bytes copied out of the buffer;
+    larger ones as the bytearray they were received into.
+    """
+
+    def __init__(self, conn: socket.socket, initial: bytes = b"", bufsize: int = 262144):
+        super().__init__(initial, bufsize)
+        self.conn = conn
+
+    def _fill(self, n: int):
+        while self._end - self._start < n:
+            count = self.conn.recv_into(self._room(n))
+            if not count:
+                raise ConnectionError("Connection closed while reading data")
+            self._end += count
+
+    def read_exact(self, n: int):
+        if n >= self.bufsize:
+            data, received = self._take_large(n)
+            recv_into_exact(self.conn, memoryview(data)[received:])
+            return data
+        self._fill(n)
+        return bytes(self._take(n))
+
+    def read_frame(self) -> Frame:
+        self._fill(HEADER_SIZE)
+        op, flags, request_id, length = parse_header(self._take(HEADER_SIZE))
+        payload = self.read_exact(length) if length else b""
+        return Frame(op, request_id, flags, payload)
+
+
+class AsyncFrameReader(_ReadBuffer):
+    """Buffered frame reader for a non-blocking socket (see _ReadBuffer).
+
+    `initial` holds bytes already taken off the socket while deciding which
+    protocol the client speaks.
+    """
+
+    def __init__(self, loop, conn: socket.socket, initial: bytes = b"", bufsize: int = 262144):
+        super().__init__(initial, bufsize)
+        self.loop = loop
+        self.conn = conn
+        self._unyielded = 0
+
+    async def _received(self, count: int):
+        if not count:
+            raise ConnectionError("Connection closed while reading data")
+        # sock_recv* return without suspending while data is waiting, so a
+        # client that sends fast enough would keep the loop from running
+        # anything else (such as our sends on the same connection). Let it
+        # run once per bufsize read.
+        self._unyielded += count
+        if self._unyielded >= self.bufsize:
+            self._unyielded = 0
+            await asyncio.sleep(0)
+
+    async def _fill(self, n: int):
+        while self._end - self._start < n:
+            count = await self.loop.sock_recv_into(self.conn, self._room(n))
+            await self._received(count)
+            self._end += count
+
+    async def read_exact(self, n: int):
+        if n >= self.bufsize:
+            # Callers get a bytearray, which works wherever bytes do here.
+            data, received = self._take_large(n)
+            view = memoryview(data)
+            while received < n:
+                count = await self.loop.sock_recv_into(self.conn, view[received:])
+                await self._received(count)
+                received += count
+            return data
+        await self._fill(n)
+        return bytes(self._take(n))
+
+    async def read_frame(self) -> Frame:
+        await self._fill(HEADER_SIZE)
+        op, flags, request_id, length = parse_header(self._take(HEADER_SIZE))
+        payload = await self.read_exact(length) if length else b""
+        return Frame(op, request_id, flags, payload)
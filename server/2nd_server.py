@@ -1,76 +1,92 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import atexit
 import os
 import socket
-import threading
-import struct
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Make the shared `common` package importable when run as server/2nd_server.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import admission
+import config
+import durable
+import framed_session
+import metrics
+import ratelimit
+import sessions
+import storage
+import tracing
+import transfer
 from auth import authenticate
+from common import buffers, checksums, framing
+from common.framing import recv_length_prefixed_into
 
-IP = "0.0.0.0"
-PORT = 4450
-ADDR = (IP, PORT)
-SIZE = 1024
-CHUNK_SIZE = 65536  # 64KB chunks 
-SOCKET_BUFFER_SIZE = 65536  
-FORMAT = "utf-8"
-SERVER_PATH = "server\server_data"          
+SIZE = config.SIZE
+FORMAT = config.FORMAT
 
 
-
-
-def recv_length_prefixed(conn: socket.socket) -> bytes:
-    # Receive 4-byte length header
-    length_data = b""
-    while len(length_data) < 4:
-        chunk = conn.recv(4 - len(length_data))
-        if not chunk:
-            raise ConnectionError("Connection closed while reading length")
-        length_data += chunk
-    
-    length = struct.unpack("!I", length_data)[0]
-    
-    # Receive the actual data
-    data = b""
-    while len(data) < length:
-        chunk = conn.recv(min(CHUNK_SIZE, length - len(data)))
-        if not chunk:
-            raise ConnectionError("Connection closed while reading data")
-        data += chunk
-    
-    return data
-
-def handle_client(conn: socket.socket, addr):
+def handle_client(conn: socket.socket, addr, ticket=None, trace=tracing.NULL):
     print(f"[NEW CONNECTION] {addr} connected.")
+    connected = time.perf_counter()
     
     conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  
-    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
-    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.SOCKET_BUFFER_SIZE)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.SOCKET_BUFFER_SIZE)
     
     conn.send("OK@Welcome to the server. Please log in".encode(FORMAT))
 
-    # Login
+    # Login, or a HELLO frame from a client speaking the framed protocol.
+    # RESUME@<token> logs in with the token of an earlier session; if it has
+    # expired the client may still send LOGIN. LOGIN@user@pass@TOKEN asks
+    # for a token, which comes back as the last field of the reply.
+    token = None
     try:
-        auth_data = conn.recv(SIZE).decode(FORMAT)
-        parts = auth_data.split("@")
-        if len(parts) != 3 or parts[0] != "LOGIN":
-            conn.send("ERR@Bad login format".encode(FORMAT))
-            conn.close()
+        first = conn.recv(SIZE)
+        if framing.is_framed(first):
+            framed_session.serve_blocking(conn, addr, first, ticket, trace)
             return
 
-        _, username, password = parts
-        if authenticate(username, password):
-            conn.send(
-                "OK@AUTH_SUCCESS@You can now enter commands. Type HELP to see options."
-                .encode(FORMAT)
-            )
-            print(f"[AUTH_SUCCESS] {username} from {addr}")
-        else:
-            conn.send("ERR@AUTH_FAILED".encode(FORMAT))
-            print(f"[AUTH_FAIL] {addr} failed authentication.")
+        auth_data = first.decode(FORMAT)
+        parts = auth_data.split("@")
+        username = None
+        resumed = len(parts) == 2 and parts[0] == "RESUME"
+        if resumed:
+            username = sessions.resume(parts[1])
+            if username is None:
+                resumed = False
+                conn.send("ERR@SESSION_EXPIRED".encode(FORMAT))
+                parts = conn.recv(SIZE).decode(FORMAT).split("@")
+
+        if username is None:
+            if parts[0] != "LOGIN" or len(parts) not in (3, 4) or parts[3:] not in ([], ["TOKEN"]):
+                conn.send("ERR@Bad login format".encode(FORMAT))
+                conn.close()
+                return
+            if not authenticate(parts[1], parts[2]):
+                conn.send("ERR@AUTH_FAILED".encode(FORMAT))
+                print(f"[AUTH_FAIL] {addr} failed authentication.")
+                conn.close()
+                return
+            username = parts[1]
+
+        if not admission.manager().login(ticket, username):
+            conn.send(admission.busy_message().encode(FORMAT))
+            print(f"[BUSY] {username} from {addr}: too many connections for this user")
             conn.close()
             return
+        msg = "OK@AUTH_SUCCESS@" + ("Session resumed." if resumed else
+                                    "You can now enter commands. Type HELP to see options.")
+        if resumed or len(parts) == 4:
+            token = sessions.issue(username)
+            msg += f"@{token}"
+        conn.send(msg.encode(FORMAT))
+        trace.span("handshake", connected, user=username, resumed=resumed)
+        print(f"[AUTH_SUCCESS] {username} from {addr}{' (resumed)' if resumed else ''}")
     except Exception as e:
         print(f"[LOGIN ERROR] {addr}: {e}")
         conn.close()
@@ -78,6 +94,8 @@ def handle_client(conn: socket.socket, addr):
 
     # Main command loop
     while True:
+        name = None
+        ok = True
         try:
             data = conn.recv(SIZE).decode(FORMAT).strip()
             if not data:
@@ -85,10 +103,13 @@ def handle_client(conn: socket.socket, addr):
 
             parts = data.split("@")
             cmd = parts[0].upper()
+            name = metrics.command_name(cmd)
+            started = metrics.command_started(name)
 
-            # PING command - for latency testing
+            # PING command - for latency testing; echoes PING@<seq>@<timestamp>
+            # as PONG@<seq>@<timestamp> so the client can match replies
             if cmd == "PING":
-                conn.send("PONG".encode(FORMAT))
+                conn.send("@".join(["PONG", *parts[1:]]).encode(FORMAT))
                 
             # THROUGHPUT command - for throughput testing
             elif cmd == "THROUGHPUT":
@@ -108,6 +129,9 @@ def handle_client(conn: socket.socket, addr):
                     
                     received_total = 0
                     start_time = time.time()
+                    throttle = ratelimit.throttle(username, ratelimit.THROUGHPUT, ratelimit.RECV)
+                    xfer = trace.transfer("throughput", f"{size_kb}KB x {iterations}", total_bytes)
+                    buf = bytearray(1024)  # reused for every chunk
                     
                     for batch in range(1, iterations + 1):
                         batch_received = 0
@@ -115,17 +139,23 @@ def handle_client(conn: socket.socket, addr):
                         # Receive size_kb chunks (each 1KB)
                         for chunk_num in range(size_kb):
                             try:
-                                chunk_data = recv_length_prefixed(conn)
-                                batch_received += len(chunk_data)
-                                received_total += len(chunk_data)
+                                n = recv_length_prefixed_into(conn, buf)
+                                batch_received += n
+                                received_total += n
                             except Exception as e:
                                 print(f"[THROUGHPUT ERROR] Batch {batch}, chunk {chunk_num}: {e}")
                                 raise
                         
-                        # Send ACK for this batch
+                        # Send ACK for this batch (late, if the test is shaped)
+                        xfer.mark("net", batch_received)
+                        ratelimit.pace(throttle, batch_received)
+                        xfer.mark("wait")
                         conn.send(f"ACK_BATCH_{batch}".encode(FORMAT))
+                        xfer.mark("net")
                     
                     duration = time.time() - start_time
+                    xfer.finish()
+                    metrics.add_bytes("in", received_total)
                     mbps = (received_total / 1_048_576) / duration if duration > 0 else 0
                     
                     print(f"[THROUGHPUT] Complete: {received_total:,} bytes ({received_total/1_048_576:.2f}MB) "
@@ -138,6 +168,7 @@ def handle_client(conn: socket.socket, addr):
                     conn.send(f"ERR@Throughput test failed: {e}".encode(FORMAT))
 
             elif cmd == "LOGOUT":
+                sessions.revoke(token)
                 conn.send("OK@Disconnected from the server.".encode(FORMAT))
                 break
 
@@ -145,27 +176,33 @@ def handle_client(conn: socket.socket, addr):
                 msg = (
                     "OK@Available commands:\n"
                     "UPLOAD <filename>\nDOWNLOAD <filename>\n"
-                    "DELETE <filename>\nDIR\nLOGOUT"
+                    "DELETE <filename>\nDIR\nVERIFY <filename>\nSTATS\nLOGOUT"
                 )
                 conn.send(msg.encode(FORMAT))
 
             elif cmd == "DIR":
-                files = os.listdir(SERVER_PATH)
-                if not files:
-                    conn.send("OK@No files found.".encode(FORMAT))
-                else:
-                    file_list = []
-                    for file in files:
-                        filepath = os.path.join(SERVER_PATH, file)
-                        if os.path.isdir(filepath):
-                            file_list.append(f"{file}/ — [DIR]")
-                        else:
-                            name, extension = os.path.splitext(file)
-                            if extension == "":
-                                extension = "(unknown type)"
-                            file_list.append(f"{name} — {extension}")
-                    formatted_list = "\n".join(file_list)
-                    conn.send(f"Files on server:\n{formatted_list}".encode(FORMAT))
+                conn.send(storage.list_dir().encode(FORMAT))
+
+            elif cmd == "STATS":
+                conn.send(f"OK@{storage.stats_text()}".encode(FORMAT))
+
+            elif cmd == "VERIFY":
+                # VERIFY@name[@digest] -> OK@<algorithm>@<digest>[@MATCH|@MISMATCH]
+                if len(parts) < 2:
+                    conn.send("ERR@Missing filename".encode(FORMAT))
+                    continue
+                try:
+                    digest, _ = storage.verify(storage.resolve(parts[1]))
+                except ValueError as e:
+                    conn.send(f"ERR@{e}".encode(FORMAT))
+                    continue
+                except (FileNotFoundError, IsADirectoryError):
+                    conn.send("ERR@File not found.".encode(FORMAT))
+                    continue
+                msg = f"OK@{checksums.ALGORITHM}@{digest}"
+                if len(parts) >= 3:
+                    msg += "@MATCH" if parts[2] == digest else "@MISMATCH"
+                conn.send(msg.encode(FORMAT))
 
             elif cmd == "UPLOAD":
                 if len(parts) < 2:
@@ -176,10 +213,11 @@ def handle_client(conn: socket.socket, addr):
                 sub = parts[2] if len(parts) >= 3 else None
 
                 # Build correct destination path
-                subpath = os.path.join(SERVER_PATH, sub) if sub else SERVER_PATH
-                os.makedirs(subpath, exist_ok=True)
-
-                filepath = os.path.join(subpath, filename)
+                try:
+                    filepath = storage.upload_path(filename, sub)
+                except ValueError as e:
+                    conn.send(f"ERR@{e}".encode(FORMAT))
+                    continue
 
                 # Tell client we're ready
                 conn.send("READY".encode(FORMAT))
@@ -194,23 +232,45 @@ def handle_client(conn: socket.socket, addr):
 
                 conn.send("OK".encode(FORMAT))
 
-                # Receive file data
+                # Receive file data into a .part file; only a complete upload
+                # is renamed into place, a dropped one is kept for resuming.
+                partial = storage.PartialUpload(filepath, filesize)
+                hasher = checksums.new()
+                throttle = ratelimit.throttle(username, ratelimit.TRANSFER, ratelimit.RECV)
+                xfer = trace.transfer("upload", filename, filesize)
                 received = 0
-                with open(filepath, "wb") as f:
+                with partial.open() as f, buffers.lease(config.CHUNK_SIZE) as buf:
                     while received < filesize:
-                        chunk = conn.recv(min(CHUNK_SIZE, filesize - received))
-                        if not chunk:
+                        n = conn.recv_into(buf, min(config.CHUNK_SIZE, filesize - received))
+                        xfer.mark("net", n)
+                        if not n:
                             break
-                        f.write(chunk)
-                        received += len(chunk)
-
+                        f.write(buf[:n])
+                        xfer.mark("disk")
+                        hasher.update(buf[:n])
+                        xfer.mark("cpu")
+                        received += n
+                        ratelimit.pace(throttle, n)
+                        xfer.mark("wait")
+
+                metrics.add_bytes("in", received)
+                if received < filesize:
+                    print(f"[UPLOAD INCOMPLETE] {addr} sent {received} of {filesize} bytes of '{filename}'")
+                    break
+                partial.commit()
+                storage.record_digest(filepath, hasher.hexdigest())
+                xfer.mark("disk")
+                xfer.finish()
                 conn.send(f"OK@File '{filename}' uploaded successfully.".encode(FORMAT))
                 print(f"[UPLOAD] {addr} uploaded '{filename}' ({received} bytes) to '{sub or '.'}'")
 
             elif cmd == "UPLOAD_EMPTY":
                 folder_name = parts[1]
-                folder_path = os.path.join(SERVER_PATH, folder_name)
-                os.makedirs(folder_path, exist_ok=True)
+                try:
+                    storage.make_dir(folder_name)
+                except ValueError as e:
+                    conn.send(f"ERR@{e}".encode(FORMAT))
+                    continue
                 conn.send(f"OK@Empty folder '{folder_name}' created successfully.".encode(FORMAT))
                 print(f"[UPLOAD_EMPTY] {addr} created empty folder '{folder_name}'")
 
@@ -219,58 +279,49 @@ def handle_client(conn: socket.socket, addr):
                     conn.send("ERR@Missing filename".encode(FORMAT))
                     continue
                 filename = parts[1]
-                filepath = os.path.join(SERVER_PATH, filename)
-
-                if not os.path.exists(filepath):
+                try:
+                    f = storage.open_file(storage.resolve(filename))
+                except ValueError as e:
+                    conn.send(f"ERR@{e}".encode(FORMAT))
+                    continue
+                except (FileNotFoundError, IsADirectoryError):
                     conn.send("ERR@File not found.".encode(FORMAT))
                     continue
 
-                filesize = os.path.getsize(filepath)
-                conn.send(f"OK@{filesize}".encode(FORMAT))
-                
-                ack = conn.recv(SIZE).decode(FORMAT).strip()
-                if ack != "READY":
-                    print(f"[ERROR] Client not ready for download")
-                    continue
+                with f:
+                    filesize = storage.file_size(f)
+                    conn.send(f"OK@{filesize}".encode(FORMAT))
 
-                print(f"[SEND] Sending '{filename}' ({filesize} bytes) to {addr}")
-                
-                sent = 0
-                with open(filepath, "rb") as f:
-                    while sent < filesize:
-                        remaining = filesize - sent
-                        chunk_size = min(CHUNK_SIZE, remaining)
-                        chunk = f.read(chunk_size)
-                        
-                        if not chunk:
-                            break
-                        
-                        conn.sendall(chunk)
-                        sent += len(chunk)
+                    ack = conn.recv(SIZE).decode(FORMAT).strip()
+                    if ack != "READY":
+                        print(f"[ERROR] Client not ready for download")
+                        continue
 
-                print(f"[SENT] '{filename}' sent successfully to {addr} ({sent} bytes)")
+                    print(f"[SEND] Sending '{filename}' ({filesize} bytes) to {addr}")
+
+                    start_time = time.perf_counter()
+                    xfer = trace.transfer("download", filename, filesize)
+                    sent, mode = transfer.send_file(conn, f, 0, filesize, ratelimit.throttle(
+                        username, ratelimit.TRANSFER, ratelimit.SEND))
+                    xfer.mark("net", sent)  # sendfile: disk and network in one call
+                    xfer.finish(mode=mode)
+                stats = transfer.record_transfer("download", filename, addr, sent,
+                                                 time.perf_counter() - start_time, mode)
+
+                print(f"[SENT] '{filename}' sent successfully to {addr} ({sent} bytes, "
+                      f"{mode}, {stats['mbps']:.2f} MB/s)")
                 
             elif cmd == "DELETE":
                 if len(parts) < 2:
                     conn.send("ERR@Missing filename or folder name".encode(FORMAT))
                     continue
 
-                path_to_delete = os.path.join(SERVER_PATH, parts[1])
-
-                if not os.path.exists(path_to_delete):
-                    conn.send("ERR@Path not found.".encode(FORMAT))
-                    continue
-
                 try:
-                    if os.path.isfile(path_to_delete):
-                        os.remove(path_to_delete)
-                        conn.send(f"OK@File '{parts[1]}' deleted successfully.".encode(FORMAT))
-                        print(f"[DELETE] File '{parts[1]}' removed by {addr}")
-                    elif os.path.isdir(path_to_delete):
-                        import shutil
-                        shutil.rmtree(path_to_delete)
-                        conn.send(f"OK@Folder '{parts[1]}' deleted successfully.".encode(FORMAT))
-                        print(f"[DELETE] Folder '{parts[1]}' removed by {addr}")
+                    kind = storage.delete(parts[1])
+                    conn.send(f"OK@{kind} '{parts[1]}' deleted successfully.".encode(FORMAT))
+                    print(f"[DELETE] {kind} '{parts[1]}' removed by {addr}")
+                except FileNotFoundError:
+                    conn.send("ERR@Path not found.".encode(FORMAT))
                 except Exception as e:
                     conn.send(f"ERR@Failed to delete '{parts[1]}': {e}".encode(FORMAT))
                     print(f"[ERROR][DELETE] {addr}: Failed to delete '{parts[1]}': {e}")
@@ -279,27 +330,165 @@ def handle_client(conn: socket.socket, addr):
                 conn.send("ERR@Unknown command".encode(FORMAT))
 
         except Exception as e:
+            ok = False
             print(f"[ERROR] {addr}: {e}")
             break
+        finally:
+            if name is not None:
+                metrics.command_finished(name, started, ok)
+                trace.span(name, started, ok=ok)
 
     print(f"[DISCONNECTED] {addr} disconnected.")
     conn.close()
 
 
-def main():
-    print("Starting the server...")
+def serve_threaded():
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(ADDR)
-    server.listen()
-    print(f"Server is listening on {IP}:{PORT}")
-
+    server.bind((config.IP, config.PORT))
+    server.listen(config.LISTEN_BACKLOG)
+    print(f"Server is listening on {config.IP}:{config.PORT}")
+
+    # Each client is served by one of WORKER_THREADS threads; admitted
+    # clients beyond that wait for a free worker (the "queued" gauge).
+    manager = admission.manager()
+    workers = ThreadPoolExecutor(max_workers=config.WORKER_THREADS, thread_name_prefix="client")
     while True:
         conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr))
-        thread.start()
-        print(f"[ACTIVE CONNECTIONS] {threading.active_count() - 1}")
+        ticket = manager.admit(addr)
+        if ticket is None:
+            admission.turn_away(conn)
+            continue
+        workers.submit(serve_client, conn, addr, ticket)
+        gauges = manager.stats()
+        print(f"[ACTIVE CONNECTIONS] {gauges['active']} (+{gauges['queued']} queued)")
+
+
+def serve_client(conn: socket.socket, addr, ticket):
+    admission.manager().start(ticket)
+    trace = tracing.connection(addr)  # here, so a profiler runs on this thread
+    try:
+        handle_client(conn, addr, ticket, trace)
+    except Exception as e:
+        print(f"[ERROR] {addr}: {e}")
+        conn.close()
+    finally:
+        trace.close()
+        admission.manager().release(ticket)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CNT3004 file sharing server")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default=config.ENGINE,
+                        help="threaded: one OS thread per client; asyncio: one event loop for all clients")
+    parser.add_argument("--host", default=config.IP)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--root", default=config.SERVER_PATH, help="storage directory")
+    parser.add_argument("--backlog", type=int, default=config.LISTEN_BACKLOG)
+    parser.add_argument("--max-connections", type=int, default=config.MAX_CONNECTIONS,
+                        help="clients served or waiting at once; more are told ERR@BUSY")
+    parser.add_argument("--workers", type=int, default=config.WORKER_THREADS,
+                        help="threaded engine: client threads (further clients wait for one)")
+    parser.add_argument("--max-per-ip", type=int, default=config.MAX_CONNECTIONS_PER_IP,
+                        help="connections per client IP (0: no limit)")
+    parser.add_argument("--max-per-user", type=int, default=config.MAX_CONNECTIONS_PER_USER,
+                        help="connections per logged-in user (0: no limit)")
+    parser.add_argument("--no-zero-copy", action="store_true",
+                        help="serve DOWNLOAD with the chunked read/send loop instead of sendfile")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="never compress UPLOAD/DOWNLOAD data on the wire")
+    parser.add_argument("--cache-size", type=int, default=config.CACHE_SIZE // 1048576, metavar="MB",
+                        help="memory for caching hot files served by DOWNLOAD (0 disables it)")
+    parser.add_argument("--storage", choices=("plain", "chunked"), default=config.STORAGE_BACKEND,
+                        help="chunked: deduplicate uploads in a content-addressed chunk store")
+    parser.add_argument("--fsync", choices=durable.POLICIES, default=config.FSYNC_POLICY,
+                        help="durability of finished uploads: none, fsync the file, "
+                             "or fsync the file and its directory")
+    parser.add_argument("--users", default=config.USERS_FILE, help="user store (username -> password hash)")
+    parser.add_argument("--auth-workers", type=int, default=config.AUTH_WORKERS,
+                        help="password hashes computed at once")
+    parser.add_argument("--io-workers", type=int, default=config.IO_WORKERS,
+                        help="threads for blocking disk and CPU work, shared by all connections")
+    parser.add_argument("--session-ttl", type=int, default=config.SESSION_TTL, metavar="SECONDS",
+                        help="how long a session token stays valid after its last use")
+    parser.add_argument("--rate-limit", type=float, default=config.RATE_LIMIT / 1048576, metavar="MB/s",
+                        help="bandwidth of all transfers together, each direction (0: unlimited)")
+    parser.add_argument("--user-rate-limit", type=float, default=config.RATE_LIMIT_PER_USER / 1048576,
+                        metavar="MB/s", help="bandwidth of each user's transfers, each direction (0: unlimited)")
+    parser.add_argument("--class-rate-limit", action="append", default=[], metavar="CLASS=MB/s",
+                        help="bandwidth of one command class (transfer, throughput) across all clients; "
+                             "may be repeated")
+    parser.add_argument("--metrics-port", type=int, default=config.METRICS_PORT,
+                        help="serve Prometheus metrics on this local port (0: off)")
+    parser.add_argument("--metrics-host", default=config.METRICS_HOST,
+                        help="address the metrics endpoint listens on")
+    parser.add_argument("--trace", metavar="FILE", default=config.TRACE_FILE,
+                        help="write Chrome trace events (commands, transfer spans) to FILE")
+    parser.add_argument("--trace-sample", type=float, default=config.TRACE_SAMPLE, metavar="FRACTION",
+                        help="fraction of connections traced with --trace")
+    parser.add_argument("--profile-sample", type=float, default=config.PROFILE_SAMPLE, metavar="FRACTION",
+                        help="fraction of connections run under cProfile")
+    parser.add_argument("--profile-dir", default=config.PROFILE_DIR, help="where cProfile output goes")
+    args = parser.parse_args(argv)
+    for limit in args.class_rate_limit:
+        cls, _, rate = limit.partition("=")
+        if cls not in ratelimit.CLASSES:
+            parser.error(f"--class-rate-limit: unknown class '{cls}' (choose from {', '.join(ratelimit.CLASSES)})")
+        try:
+            float(rate)
+        except ValueError:
+            parser.error(f"--class-rate-limit: bad rate in '{limit}'")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config.ENGINE = args.engine
+    config.IP = args.host
+    config.PORT = args.port
+    config.SERVER_PATH = args.root
+    config.LISTEN_BACKLOG = args.backlog
+    config.ZERO_COPY = not args.no_zero_copy
+    config.STORAGE_BACKEND = args.storage
+    config.CACHE_SIZE = args.cache_size * 1048576
+    config.COMPRESSION = not args.no_compression
+    config.FSYNC_POLICY = args.fsync
+    config.USERS_FILE = args.users
+    config.AUTH_WORKERS = max(1, args.auth_workers)
+    config.IO_WORKERS = max(1, args.io_workers)
+    config.SESSION_TTL = args.session_ttl
+    config.MAX_CONNECTIONS = args.max_connections
+    config.WORKER_THREADS = max(1, args.workers)
+    config.MAX_CONNECTIONS_PER_IP = args.max_per_ip
+    config.MAX_CONNECTIONS_PER_USER = args.max_per_user
+    config.RATE_LIMIT = int(args.rate_limit * 1048576)
+    config.RATE_LIMIT_PER_USER = int(args.user_rate_limit * 1048576)
+    config.RATE_LIMIT_CLASSES = dict(config.RATE_LIMIT_CLASSES)
+    for limit in args.class_rate_limit:
+        cls, _, rate = limit.partition("=")
+        config.RATE_LIMIT_CLASSES[cls] = int(float(rate) * 1048576)
+    config.METRICS_HOST = args.metrics_host
+    config.METRICS_PORT = args.metrics_port
+    config.TRACE_FILE = args.trace
+    config.TRACE_SAMPLE = args.trace_sample
+    config.PROFILE_SAMPLE = args.profile_sample
+    config.PROFILE_DIR = args.profile_dir
+    storage.ensure_root()
+    removed = storage.load_chunk_store()
+    if removed:
+        print(f"[STORAGE] Removed {removed} unreferenced chunks")
+    if config.METRICS_PORT:
+        metrics.serve_prometheus(config.METRICS_HOST, config.METRICS_PORT, storage.metric_families)
+    tracing.start()
+    atexit.register(tracing.stop)
+
+    print(f"Starting the server ({config.ENGINE} engine)...")
+    if config.ENGINE == "asyncio":
+        import async_server
+        async_server.run()
+    else:
+        serve_threaded()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
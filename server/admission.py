@@ -0,0 +1,136 @@
+# admission.py
+# Connection admission control shared by both engines.
+#
+# Every accepted socket asks the manager for a ticket before any work is
+# done for it. The manager enforces a global limit (MAX_CONNECTIONS, which
+# counts connections still queued for a worker thread) and a per-IP limit;
+# the per-user limit is checked once the client has logged in. A client
+# over any limit gets a one-line "ERR@BUSY@<seconds>" telling it when to
+# retry, and the connection is closed straight away, so a burst of clients
+# costs the server a few bytes each instead of a thread and a file
+# descriptor for as long as they stay.
+import collections
+import threading
+
+import config
+
+QUEUED, ACTIVE = "queued", "active"
+
+
+class Ticket:
+    """One admitted connection."""
+    __slots__ = ("ip", "username", "state")
+
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.username = None
+        self.state = QUEUED
+
+
+class ConnectionManager:
+    def __init__(self, max_connections: int, per_ip: int, per_user: int):
+        self.max_connections = max_connections
+        self.per_ip = per_ip        # 0 = unlimited
+        self.per_user = per_user    # 0 = unlimited
+        self._lock = threading.Lock()
+        self._by_ip = collections.Counter()
+        self._by_user = collections.Counter()
+        self.active = 0
+        self.queued = 0
+        self.peak = 0
+        self.accepted = 0
+        self.rejected = collections.Counter()  # reason -> count
+
+    def admit(self, addr):
+        """A Ticket for a new connection from addr, or None if it must be turned away."""
+        ip = addr[0]
+        with self._lock:
+            if self.active + self.queued >= self.max_connections:
+                self.rejected["capacity"] += 1
+                return None
+            if self.per_ip and self._by_ip[ip] >= self.per_ip:
+                self.rejected["per_ip"] += 1
+                return None
+            self._by_ip[ip] += 1
+            self.queued += 1
+            self.accepted += 1
+            self.peak = max(self.peak, self.active + self.queued)
+            return Ticket(ip)
+
+    def start(self, ticket: Ticket):
+        """The connection got a worker (or task) and is being served."""
+        with self._lock:
+            if ticket.state == QUEUED:
+                ticket.state = ACTIVE
+                self.queued -= 1
+                self.active += 1
+
+    def login(self, ticket: Ticket, username: str) -> bool:
+        """Attach the logged-in user; False if they already have too many connections."""
+        if ticket is None:
+            return True
+        with self._lock:
+            if self.per_user and self._by_user[username] >= self.per_user:
+                self.rejected["per_user"] += 1
+                return False
+            ticket.username = username
+            self._by_user[username] += 1
+            return True
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            if ticket.state is None:
+                return  # already released
+            if ticket.state == QUEUED:
+                self.queued -= 1
+            else:
+                self.active -= 1
+            ticket.state = None
+            self._by_ip[ticket.ip] -= 1
+            if not self._by_ip[ticket.ip]:
+                del self._by_ip[ticket.ip]
+            if ticket.username is not None:
+                self._by_user[ticket.username] -= 1
+                if not self._by_user[ticket.username]:
+                    del self._by_user[ticket.username]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "peak": self.peak,
+                "accepted": self.accepted,
+                "rejected": sum(self.rejected.values()),
+                "rejected_capacity": self.rejected["capacity"],
+                "rejected_per_ip": self.rejected["per_ip"],
+                "rejected_per_user": self.rejected["per_user"],
+                "max_connections": self.max_connections,
+            }
+
+
+def busy_message() -> str:
+    return f"ERR@BUSY@{config.BUSY_RETRY_AFTER}"
+
+
+def turn_away(conn):
+    """Tell a client it was not admitted and close, without ever blocking."""
+    try:
+        conn.setblocking(False)
+        conn.send(busy_message().encode(config.FORMAT))
+    except OSError:
+        pass
+    conn.close()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def manager() -> ConnectionManager:
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ConnectionManager(config.MAX_CONNECTIONS, config.MAX_CONNECTIONS_PER_IP,
+                                         config.MAX_CONNECTIONS_PER_USER)
+        return _manager
@@ -0,0 +1,369 @@
+# async_server.py
+# asyncio engine: every client is a coroutine on a single event loop instead
+# of an OS thread. The command handling mirrors handle_client() in
+# 2nd_server.py, using the loop's non-blocking socket calls (sock_recv /
+# sock_sendall) so each idle client costs a socket and a suspended coroutine
+# rather than a thread stack.
+import asyncio
+import functools
+import socket
+import time
+
+import admission
+import config
+import durable
+import metrics
+import ratelimit
+import sessions
+import storage
+import tracing
+import transfer
+from auth import authenticate_async
+from common import buffers, checksums, framing
+from framed_session import FramedSession, io_executor
+
+SIZE = config.SIZE
+FORMAT = config.FORMAT
+
+
+async def send_text(loop, conn: socket.socket, msg: str):
+    await loop.sock_sendall(conn, msg.encode(FORMAT))
+
+
+async def handle_client(conn: socket.socket, addr, ticket=None, trace=tracing.NULL):
+    loop = asyncio.get_running_loop()
+    print(f"[NEW CONNECTION] {addr} connected.")
+    connected = time.perf_counter()
+
+    conn.setblocking(False)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.SOCKET_BUFFER_SIZE)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.SOCKET_BUFFER_SIZE)
+
+    framed = False
+    try:
+        await send_text(loop, conn, "OK@Welcome to the server. Please log in")
+
+        # Login, or a HELLO frame from a client speaking the framed protocol.
+        # RESUME@<token> and LOGIN@user@pass@TOKEN work as in 2nd_server.py.
+        first = await loop.sock_recv(conn, SIZE)
+        if framing.is_framed(first):
+            framed = True
+            await FramedSession(conn, addr, first, ticket, trace).run()
+            return
+
+        auth_data = first.decode(FORMAT)
+        parts = auth_data.split("@")
+        username = token = None
+        resumed = len(parts) == 2 and parts[0] == "RESUME"
+        if resumed:
+            username = sessions.resume(parts[1])
+            if username is None:
+                resumed = False
+                await send_text(loop, conn, "ERR@SESSION_EXPIRED")
+                parts = (await loop.sock_recv(conn, SIZE)).decode(FORMAT).split("@")
+
+        if username is None:
+            if parts[0] != "LOGIN" or len(parts) not in (3, 4) or parts[3:] not in ([], ["TOKEN"]):
+                await send_text(loop, conn, "ERR@Bad login format")
+                return
+            if not await authenticate_async(parts[1], parts[2]):
+                await send_text(loop, conn, "ERR@AUTH_FAILED")
+                print(f"[AUTH_FAIL] {addr} failed authentication.")
+                return
+            username = parts[1]
+
+        if not admission.manager().login(ticket, username):
+            await send_text(loop, conn, admission.busy_message())
+            print(f"[BUSY] {username} from {addr}: too many connections for this user")
+            return
+        msg = "OK@AUTH_SUCCESS@" + ("Session resumed." if resumed else
+                                    "You can now enter commands. Type HELP to see options.")
+        if resumed or len(parts) == 4:
+            token = sessions.issue(username)
+            msg += f"@{token}"
+        await send_text(loop, conn, msg)
+        trace.span("handshake", connected, user=username, resumed=resumed)
+        print(f"[AUTH_SUCCESS] {username} from {addr}{' (resumed)' if resumed else ''}")
+
+        await command_loop(loop, conn, addr, username, token, trace)
+    except Exception as e:
+        print(f"[ERROR] {addr}: {e}")
+    finally:
+        if not framed:  # FramedSession.run() reports and closes its own socket
+            print(f"[DISCONNECTED] {addr} disconnected.")
+            conn.close()
+
+
+async def command_loop(loop, conn: socket.socket, addr, username: str = None, token: str = None,
+                       trace=tracing.NULL):
+    while True:
+        data = (await loop.sock_recv(conn, SIZE)).decode(FORMAT).strip()
+        if not data:
+            return
+
+        parts = data.split("@")
+        cmd = parts[0].upper()
+        name = metrics.command_name(cmd)
+        started = metrics.command_started(name)
+        ok = True
+        try:
+            if cmd == "PING":
+                await send_text(loop, conn, "@".join(["PONG", *parts[1:]]))
+
+            elif cmd == "THROUGHPUT":
+                await handle_throughput(loop, conn, addr, parts, username, trace)
+
+            elif cmd == "LOGOUT":
+                sessions.revoke(token)
+                await send_text(loop, conn, "OK@Disconnected from the server.")
+                return
+
+            elif cmd == "HELP":
+                await send_text(loop, conn,
+                    "OK@Available commands:\n"
+                    "UPLOAD <filename>\nDOWNLOAD <filename>\n"
+                    "DELETE <filename>\nDIR\nVERIFY <filename>\nSTATS\nLOGOUT"
+                )
+
+            elif cmd == "DIR":
+                await send_text(loop, conn, await asyncio.to_thread(storage.list_dir))
+
+            elif cmd == "STATS":
+                await send_text(loop, conn, f"OK@{await asyncio.to_thread(storage.stats_text)}")
+
+            elif cmd == "VERIFY":
+                await handle_verify(loop, conn, parts)
+
+            elif cmd == "UPLOAD":
+                await handle_upload(loop, conn, addr, parts, username, trace)
+
+            elif cmd == "UPLOAD_EMPTY":
+                folder_name = parts[1] if len(parts) >= 2 else ""
+                try:
+                    await asyncio.to_thread(storage.make_dir, folder_name)
+                except ValueError as e:
+                    await send_text(loop, conn, f"ERR@{e}")
+                    continue
+                await send_text(loop, conn, f"OK@Empty folder '{folder_name}' created successfully.")
+                print(f"[UPLOAD_EMPTY] {addr} created empty folder '{folder_name}'")
+
+            elif cmd == "DOWNLOAD":
+                await handle_download(loop, conn, addr, parts, username, trace)
+
+            elif cmd == "DELETE":
+                if len(parts) < 2:
+                    await send_text(loop, conn, "ERR@Missing filename or folder name")
+                    continue
+                try:
+                    kind = await asyncio.to_thread(storage.delete, parts[1])
+                    await send_text(loop, conn, f"OK@{kind} '{parts[1]}' deleted successfully.")
+                    print(f"[DELETE] {kind} '{parts[1]}' removed by {addr}")
+                except FileNotFoundError:
+                    await send_text(loop, conn, "ERR@Path not found.")
+                except Exception as e:
+                    await send_text(loop, conn, f"ERR@Failed to delete '{parts[1]}': {e}")
+                    print(f"[ERROR][DELETE] {addr}: Failed to delete '{parts[1]}': {e}")
+
+            else:
+                await send_text(loop, conn, "ERR@Unknown command")
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            metrics.command_finished(name, started, ok)
+            trace.span(name, started, ok=ok)
+
+
+async def handle_throughput(loop, conn, addr, parts, username=None, trace=tracing.NULL):
+    if len(parts) < 3:
+        await send_text(loop, conn, "ERR@Invalid THROUGHPUT format")
+        return
+    try:
+        size_kb = int(parts[1])
+        iterations = int(parts[2])
+    except ValueError as e:
+        await send_text(loop, conn, f"ERR@Invalid parameters: {e}")
+        return
+
+    total_bytes = size_kb * iterations * 1024
+    print(f"[THROUGHPUT] Starting test: {size_kb}KB x {iterations} iterations = {total_bytes/1_048_576:.2f}MB from {addr}")
+    await send_text(loop, conn, "READY")
+
+    received_total = 0
+    start_time = time.time()
+    throttle = ratelimit.throttle(username, ratelimit.THROUGHPUT, ratelimit.RECV)
+    xfer = trace.transfer("throughput", f"{size_kb}KB x {iterations}", total_bytes)
+    buf = bytearray(1024)  # reused for every chunk
+    for batch in range(1, iterations + 1):
+        batch_received = 0
+        for _ in range(size_kb):
+            batch_received += await framing.async_recv_length_prefixed_into(loop, conn, buf)
+        received_total += batch_received
+        xfer.mark("net", batch_received)
+        await ratelimit.async_pace(throttle, batch_received)
+        xfer.mark("wait")
+        await send_text(loop, conn, f"ACK_BATCH_{batch}")
+        xfer.mark("net")
+
+    duration = time.time() - start_time
+    xfer.finish()
+    metrics.add_bytes("in", received_total)
+    mbps = (received_total / 1_048_576) / duration if duration > 0 else 0
+    print(f"[THROUGHPUT] Complete: {received_total:,} bytes ({received_total/1_048_576:.2f}MB) "
+          f"in {duration:.2f}s = {mbps:.2f} MB/s")
+
+
+async def handle_verify(loop, conn, parts):
+    """VERIFY@name[@digest] -> OK@<algorithm>@<digest>[@MATCH|@MISMATCH]"""
+    if len(parts) < 2:
+        await send_text(loop, conn, "ERR@Missing filename")
+        return
+    try:
+        digest, _ = await asyncio.to_thread(storage.verify, storage.resolve(parts[1]))
+    except ValueError as e:
+        await send_text(loop, conn, f"ERR@{e}")
+        return
+    except (FileNotFoundError, IsADirectoryError):
+        await send_text(loop, conn, "ERR@File not found.")
+        return
+    msg = f"OK@{checksums.ALGORITHM}@{digest}"
+    if len(parts) >= 3:
+        msg += "@MATCH" if parts[2] == digest else "@MISMATCH"
+    await send_text(loop, conn, msg)
+
+
+async def handle_upload(loop, conn, addr, parts, username=None, trace=tracing.NULL):
+    if len(parts) < 2:
+        await send_text(loop, conn, "ERR@Missing filename")
+        return
+
+    filename = parts[1]
+    sub = parts[2] if len(parts) >= 3 else None
+    try:
+        filepath = await asyncio.to_thread(storage.upload_path, filename, sub)
+    except ValueError as e:
+        await send_text(loop, conn, f"ERR@{e}")
+        return
+
+    await send_text(loop, conn, "READY")
+
+    filesize_data = (await loop.sock_recv(conn, SIZE)).decode(FORMAT)
+    try:
+        filesize = int(filesize_data)
+    except ValueError:
+        await send_text(loop, conn, "ERR@Invalid file size")
+        return
+
+    await send_text(loop, conn, "OK")
+
+    # Receive into a .part file; only a complete upload is renamed into place.
+    partial = storage.PartialUpload(filepath, filesize)
+    hasher = checksums.new()
+    throttle = ratelimit.throttle(username, ratelimit.TRANSFER, ratelimit.RECV)
+    xfer = trace.transfer("upload", filename, filesize)
+    received = 0
+    f = await asyncio.to_thread(partial.open)
+    try:
+        with buffers.lease(config.CHUNK_SIZE) as buf:
+            while received < filesize:
+                n = await loop.sock_recv_into(conn, buf[:min(config.CHUNK_SIZE, filesize - received)])
+                xfer.mark("net", n)
+                if not n:
+                    break
+                await durable.async_write(f, buf[:n])
+                xfer.mark("disk")
+                hasher.update(buf[:n])
+                xfer.mark("cpu")
+                received += n
+                await ratelimit.async_pace(throttle, n)
+                xfer.mark("wait")
+    finally:
+        await asyncio.to_thread(f.close)
+
+    metrics.add_bytes("in", received)
+    if received < filesize:
+        raise ConnectionError(f"Upload of '{filename}' stopped at {received} of {filesize} bytes")
+    await asyncio.to_thread(partial.commit)
+    await asyncio.to_thread(storage.record_digest, filepath, hasher.hexdigest())
+    xfer.mark("disk")
+    xfer.finish()
+    await send_text(loop, conn, f"OK@File '{filename}' uploaded successfully.")
+    print(f"[UPLOAD] {addr} uploaded '{filename}' ({received} bytes) to '{sub or '.'}'")
+
+
+async def handle_download(loop, conn, addr, parts, username=None, trace=tracing.NULL):
+    if len(parts) < 2:
+        await send_text(loop, conn, "ERR@Missing filename")
+        return
+    filename = parts[1]
+    try:
+        f = await asyncio.to_thread(storage.open_file, storage.resolve(filename))
+    except ValueError as e:
+        await send_text(loop, conn, f"ERR@{e}")
+        return
+    except (FileNotFoundError, IsADirectoryError):
+        await send_text(loop, conn, "ERR@File not found.")
+        return
+
+    with f:
+        filesize = storage.file_size(f)
+        await send_text(loop, conn, f"OK@{filesize}")
+
+        ack = (await loop.sock_recv(conn, SIZE)).decode(FORMAT).strip()
+        if ack != "READY":
+            print(f"[ERROR] Client not ready for download")
+            return
+
+        print(f"[SEND] Sending '{filename}' ({filesize} bytes) to {addr}")
+        start_time = time.perf_counter()
+        xfer = trace.transfer("download", filename, filesize)
+        sent, mode = await transfer.async_send_file(loop, conn, f, 0, filesize, ratelimit.throttle(
+            username, ratelimit.TRANSFER, ratelimit.SEND))
+        xfer.mark("net", sent)  # sendfile: disk and network in one call
+        xfer.finish(mode=mode)
+    stats = transfer.record_transfer("download", filename, addr, sent,
+                                     time.perf_counter() - start_time, mode)
+
+    print(f"[SENT] '{filename}' sent successfully to {addr} ({sent} bytes, "
+          f"{mode}, {stats['mbps']:.2f} MB/s)")
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(io_executor())
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((config.IP, config.PORT))
+    server.listen(config.LISTEN_BACKLOG)
+    server.setblocking(False)
+    print(f"Server is listening on {config.IP}:{config.PORT}")
+
+    # Keep references so running client tasks are not garbage collected.
+    manager = admission.manager()
+    clients = set()
+    while True:
+        conn, addr = await loop.sock_accept(server)
+        ticket = manager.admit(addr)
+        if ticket is None:
+            admission.turn_away(conn)
+            continue
+        manager.start(ticket)  # a task costs no thread, so nothing waits in a queue
+        trace = tracing.connection(addr)
+        task = loop.create_task(handle_client(conn, addr, ticket, trace))
+        clients.add(task)
+        task.add_done_callback(clients.discard)
+        task.add_done_callback(functools.partial(client_done, ticket, trace))
+        print(f"[ACTIVE CONNECTIONS] {len(clients)}")
+
+
+def client_done(ticket, trace, _task):
+    trace.close()
+    admission.manager().release(ticket)
+
+
+def run():
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
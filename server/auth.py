@@ -1,17 +1,194 @@
+# auth.py
+# User store and password checks for LOGIN.
+#
+# users.json maps usernames to password hashes. It is parsed once and kept in
+# memory; each login only stat()s the file and reloads it if its mtime or
+# size changed, so edits still take effect without a restart.
+#
+# Hashes are salted scrypt ("scrypt$n$r$p$salt$hash", PBKDF2 where OpenSSL
+# lacks scrypt), compared with hmac.compare_digest. Entries in the old format
+# (bare MD5 hex) are still accepted and rewritten as scrypt on the next
+# successful login. The KDF is deliberately slow and memory hungry, so at
+# most config.AUTH_WORKERS hashes run at once; the asyncio engine runs them
+# on a dedicated pool (authenticate_async) so the event loop never waits.
+import asyncio
+import base64
 import hashlib
+import hmac
 import json
 import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 200000
+SALT_SIZE = 16
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
 
-USERS_FILE = os.path.join(os.path.dirname(__file__), "users.json")
 
 def hash_password(password: str) -> str:
-    return hashlib.md5(password.encode()).hexdigest()
+    """A new salted hash of password in the users.json format."""
+    salt = secrets.token_bytes(SALT_SIZE)
+    if hasattr(hashlib, "scrypt"):
+        key = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}"
+    key = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(key)}"
+
+
+def is_legacy(stored: str) -> bool:
+    return "$" not in stored
+
+
+def check_password(password: str, stored: str) -> bool:
+    """Does password match the stored hash (any supported format)?"""
+    try:
+        if is_legacy(stored):
+            return hmac.compare_digest(hashlib.md5(password.encode()).hexdigest(), stored.lower())
+        scheme, *params = stored.split("$")
+        if scheme == "scrypt":
+            n, r, p, salt, key = params
+            key = base64.b64decode(key)
+            actual = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=int(n), r=int(r),
+                                    p=int(p), maxmem=int(n) * int(r) * 256, dklen=len(key))
+        elif scheme == "pbkdf2_sha256":
+            iterations, salt, key = params
+            key = base64.b64decode(key)
+            actual = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(salt),
+                                         int(iterations), len(key))
+        else:
+            return False
+    except (ValueError, TypeError):
+        return False  # a malformed entry never matches
+    return hmac.compare_digest(actual, key)
+
+
+class UserStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._key = None    # (mtime_ns, size) of the file as loaded
+        self._users = {}
+        self.loads = 0
+
+    def users(self) -> dict:
+        """The current {username: hash}, reloaded only if the file changed."""
+        st = os.stat(self.path)
+        with self._lock:
+            if self._key != (st.st_mtime_ns, st.st_size):
+                with open(self.path, "r") as f:
+                    self._users = json.load(f)
+                self._key = (st.st_mtime_ns, st.st_size)
+                self.loads += 1
+            return self._users
+
+    def update(self, username: str, stored: str, expected: str) -> bool:
+        """Replace username's hash if it is still `expected`; atomically rewrites the file."""
+        with self._lock:
+            with open(self.path, "r") as f:
+                users = json.load(f)
+            if users.get(username) != expected:
+                return False  # changed meanwhile; leave it alone
+            users[username] = stored
+            tmp = f"{self.path}.{secrets.token_hex(8)}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(users, f, indent=2)
+            os.replace(tmp, self.path)
+            st = os.stat(self.path)
+            self._users, self._key = users, (st.st_mtime_ns, st.st_size)
+            return True
+
+
+_store = None
+_slots = None
+_executor = None
+_init_lock = threading.Lock()
+# Checked against when the username is unknown, so a failed login takes as
+# long whether or not the user exists.
+_DUMMY_HASH = hash_password(secrets.token_hex(8))
+# (username, stored hash) -> keyed digest of the password last verified
+# against it. A reconnecting client skips the KDF; the key never leaves the
+# process, and a changed hash no longer matches its entry.
+_verified = {}
+_verified_key = secrets.token_bytes(32)
+_stats = {"logins": 0, "failures": 0, "kdf_runs": 0, "fast_path": 0, "migrated": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _init():
+    global _store, _slots, _executor
+    with _init_lock:
+        if _store is None or _store.path != config.USERS_FILE:
+            _store = UserStore(config.USERS_FILE)
+            _verified.clear()
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(config.AUTH_WORKERS)
+            _executor = ThreadPoolExecutor(max_workers=config.AUTH_WORKERS, thread_name_prefix="auth")
+    return _store
+
+
+def _remember(username: str, stored: str, password: str):
+    _verified[(username, stored)] = hmac.digest(_verified_key, password.encode(), "sha256")
+
+
+def _remembered(username: str, stored, password: str) -> bool:
+    remembered = _verified.get((username, stored))
+    return remembered is not None and hmac.compare_digest(
+        remembered, hmac.digest(_verified_key, password.encode(), "sha256"))
 
-def load_users():
-    with open(USERS_FILE, "r") as f:
-        return json.load(f)
 
 def authenticate(username: str, password: str) -> bool:
-    users = load_users()
-    hashed_pw = hash_password(password)
-    return username in users and users[username] == hashed_pw
\ No newline at end of file
+    store = _init()
+    stored = store.users().get(username)
+    if _remembered(username, stored, password):
+        _count("fast_path")
+        _count("logins")
+        return True
+
+    with _slots:
+        # A login of the same user may have finished while we waited.
+        stored = store.users().get(username)
+        if _remembered(username, stored, password):
+            _count("fast_path")
+            _count("logins")
+            return True
+        _count("kdf_runs")
+        ok = check_password(password, stored if isinstance(stored, str) else _DUMMY_HASH)
+        ok = ok and isinstance(stored, str)
+        if ok and is_legacy(stored):
+            upgraded = hash_password(password)
+            if store.update(username, upgraded, stored):
+                _count("migrated")
+                stored = upgraded
+    if not ok:
+        _count("failures")
+        return False
+    _remember(username, stored, password)
+    _count("logins")
+    return True
+
+
+async def authenticate_async(username: str, password: str) -> bool:
+    """authenticate() on the bounded auth pool, for the asyncio engine."""
+    _init()
+    return await asyncio.get_running_loop().run_in_executor(_executor, authenticate, username, password)
+
+
+def stats() -> dict:
+    with _stats_lock:
+        s = dict(_stats)
+    s["file_loads"] = _store.loads if _store is not None else 0
+    return s
@@ -0,0 +1,137 @@
+# cache.py
+# In-memory cache of hot file contents for DOWNLOAD.
+#
+# A few files account for most downloads, so their bytes are kept in memory
+# as read-only buffers shared by every connection that sends them. Entries
+# are keyed by path and validated against (inode, size, mtime) on each use,
+# so a file changed behind the server's back is never served stale; UPLOAD
+# and DELETE also drop entries explicitly (storage.invalidate). The total
+# size is bounded and the least recently used entries are evicted first.
+import collections
+import os
+import threading
+
+
+class CachedFile:
+    """Read-only, seekable file object over a cached buffer.
+
+    transfer.send_file() sends straight from .buffer instead of reading.
+    """
+
+    def __init__(self, buffer: memoryview):
+        self.buffer = buffer
+        self.size = len(buffer)
+        self.pos = 0
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size - self.pos
+        data = bytes(self.buffer[self.pos:self.pos + n])
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FileCache:
+    """LRU cache of file contents. A miss is a file the cache could hold
+    being read from disk (put()); looking up a file too large to ever be
+    cached is neither a hit nor a miss, so streaming big files doesn't
+    drag the hit ratio down."""
+
+    def __init__(self, capacity: int, max_file: int):
+        self.capacity = capacity  # bytes; 0 disables the cache
+        self.max_file = max_file  # larger files are never cached
+        self._entries = collections.OrderedDict()  # path -> (key, memoryview)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def admits(self, size: int) -> bool:
+        return 0 < self.capacity and size <= min(self.max_file, self.capacity)
+
+    def get(self, path: str, key):
+        """Cached contents of path if its key (inode, size, mtime) still matches.
+
+        None is not counted as a miss yet: the caller only knows whether the
+        file could have been cached once it has opened it.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:  # the file changed on disk
+                self._remove(path)
+            return None
+
+    def put(self, path: str, key, data: bytes) -> memoryview:
+        """Cache data read from disk after get() missed."""
+        buffer = memoryview(data).toreadonly()
+        if not self.admits(len(buffer)):
+            return buffer
+        with self._lock:
+            self.misses += 1
+            if path in self._entries:
+                self._remove(path)
+            self._entries[path] = (key, buffer)
+            self.bytes += len(buffer)
+            while self.bytes > self.capacity:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return buffer
+
+    def invalidate(self, path: str):
+        """Drop path, or everything under it if it is a folder."""
+        prefix = path.rstrip(os.sep) + os.sep
+        with self._lock:
+            for cached in [p for p in self._entries if p == path or p.startswith(prefix)]:
+                self._remove(cached)
+                self.invalidations += 1
+
+    def _remove(self, path: str):
+        _, buffer = self._entries.pop(path)
+        self.bytes -= len(buffer)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "capacity": self.capacity,
+                "bytes": self.bytes,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,309 @@
+# chunkstore.py
+# Content-addressed chunk store behind the "chunked" storage backend.
+#
+# Each file is cut into content-defined chunks (common/chunking.py). Every
+# distinct chunk is stored once as <root>/<ab>/<hash>, and the file's own path
+# in SERVER_PATH holds a small manifest listing its chunks in order. A stored
+# file only counts as a manifest if the store wrote it: each manifest it writes
+# is registered under <registry> with the stat key of the file, so bytes a
+# client uploaded that merely look like a manifest stay plain data. Identical
+# uploads, and files that share long runs of bytes, share storage. DIR and
+# DELETE keep working on the manifests unchanged; DOWNLOAD reads through
+# ChunkedFile, which reassembles the bytes.
+#
+# Chunks are not reference counted. A chunk nobody points at any more (after
+# a DELETE or an overwrite) stays on disk until sweep(), which runs only at
+# server start. That is deliberate: an upload stores its chunks before it
+# writes the manifest that refers to them, so a sweep while uploads are in
+# flight would delete chunks about to be used, and each sweep walks every
+# manifest. Orphans cost disk space until the next restart, never data.
+import bisect
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import NamedTuple
+
+import durable
+from common import chunking
+
+MANIFEST_MAGIC = b"FSMANIFEST1\n"
+
+
+class Manifest(NamedTuple):
+    size: int
+    chunks: list  # [(chunk id, length)]
+
+
+def read_manifest(f):
+    """Parse a manifest from an open binary file, or return None if it isn't one."""
+    if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+        return None
+    try:
+        body = json.loads(f.read())
+        chunks = [(h, int(n)) for h, n in body["chunks"]]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not all(chunking.is_chunk_id(h) and n >= 0 for h, n in chunks):
+        return None  # an id is a file name in the store; anything else could point outside it
+    try:
+        return Manifest(int(body["size"]), chunks)
+    except (ValueError, TypeError):
+        return None
+
+
+def _stat_key(st) -> list:
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class ChunkStore:
+    def __init__(self, root: str, registry: str, base: str):
+        self.root = root
+        self.registry = registry  # mirrors the tree under base: <rel>.json per manifest
+        self.base = os.path.abspath(base)
+        self._lock = threading.Lock()
+        self._manifest_lock = threading.Lock()  # registers and renames manifests into place
+        self.files = 0
+        self.logical_bytes = 0     # sum of the sizes of all stored files
+        self.unique_chunks = 0
+        self.stored_bytes = 0      # bytes actually held in chunks
+        self.upload_bytes = 0      # file bytes uploaded through UPLOAD_CHUNKS
+        self.upload_bytes_sent = 0  # ...of which had to cross the wire
+
+    def path(self, chunk_id: str) -> str:
+        return os.path.join(self.root, chunk_id[:2], chunk_id)
+
+    def _mark_path(self, path: str, folder: bool = False) -> str:
+        rel = os.path.relpath(os.path.abspath(path), self.base)
+        return os.path.join(self.registry, rel if folder else rel + ".json")
+
+    def _mark(self, path: str, st):
+        mark = self._mark_path(path)
+        os.makedirs(os.path.dirname(mark), exist_ok=True)
+        tmp = f"{mark}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(_stat_key(st), f)
+        os.replace(tmp, mark)
+
+    def unmark(self, path: str):
+        """Forget the registrations of path (a file or a whole folder), which was deleted."""
+        try:
+            os.remove(self._mark_path(path))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(self._mark_path(path, folder=True), ignore_errors=True)
+
+    def written_by_us(self, path: str, st) -> bool:
+        """Whether the file at path, with stat st, is a manifest this store wrote.
+
+        Anything that replaced it since (a plain upload, an edit behind the
+        server's back) has a different stat key.
+        """
+        try:
+            with open(self._mark_path(path)) as f:
+                return json.load(f) == _stat_key(st)
+        except (OSError, ValueError):
+            return False
+
+    def load(self, path: str):
+        """The Manifest stored at path, or None if path is not one of ours."""
+        try:
+            with open(path, "rb") as f:
+                if not self.written_by_us(path, os.fstat(f.fileno())):
+                    return None
+                return read_manifest(f)
+        except OSError:
+            return None
+
+    def has(self, chunk_id: str) -> bool:
+        return os.path.exists(self.path(chunk_id))
+
+    def put(self, chunk_id: str, data) -> bool:
+        """Store a chunk unless it is already present. Returns True if it was new."""
+        path = self.path(chunk_id)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            durable.sync_file(f)
+        with self._lock:
+            if os.path.exists(path):  # another upload stored it meanwhile
+                os.remove(tmp)
+                return False
+            durable.replace(tmp, path, synced=True)
+            self.unique_chunks += 1
+            self.stored_bytes += len(data)
+        return True
+
+    def write_manifest(self, dest: str, manifest: Manifest):
+        """Atomically write (or replace) the manifest at dest."""
+        tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(MANIFEST_MAGIC)
+            f.write(json.dumps({"size": manifest.size, "chunks": manifest.chunks}).encode("utf-8"))
+            durable.sync_file(f)
+            st = os.fstat(f.fileno())
+        # The rename keeps the inode and mtime, so the file is registered
+        # before it appears under its name. Two uploads of the same name must
+        # not interleave these steps, or the registry keeps the stat key of
+        # the manifest that lost the rename.
+        with self._manifest_lock:
+            old = self.load(dest) if os.path.isfile(dest) else None
+            self._mark(dest, st)
+            durable.replace(tmp, dest, synced=True)
+        with self._lock:
+            if old is not None:
+                self.files -= 1
+                self.logical_bytes -= old.size
+            self.files += 1
+            self.logical_bytes += manifest.size
+
+    def ingest(self, src: str, dest: str):
+        """Chunk the plain file src into the store and leave a manifest at dest.
+
+        src may be dest itself, in which case the file is replaced in place.
+        """
+        chunks = []
+        size = 0
+        with open(src, "rb") as f:
+            for data in chunking.split(f):
+                chunk_id = chunking.chunk_id(data)
+                self.put(chunk_id, data)
+                chunks.append((chunk_id, len(data)))
+                size += len(data)
+        self.write_manifest(dest, Manifest(size, chunks))
+        if os.path.abspath(src) != os.path.abspath(dest):
+            os.remove(src)
+
+    def forget(self, manifest: Manifest):
+        """Account for a manifest that was deleted."""
+        with self._lock:
+            self.files -= 1
+            self.logical_bytes -= manifest.size
+
+    def record_upload(self, size: int, sent: int):
+        with self._lock:
+            self.upload_bytes += size
+            self.upload_bytes_sent += sent
+
+    def open(self, manifest: Manifest) -> "ChunkedFile":
+        return ChunkedFile(self, manifest)
+
+    def sweep(self, manifests) -> int:
+        """Delete chunks no manifest refers to and recount the totals.
+
+        manifests is every Manifest currently stored. Returns the number of
+        chunks removed. Must not run while uploads are in progress.
+        """
+        referenced = set()
+        files = logical = 0
+        for manifest in manifests:
+            files += 1
+            logical += manifest.size
+            referenced.update(chunk_id for chunk_id, _ in manifest.chunks)
+
+        removed = unique = stored = 0
+        for current, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(current, name)
+                if name in referenced:
+                    unique += 1
+                    stored += os.path.getsize(path)
+                else:  # unreferenced chunk or a leftover .tmp
+                    os.remove(path)
+                    removed += 1
+
+        with self._lock:
+            self.files, self.logical_bytes = files, logical
+            self.unique_chunks, self.stored_bytes = unique, stored
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": self.files,
+                "logical_bytes": self.logical_bytes,
+                "unique_chunks": self.unique_chunks,
+                "stored_bytes": self.stored_bytes,
+                "dedup_ratio": round(self.logical_bytes / self.stored_bytes, 3) if self.stored_bytes else 1.0,
+                "upload_bytes": self.upload_bytes,
+                "upload_bytes_sent": self.upload_bytes_sent,
+            }
+
+
+class ChunkedFile:
+    """Read-only, seekable file object over a manifest's chunks.
+
+    It has no fileno(), so transfer.send_file() serves it with the chunked
+    read/send loop instead of sendfile.
+    """
+
+    def __init__(self, store: ChunkStore, manifest: Manifest):
+        self.store = store
+        self.manifest = manifest
+        self.size = manifest.size
+        self.starts = []
+        offset = 0
+        for _, length in manifest.chunks:
+            self.starts.append(offset)
+            offset += length
+        self.pos = 0
+        self._cached = (None, b"")  # (index, bytes) of the last chunk read
+
+    def _chunk(self, index: int) -> bytes:
+        if self._cached[0] != index:
+            with open(self.store.path(self.manifest.chunks[index][0]), "rb") as f:
+                self._cached = (index, f.read())
+        return self._cached[1]
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            n = self.size - self.pos
+        out = bytearray()
+        while n > 0 and self.pos < self.size:
+            index = bisect.bisect_right(self.starts, self.pos) - 1
+            start = self.pos - self.starts[index]
+            piece = self._chunk(index)[start:start + n]
+            if not piece:
+                raise OSError(f"Chunk {self.manifest.chunks[index][0]} is truncated")
+            out += piece
+            self.pos += len(piece)
+            n -= len(piece)
+        return bytes(out)
+
+    def readinto(self, b) -> int:
+        view = memoryview(b)
+        done = 0
+        while done < len(view) and self.pos < self.size:
+            index = bisect.bisect_right(self.starts, self.pos) - 1
+            start = self.pos - self.starts[index]
+            piece = memoryview(self._chunk(index))[start:start + len(view) - done]
+            if not piece:
+                raise OSError(f"Chunk {self.manifest.chunks[index][0]} is truncated")
+            view[done:done + len(piece)] = piece
+            self.pos += len(piece)
+            done += len(piece)
+        return done
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self):
+        self._cached = (None, b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,118 @@
+# config.py
+# Shared server settings. Both engines read these at call time (config.X),
+# so the command-line flags parsed in 2nd_server.main() apply everywhere.
+import os
+
+IP = "0.0.0.0"
+PORT = 4450
+SIZE = 1024
+CHUNK_SIZE = 65536  # 64KB chunks
+SOCKET_BUFFER_SIZE = 65536
+FORMAT = "utf-8"
+SERVER_PATH = os.path.join("server", "server_data")
+
+# Engine selection: "threaded" (one thread per client) or "asyncio"
+ENGINE = "threaded"
+LISTEN_BACKLOG = 1024
+
+# DOWNLOAD: hand file descriptors to the kernel (os.sendfile) instead of
+# copying every chunk through user space. Falls back automatically.
+ZERO_COPY = True
+
+# Framed protocol: payload size of each DATA frame the server sends.
+FRAME_DATA_SIZE = 262144
+
+# Storage backend: "plain" stores every upload as a full copy; "chunked"
+# splits uploads into content-defined chunks and stores each distinct chunk
+# once (server/chunkstore.py).
+STORAGE_BACKEND = "plain"
+
+# Offer on-the-wire compression (common/compression.py) for UPLOAD/DOWNLOAD.
+COMPRESSION = True
+
+# DOWNLOAD cache of hot file contents (server/cache.py): total bytes kept in
+# memory (0 disables it) and the largest file that may be cached.
+CACHE_SIZE = 256 * 1048576
+CACHE_MAX_FILE = 16 * 1048576
+
+# Framed protocol: how many requests one connection may have in flight, how
+# many DATA frames are buffered per request, and how many payload bytes of
+# them one connection may hold across all its requests before reading
+# pauses. (One frame is always let through, however large.)
+MAX_STREAMS = 64
+STREAM_QUEUE_DEPTH = 16
+STREAM_QUEUE_BYTES = 16 * 1048576
+
+# Framed LOGOUT waits this many seconds for the requests still in flight to
+# finish before it answers and the connection closes (cancelling the rest).
+LOGOUT_DRAIN_TIMEOUT = 30
+
+# Framed THROUGHPUT test (timed mode): the DATA frame sizes a client may ask
+# for and the longest run it may ask for, in seconds.
+THROUGHPUT_MIN_FRAME = 1024
+THROUGHPUT_MAX_FRAME = 16 * 1048576
+THROUGHPUT_MAX_SECONDS = 120
+
+# Framed DIR: entries per page when the client doesn't ask for a limit, the
+# largest page it may ask for, and entries per DATA frame within a page.
+DIR_PAGE_SIZE = 1000
+DIR_MAX_PAGE_SIZE = 10000
+DIR_FRAME_ENTRIES = 256
+
+# Uploads: durability of the rename that publishes a finished upload
+# (server/durable.py): "none", "fsync" (the file) or "fsync+dir" (the file
+# and its directory). Received bytes are written through a buffer of
+# WRITE_BUFFER_SIZE into a file preallocated to the announced size.
+FSYNC_POLICY = "fsync"
+WRITE_BUFFER_SIZE = 1048576
+PREALLOCATE = True
+
+# Blocking work the event loops hand to threads (disk reads and writes,
+# hashing, compression) runs on one shared pool of IO_WORKERS threads, so
+# the threaded engine's per-connection loops don't each start their own.
+IO_WORKERS = 32
+
+# LOGIN: the user store (username -> password hash, server/auth.py) and how
+# many password hashes may be computed at once.
+USERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json")
+AUTH_WORKERS = 4
+
+# Session tokens (server/sessions.py): seconds a token stays valid after its
+# last use, and how many are kept at most.
+SESSION_TTL = 3600
+SESSION_MAX = 100000
+
+# Admission control (server/admission.py). MAX_CONNECTIONS counts clients
+# being served plus those waiting for one of the threaded engine's
+# WORKER_THREADS; the per-IP / per-user caps (0 = none) stop one host or
+# account from taking them all. Clients over a limit get ERR@BUSY@<seconds>
+# with BUSY_RETRY_AFTER as the hint.
+MAX_CONNECTIONS = 4096
+WORKER_THREADS = 1024
+MAX_CONNECTIONS_PER_IP = 256
+MAX_CONNECTIONS_PER_USER = 128
+BUSY_RETRY_AFTER = 1
+
+# Bandwidth shaping (server/ratelimit.py), in bytes per second per direction;
+# 0 = unlimited. RATE_LIMIT caps all clients together, RATE_LIMIT_PER_USER
+# all connections of one user, and RATE_LIMIT_CLASSES all transfers of one
+# command class. A bucket holds RATE_BURST seconds' worth of bytes.
+RATE_LIMIT = 0
+RATE_LIMIT_PER_USER = 0
+RATE_LIMIT_CLASSES = {"transfer": 0, "throughput": 0}
+RATE_BURST = 0.05
+
+# Metrics (server/metrics.py): serve them in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics; port 0 turns the exporter off.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+
+# Tracing (server/tracing.py): Chrome trace events for a TRACE_SAMPLE
+# fraction of connections are written to TRACE_FILE (None: off), with a
+# transfer progress marker every TRACE_PROGRESS_BYTES. A PROFILE_SAMPLE
+# fraction of connections runs under cProfile, dumped into PROFILE_DIR.
+TRACE_FILE = None
+TRACE_SAMPLE = 1.0
+TRACE_PROGRESS_BYTES = 8 * 1048576
+PROFILE_SAMPLE = 0.0
+PROFILE_DIR = "profiles"
@@ -0,0 +1,175 @@
+# durable.py
+# How uploaded bytes reach the disk.
+#
+# Every upload is written to a temporary file (storage.PartialUpload, the
+# chunk store's .tmp files) and renamed over its real name only when
+# complete, so readers see either the old file or the whole new one. The
+# rename is only as safe as the bytes behind it, though: without an fsync a
+# crash can leave the new name pointing at a file whose data never made it
+# to disk. config.FSYNC_POLICY picks the trade-off:
+#
+#   none       rename only; fastest, a crash may lose recent uploads
+#   fsync      fsync the file before renaming it into place
+#   fsync+dir  ...and fsync the directory afterwards, so the rename itself
+#              survives a crash
+#
+# Writer adds large write buffers and preallocation from the announced size,
+# which keeps big uploads in few extents.
+import asyncio
+import os
+import threading
+import time
+
+import config
+import metrics
+
+POLICIES = ("none", "fsync", "fsync+dir")
+
+_lock = threading.Lock()
+_stats = {"file_syncs": 0, "file_sync_seconds": 0.0, "dir_syncs": 0, "dir_sync_seconds": 0.0}
+
+
+def _record(kind: str, seconds: float):
+    with _lock:
+        _stats[f"{kind}_syncs"] += 1
+        _stats[f"{kind}_sync_seconds"] += seconds
+    metrics.disk_time("fsync", seconds)
+
+
+def syncs_files() -> bool:
+    return config.FSYNC_POLICY != "none"
+
+
+def syncs_dirs() -> bool:
+    return config.FSYNC_POLICY == "fsync+dir"
+
+
+def sync_file(f):
+    """Flush an open file and, if the policy asks for it, fsync it."""
+    f.flush()
+    if syncs_files():
+        start = time.perf_counter()
+        os.fsync(f.fileno())
+        _record("file", time.perf_counter() - start)
+
+
+def sync_path(path: str):
+    """fsync a closed file by path (any descriptor flushes the whole file)."""
+    if syncs_files():
+        start = time.perf_counter()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        _record("file", time.perf_counter() - start)
+
+
+def sync_dir(path: str):
+    """fsync a directory so renames and new entries in it are on disk."""
+    if syncs_dirs():
+        start = time.perf_counter()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        _record("dir", time.perf_counter() - start)
+
+
+def replace(src: str, dest: str, synced: bool = False):
+    """Atomically move the finished file src to dest, durably per the policy.
+
+    synced: src was already fsynced through sync_file().
+    """
+    if not synced:
+        sync_path(src)
+    os.replace(src, dest)
+    sync_dir(os.path.dirname(os.path.abspath(dest)))
+
+
+class Writer:
+    """Buffered writer for a file being received, preallocated to its final size.
+
+    Opening at offset continues an existing file (a resumed upload). Space
+    past what was written is given back on close, so the file's size is
+    the number of bytes received. (After a crash it may not be; the resume
+    digest check then rejects the zero-filled tail and the upload restarts.)
+    on_close is called once the file is closed.
+    """
+
+    def __init__(self, path: str, size: int, offset: int = 0, on_close=None):
+        self.on_close = on_close
+        self.buffer_size = config.WRITE_BUFFER_SIZE
+        self.f = open(path, "r+b" if offset else "wb", buffering=self.buffer_size)
+        self.buffered = 0  # bytes written since the buffer last went to disk
+        self.allocated = offset
+        try:
+            if offset:
+                self.f.truncate(offset)
+                self.f.seek(offset)
+            if config.PREALLOCATE and size > offset and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(self.f.fileno(), offset, size - offset)
+                    self.allocated = size
+                except OSError:
+                    pass  # e.g. the filesystem doesn't support it
+        except BaseException:
+            self.f.close()
+            raise
+
+    def needs_disk(self, n: int) -> bool:
+        """Whether write() of n bytes goes to the disk rather than only into the buffer."""
+        return self.buffered + n > self.buffer_size
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        n = self.f.write(data)
+        if self.needs_disk(n):
+            self.f.flush()  # so the buffer is known to be empty again
+            self.buffered = 0
+        else:
+            self.buffered += n
+        metrics.disk_time("write", time.perf_counter() - start, n)
+        return n
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            if self.allocated > self.f.tell():
+                self.f.flush()
+                self.f.truncate(self.f.tell())
+        finally:
+            try:
+                self.f.close()
+            finally:
+                if self.on_close is not None:
+                    self.on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def async_write(writer: Writer, data):
+    """writer.write(data) for a coroutine: on a worker thread if it reaches the disk."""
+    if writer.needs_disk(len(data)):
+        await asyncio.to_thread(writer.write, data)
+    else:
+        writer.write(data)
+
+
+def stats() -> dict:
+    with _lock:
+        s = dict(_stats)
+    for kind in ("file", "dir"):
+        n = s[f"{kind}_syncs"]
+        s[f"{kind}_sync_avg_ms"] = round(s.pop(f"{kind}_sync_seconds") * 1000 / n, 3) if n else 0.0
+    s["policy"] = config.FSYNC_POLICY
+    return s
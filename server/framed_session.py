@@ -0,0 +1,1055 @@
+# framed_session.py
+# Server side of the framed binary protocol (common/framing.py).
+#
+# One implementation serves both engines: the asyncio engine awaits
+# FramedSession.run() on its own loop, and the threaded engine runs it on a
+# private event loop inside the client's thread (serve_blocking). Either way
+# the socket is driven with the loop's non-blocking sock_* calls.
+#
+# Requests are multiplexed: every request frame starts a task keyed by its
+# request id (the stream id), DATA frames are routed to that task's queue,
+# and replies from concurrent tasks are interleaved frame by frame under a
+# send lock. A client can therefore keep many uploads/downloads in flight
+# on one connection instead of paying round trips per file. Control frames
+# take the send lock ahead of waiting DATA frames, and transfers are shaped
+# by the token buckets in ratelimit.py.
+import asyncio
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+import chunkstore
+import config
+import durable
+import metrics
+import ratelimit
+import sessions
+import storage
+import tracing
+import transfer
+from auth import authenticate_async
+from common import buffers, checksums, chunking, compression, delta, framing
+from common.framing import Op
+
+HELP_TEXT = (
+    "Available commands:\n"
+    "UPLOAD <filename|folder>\nDOWNLOAD <filename>\n"
+    "DELETE <filename>\nDIR [folder] [pattern] [-r]\nVERIFY <filename> [local file]\nSTATS\nLOGOUT"
+)
+
+
+class FramedSession:
+    def __init__(self, conn, addr, initial: bytes = b"", ticket=None, trace=tracing.NULL):
+        self.loop = asyncio.get_running_loop()
+        self.conn = conn
+        self.addr = addr
+        self.ticket = ticket  # admission.Ticket; the per-user limit applies at login
+        self.trace = trace
+        self.started = time.perf_counter()
+        self.reader = framing.AsyncFrameReader(self.loop, conn, initial)
+        self.username = None
+        self.token = None   # this connection's session token
+        self.version = None
+        self.send_lock = ratelimit.PriorityLock()  # DATA frames yield to everything else
+        self.streams = {}   # request id -> queue of the request's DATA / END frames
+        self.queued_bytes = 0  # payload bytes waiting in those queues
+        self.dequeued = asyncio.Event()  # set whenever queued_bytes goes down
+        self.tasks = set()
+
+    # ------------------------------------------------------------------
+    # Sending
+    # ------------------------------------------------------------------
+    async def send(self, op: int, request_id: int = 0, payload=b"", flags: int = 0):
+        async with self.send_lock.hold(urgent=op != Op.DATA):
+            if len(payload) < 65536:
+                await self.loop.sock_sendall(self.conn, framing.pack_frame(op, request_id, payload, flags))
+            else:
+                # As framing.send_frame: don't copy a large payload to prepend the header.
+                await self.loop.sock_sendall(self.conn, framing.pack_header(op, request_id, len(payload), flags))
+                await self.loop.sock_sendall(self.conn, payload)
+
+    async def send_json(self, op: int, request_id: int = 0, obj: dict = None):
+        async with self.send_lock.hold(urgent=op != Op.DATA):
+            await self.loop.sock_sendall(self.conn, framing.pack_json(op, request_id, obj))
+
+    async def reply_ok(self, request_id: int, message: str = "", **fields):
+        await self.send_json(Op.OK, request_id, dict(fields, message=message))
+
+    async def reply_err(self, request_id: int, message: str):
+        await self.send_json(Op.ERR, request_id, {"message": message})
+
+    # ------------------------------------------------------------------
+    # Receiving
+    # ------------------------------------------------------------------
+    async def queue_frame(self, queue: asyncio.Queue, frame):
+        """Hand a DATA / END frame to its request, once the connection's
+        queued payload bytes leave room for it (STREAM_QUEUE_BYTES)."""
+        size = len(frame.payload)
+        while self.queued_bytes and self.queued_bytes + size > config.STREAM_QUEUE_BYTES:
+            self.dequeued.clear()
+            await self.dequeued.wait()
+            if self.streams.get(frame.request_id) is not queue:
+                return  # the request ended meanwhile; drop the frame
+        self.queued_bytes += size
+        await queue.put(frame)
+        if self.streams.get(frame.request_id) is not queue:
+            self.dequeue(frame)  # put after run_stream drained the queue; nobody will read it
+
+    def dequeue(self, frame):
+        self.queued_bytes -= len(frame.payload)
+        self.dequeued.set()
+
+    async def next_frame(self, request_id: int):
+        """Next DATA / END frame of request_id."""
+        frame = await self.streams[request_id].get()
+        self.dequeue(frame)
+        return frame
+
+    async def read_data(self, request_id: int) -> bytes:
+        """Next DATA payload belonging to request_id."""
+        frame = await self.next_frame(request_id)
+        if frame.op != Op.DATA:
+            raise framing.ProtocolError(f"Expected DATA, got {framing.op_name(frame.op)}")
+        return frame.payload
+
+    def throttle(self, cls: str, direction: str):
+        return ratelimit.throttle(self.username, cls, direction)
+
+    async def read_end(self, request_id: int) -> dict:
+        """The END frame a client sends after its last DATA frame (e.g. with a digest)."""
+        frame = await self.next_frame(request_id)
+        if frame.op != Op.END:
+            raise framing.ProtocolError(f"Expected END, got {framing.op_name(frame.op)}")
+        return frame.json()
+
+    # ------------------------------------------------------------------
+    # Session
+    # ------------------------------------------------------------------
+    async def run(self):
+        self.conn.setblocking(False)
+        try:
+            if await self.handshake() and await self.login():
+                await self.command_loop()
+        except Exception as e:
+            print(f"[ERROR] {self.addr}: {e}")
+        finally:
+            print(f"[DISCONNECTED] {self.addr} disconnected.")
+            self.conn.close()
+
+    def abort(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    async def handshake(self) -> bool:
+        frame = await self.reader.read_frame()
+        if frame.op != Op.HELLO:
+            await self.reply_err(frame.request_id, "Expected HELLO")
+            return False
+        offered = frame.json().get("versions", [])
+        common_versions = set(offered) & set(framing.SUPPORTED_VERSIONS)
+        if not common_versions:
+            await self.reply_err(frame.request_id, f"No common protocol version (server speaks "
+                                                   f"{list(framing.SUPPORTED_VERSIONS)})")
+            return False
+        self.version = max(common_versions)
+        features = ["dedup"] if storage.chunked() else []
+        codecs = compression.available() if config.COMPRESSION else []
+        await self.send_json(Op.HELLO, frame.request_id, {"version": self.version, "features": features,
+                                                          "codecs": codecs})
+        return True
+
+    async def login(self) -> bool:
+        """LOGIN with a username and password, or with a session token.
+
+        A rejected token leaves the connection open for a password LOGIN.
+        """
+        while True:
+            frame = await self.reader.read_frame()
+            if frame.op != Op.LOGIN:
+                await self.reply_err(frame.request_id, "Bad login format")
+                return False
+
+            args = frame.json()
+            if "token" in args:
+                username = sessions.resume(args["token"])
+                if username is None:
+                    await self.reply_err(frame.request_id, "SESSION_EXPIRED")
+                    continue
+                message = "Session resumed."
+            else:
+                username = args.get("username", "")
+                if not await authenticate_async(username, args.get("password", "")):
+                    await self.reply_err(frame.request_id, "AUTH_FAILED")
+                    print(f"[AUTH_FAIL] {self.addr} failed authentication.")
+                    return False
+                message = "You can now enter commands. Type HELP to see options."
+
+            if not admission.manager().login(self.ticket, username):
+                await self.send_json(Op.ERR, frame.request_id,
+                                     {"message": "BUSY", "retry_after": config.BUSY_RETRY_AFTER})
+                print(f"[BUSY] {username} from {self.addr}: too many connections for this user")
+                return False
+            self.username = username
+            self.token = sessions.issue(username)
+            await self.reply_ok(frame.request_id, message, token=self.token, ttl=config.SESSION_TTL)
+            self.trace.span("handshake", self.started, user=username, resumed="token" in args,
+                            version=self.version)
+            print(f"[AUTH_SUCCESS] {username} from {self.addr} (framed v{self.version}"
+                  f"{', resumed' if 'token' in args else ''})")
+            return True
+
+    async def command_loop(self):
+        try:
+            while True:
+                frame = await self.reader.read_frame()
+
+                if frame.op in (Op.DATA, Op.END):
+                    await self.route(frame)
+                    continue
+
+                if frame.op == Op.LOGOUT:
+                    await self.drain_streams()
+                    await self.on_logout(frame)
+                    return
+
+                handler = self.HANDLERS.get(frame.op)
+                if handler is None:
+                    await self.reply_err(frame.request_id, f"Unknown command {framing.op_name(frame.op)}")
+                elif frame.request_id in self.streams:
+                    await self.reply_err(frame.request_id, "Request id already in use")
+                elif len(self.streams) >= config.MAX_STREAMS:
+                    await self.reply_err(frame.request_id, "Too many requests in flight")
+                else:
+                    self.start_stream(frame, handler)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def route(self, frame):
+        """Queue a DATA / END frame for its request."""
+        queue = self.streams.get(frame.request_id)
+        if queue is not None:  # otherwise the request already failed
+            await self.queue_frame(queue, frame)
+
+    async def drain_streams(self):
+        """Before LOGOUT: let the requests in flight finish (for at most
+        LOGOUT_DRAIN_TIMEOUT), still reading the DATA / END frames they wait
+        for. New commands are refused meanwhile; a closed socket ends it."""
+        deadline = self.loop.time() + config.LOGOUT_DRAIN_TIMEOUT
+        read = None
+        try:
+            while self.tasks:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    return
+                read = read or self.loop.create_task(self.reader.read_frame())
+                done, _ = await asyncio.wait({read, *self.tasks}, timeout=remaining,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if read in done:
+                    frame = read.result()
+                    read = None
+                    if frame.op in (Op.DATA, Op.END):
+                        await self.route(frame)
+                    else:
+                        await self.reply_err(frame.request_id, "Logging out")
+        finally:
+            if read is not None:
+                read.cancel()
+                await asyncio.gather(read, return_exceptions=True)
+
+    def start_stream(self, frame, handler):
+        self.streams[frame.request_id] = asyncio.Queue(config.STREAM_QUEUE_DEPTH)
+        task = self.loop.create_task(self.run_stream(frame, handler))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_stream(self, frame, handler):
+        name = metrics.command_name(framing.op_name(frame.op))
+        started = metrics.command_started(name)
+        ok = False
+        try:
+            await handler(self, frame)
+            ok = True
+        except (ConnectionError, framing.ProtocolError) as e:
+            # The byte stream can't be trusted any more; end the session.
+            print(f"[ERROR] {self.addr}: {framing.op_name(frame.op)} #{frame.request_id}: {e}")
+            self.abort()
+        except Exception as e:
+            print(f"[ERROR] {self.addr}: {framing.op_name(frame.op)} #{frame.request_id}: {e}")
+            await self.reply_err(frame.request_id, str(e))
+        finally:
+            metrics.command_finished(name, started, ok)
+            self.trace.span(name, started, ok=ok, request_id=frame.request_id)
+            # Unblock the reader if it is waiting to queue more DATA for us;
+            # later frames for this id are dropped.
+            queue = self.streams.pop(frame.request_id)
+            while not queue.empty():
+                self.dequeue(queue.get_nowait())
+
+    # ------------------------------------------------------------------
+    # Commands
+    # ------------------------------------------------------------------
+    async def on_ping(self, frame):
+        # Echo the payload so clients can carry sequence numbers / timestamps.
+        await self.send(Op.PONG, frame.request_id, frame.payload, frame.flags)
+
+    async def on_logout(self, frame):
+        sessions.revoke(self.token)
+        await self.reply_ok(frame.request_id, "Disconnected from the server.")
+        return False
+
+    async def on_help(self, frame):
+        await self.reply_ok(frame.request_id, HELP_TEXT)
+
+    async def on_dir(self, frame):
+        args = frame.json()
+        if not args:
+            # Plain DIR: the top-level listing as text, as the text protocol sends it.
+            await self.reply_ok(frame.request_id, await asyncio.to_thread(storage.list_dir))
+            return
+
+        # Paged listing from the metadata index: OK {total}, then the page's
+        # entries in DATA frames (FLAG_JSON {"entries": [...]}), then END with
+        # the offset of the next page (None on the last one).
+        try:
+            offset = max(0, int(args.get("offset", 0)))
+            limit = min(int(args.get("limit") or config.DIR_PAGE_SIZE), config.DIR_MAX_PAGE_SIZE)
+            rows = await asyncio.to_thread(storage.list_entries, args.get("path") or "",
+                                           bool(args.get("recursive")), args.get("pattern"),
+                                           args.get("prefix"))
+        except (ValueError, TypeError) as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+        except (FileNotFoundError, NotADirectoryError):
+            await self.reply_err(frame.request_id, "Folder not found.")
+            return
+
+        page = rows[offset:offset + limit]
+        await self.reply_ok(frame.request_id, total=len(rows), offset=offset)
+        for start in range(0, len(page), config.DIR_FRAME_ENTRIES):
+            await self.send_json(Op.DATA, frame.request_id,
+                                 {"entries": page[start:start + config.DIR_FRAME_ENTRIES]})
+        next_offset = offset + len(page) if offset + len(page) < len(rows) else None
+        await self.send_json(Op.END, frame.request_id, {"count": len(page), "next": next_offset})
+
+    async def on_delete(self, frame):
+        name = frame.json().get("name")
+        if not name:
+            await self.reply_err(frame.request_id, "Missing filename or folder name")
+            return
+        try:
+            kind = await asyncio.to_thread(storage.delete, name)  # may remove a whole tree
+        except FileNotFoundError:
+            await self.reply_err(frame.request_id, "Path not found.")
+            return
+        except Exception as e:
+            await self.reply_err(frame.request_id, f"Failed to delete '{name}': {e}")
+            print(f"[ERROR][DELETE] {self.addr}: Failed to delete '{name}': {e}")
+            return
+        await self.reply_ok(frame.request_id, f"{kind} '{name}' deleted successfully.")
+        print(f"[DELETE] {kind} '{name}' removed by {self.addr}")
+
+    async def on_upload_empty(self, frame):
+        name = frame.json().get("name") or ""
+        try:
+            await asyncio.to_thread(storage.make_dir, name)
+        except ValueError as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+        await self.reply_ok(frame.request_id, f"Empty folder '{name}' created successfully.")
+        print(f"[UPLOAD_EMPTY] {self.addr} created empty folder '{name}'")
+
+    async def on_upload_status(self, frame):
+        # How much of this upload the server already holds, so a client can
+        # resume instead of starting over. The digest covers that prefix, and
+        # the client resumes with the upload id (other clients may have
+        # interrupted uploads of the same name).
+        args = frame.json()
+        try:
+            filepath = storage.resolve_entry(args.get("name") or "", args.get("sub"))
+            size = int(args.get("size", 0))
+        except ValueError as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+
+        def status():  # stats and reads, off the event loop
+            partial = storage.PartialUpload.find(filepath, size)
+            offset = partial.offset()
+            digest = checksums.file_digest(partial.part_path, offset) if offset else None
+            # The size of the copy already stored lets the client pick a delta upload.
+            existing = storage.stored_size(filepath) if os.path.isfile(filepath) else None
+            return partial, offset, digest, existing
+
+        partial, offset, digest, existing = await asyncio.to_thread(status)
+        await self.reply_ok(frame.request_id, offset=offset, digest=digest, existing_size=existing,
+                            upload_id=partial.upload_id if offset else None)
+
+    async def on_upload(self, frame):
+        # DATA frames follow the UPLOAD frame without waiting for a go-ahead.
+        # If the upload is refused here, those frames are dropped by the reader.
+        args = frame.json()
+        filename = args.get("name")
+        sub = args.get("sub")
+        filesize = int(args.get("size", 0))
+        offset = int(args.get("offset", 0))
+
+        try:
+            if not filename:
+                raise ValueError("Missing filename")
+            filepath = await asyncio.to_thread(storage.upload_path, filename, sub)
+            if not offset:
+                partial = storage.PartialUpload(filepath, filesize)
+            elif args.get("upload_id"):
+                partial = storage.PartialUpload(filepath, filesize, upload_id=args["upload_id"])
+            else:  # a client from before upload ids
+                partial = await asyncio.to_thread(storage.PartialUpload.find, filepath, filesize)
+            if offset and offset > await asyncio.to_thread(partial.offset):
+                raise ValueError(f"Cannot resume '{filename}' at byte {offset}")
+            decoder = compression.Decoder(args["codec"]) if args.get("codec") else None
+        except ValueError as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+        if args.get("delta"):
+            await self.upload_delta(frame, partial, args)
+            return
+
+        # Bytes land in the .part file; a dropped connection leaves it there
+        # for the client to resume, and only a complete file is renamed in.
+        # They are hashed as they arrive (after the prefix, when resuming).
+        hasher = (await asyncio.to_thread(checksums.file_hasher, partial.part_path, offset)
+                  if offset else checksums.new())
+        throttle = self.throttle(ratelimit.TRANSFER, ratelimit.RECV)
+        xfer = self.trace.transfer("upload", filename, filesize)
+        received = offset
+        wire = 0
+        # Disk work (opening and preallocating, writes that flush the
+        # buffer, the final flush) runs off the event loop.
+        f = await asyncio.to_thread(partial.open, offset)
+        overrun = False
+        try:
+            while received < filesize:
+                payload = await self.read_data(frame.request_id)
+                wire += len(payload)
+                xfer.mark("net", len(payload))
+                await ratelimit.async_pace(throttle, len(payload))
+                xfer.mark("wait")
+                data = payload
+                if decoder is not None:
+                    data = await asyncio.to_thread(decoder.decode, payload, filesize - received)
+                if received + len(data) > filesize:
+                    overrun = True
+                    break
+                await durable.async_write(f, data)
+                xfer.mark("disk")
+                hasher.update(data)
+                xfer.mark("cpu")
+                received += len(data)
+                self.reader.recycle(payload)  # written and hashed; nothing keeps it
+        finally:
+            await asyncio.to_thread(f.close)
+        metrics.add_bytes("in", wire)
+        if overrun:
+            await asyncio.to_thread(partial.discard)
+            await self.reply_err(frame.request_id, f"Upload of '{filename}' is longer than its "
+                                                   f"announced {filesize} bytes; upload discarded")
+            print(f"[UPLOAD] {self.addr} '{filename}': more data than the announced {filesize} bytes")
+            return
+        digest = hasher.hexdigest()
+
+        if args.get("verify"):
+            # The client sends END with the digest of what it read from disk.
+            expected = (await self.read_end(frame.request_id)).get("digest")
+            if expected != digest:
+                partial.discard()
+                await self.reply_err(frame.request_id, f"Checksum mismatch for '{filename}'; upload discarded")
+                print(f"[UPLOAD CORRUPT] {self.addr} '{filename}': got {digest}, client sent {expected}")
+                return
+        await asyncio.to_thread(_publish, partial, digest)  # chunking a large file takes a while
+        xfer.mark("disk")
+        xfer.finish(resumed_from=offset, wire_bytes=wire, codec=args.get("codec"))
+
+        await self.reply_ok(frame.request_id, f"File '{filename}' uploaded successfully.",
+                            size=received, resumed_from=offset, wire_bytes=wire, digest=digest)
+        print(f"[UPLOAD] {self.addr} uploaded '{filename}' ({received - offset} bytes"
+              f"{f', {wire} compressed with ' + args['codec'] if decoder else ''}"
+              f"{f', resumed at {offset}' if offset else ''}) to '{sub or '.'}'")
+
+    async def upload_delta(self, frame, partial, args):
+        # UPLOAD with "delta": send block signatures of the current copy (ACK
+        # + one DATA frame), then rebuild the new file from the client's
+        # COPY / LITERAL instructions (one per DATA frame) into the .part file.
+        filename = args["name"]
+        filesize = partial.size
+        try:
+            src = await asyncio.to_thread(storage.open_file, partial.final_path)
+        except (FileNotFoundError, IsADirectoryError):
+            src = None
+        try:
+            block = delta.block_size(storage.file_size(src) if src else 0)
+            signatures = await asyncio.to_thread(delta.signatures, src, block) if src else b""
+            await self.send_json(Op.ACK, frame.request_id,
+                                 {"block_size": block, "blocks": len(signatures) // delta.SIGNATURE.size})
+            if signatures:
+                await self.send(Op.DATA, frame.request_id, signatures)
+
+            hasher = checksums.new()
+            throttle = self.throttle(ratelimit.TRANSFER, ratelimit.RECV)
+            written = copied = 0
+            out = await asyncio.to_thread(partial.open)
+            try:
+                while written < filesize:
+                    data = await self.read_data(frame.request_id)
+                    await ratelimit.async_pace(throttle, len(data))
+                    instruction = delta.parse_instruction(data)
+                    if instruction[0] == "literal":
+                        data = instruction[1]
+                        if written + len(data) > filesize:
+                            raise ValueError("Delta is longer than the announced size")
+                        await durable.async_write(out, data)
+                        hasher.update(data)
+                        written += len(data)
+                    else:
+                        _, index, count = instruction
+                        length = count * block
+                        if src is None or written + length > filesize:
+                            raise ValueError("Bad delta COPY")
+                        n = await asyncio.to_thread(delta.copy_blocks, src, out, hasher, index * block, length)
+                        if n != length:
+                            raise ValueError("Delta COPY past the end of the stored file")
+                        written += n
+                        copied += n
+            finally:
+                await asyncio.to_thread(out.close)
+        finally:
+            if src is not None:
+                src.close()
+
+        metrics.add_bytes("in", written - copied)
+        if hasher.hexdigest() != args.get("digest"):
+            partial.discard()
+            raise ValueError(f"Rebuilt '{filename}' does not match the client's copy")
+        await asyncio.to_thread(_publish, partial, args["digest"])
+
+        await self.reply_ok(frame.request_id, f"File '{filename}' uploaded successfully.",
+                            size=written, copied=copied, literal=written - copied)
+        print(f"[UPLOAD] {self.addr} delta-uploaded '{filename}' ({written} bytes, {written - copied} "
+              f"sent, {copied} reused) to '{args.get('sub') or '.'}'")
+
+    async def on_upload_chunks(self, frame):
+        # Deduplicating upload (chunked backend only): the request lists the
+        # file's chunks, we answer ACK with the indexes of the chunks the store
+        # lacks, and the client sends just those, one chunk per DATA frame.
+        args = frame.json()
+        filename = args.get("name")
+        sub = args.get("sub")
+        try:
+            if not storage.chunked():
+                raise ValueError("Server is not using the chunked storage backend")
+            if not filename:
+                raise ValueError("Missing filename")
+            filesize = int(args.get("size", 0))
+            chunks = [(chunk_id, int(length)) for chunk_id, length in args.get("chunks", [])]
+            if not all(chunking.is_chunk_id(chunk_id) for chunk_id, _ in chunks):
+                raise ValueError("Bad chunk id")
+            if sum(length for _, length in chunks) != filesize:
+                raise ValueError("Chunk lengths do not add up to the file size")
+            filepath = await asyncio.to_thread(storage.upload_path, filename, sub)
+        except (ValueError, TypeError) as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+
+        store = storage.chunk_store()
+
+        def find_missing():  # one stat per chunk, off the event loop
+            missing, wanted = [], set()
+            for index, (chunk_id, _) in enumerate(chunks):
+                if chunk_id not in wanted and not store.has(chunk_id):
+                    wanted.add(chunk_id)
+                    missing.append(index)
+            return missing
+
+        missing = await asyncio.to_thread(find_missing)
+        await self.send_json(Op.ACK, frame.request_id, {"missing": missing})
+
+        throttle = self.throttle(ratelimit.TRANSFER, ratelimit.RECV)
+        sent = 0
+        for index in missing:
+            chunk_id, length = chunks[index]
+            data = await self.read_data(frame.request_id)
+            await ratelimit.async_pace(throttle, len(data))
+            if len(data) != length or chunking.chunk_id(data) != chunk_id:
+                raise ValueError(f"Chunk {index} of '{filename}' does not match its id")
+            await asyncio.to_thread(store.put, chunk_id, data)
+            sent += length
+        # The digest is taken of the assembled chunks, not trusted from the
+        # client: DOWNLOAD and VERIFY serve it as the file's true digest.
+        manifest = chunkstore.Manifest(filesize, chunks)
+
+        def assembled_digest():
+            with store.open(manifest) as f:
+                return checksums.stream_digest(f)
+
+        digest = await asyncio.to_thread(assembled_digest)
+        if args.get("digest") and args["digest"] != digest:
+            await self.reply_err(frame.request_id, f"Checksum mismatch for '{filename}'; upload discarded")
+            print(f"[UPLOAD CORRUPT] {self.addr} '{filename}': got {digest}, client sent {args['digest']}")
+            return
+        await asyncio.to_thread(store.write_manifest, filepath, manifest)
+        storage.invalidate(filepath)
+        await asyncio.to_thread(storage.record_digest, filepath, digest)
+        store.record_upload(filesize, sent)
+        metrics.add_bytes("in", sent)
+
+        await self.reply_ok(frame.request_id, f"File '{filename}' uploaded successfully.",
+                            size=filesize, sent=sent, reused=filesize - sent, digest=digest)
+        print(f"[UPLOAD] {self.addr} uploaded '{filename}' ({filesize} bytes, {sent} sent, "
+              f"{filesize - sent} deduplicated) to '{sub or '.'}'")
+
+    async def on_stats(self, frame):
+        stats = await asyncio.to_thread(storage.stats)  # stats the cache and index
+        await self.reply_ok(frame.request_id, storage.stats_text(stats), storage=stats)
+
+    async def on_upload_tree(self, frame):
+        # Bulk folder upload: one manifest, then every file's bytes back to
+        # back in one DATA stream (frames may span file boundaries), then one
+        # summary reply. With "verify" an END frame carries each file's digest
+        # (None for one that changed while the client read it) and only files
+        # that match are put in place.
+        args = frame.json()
+        root = args.get("root") or ""
+        try:
+            directories, targets = storage.plan_tree(root, args.get("dirs", []), args.get("files", []))
+        except (ValueError, TypeError) as e:
+            await self.reply_err(frame.request_id, f"Bad manifest: {e}")
+            return
+
+        start_time = time.perf_counter()
+        await asyncio.to_thread(storage.make_dirs, directories)
+
+        throttle = self.throttle(ratelimit.TRANSFER, ratelimit.RECV)
+        xfer = self.trace.transfer("upload_tree", root or ".", sum(size for _, size in targets))
+        verify = bool(args.get("verify"))
+        received = []  # (partial, digest) of files waiting for the client's digests
+        total = 0
+        view = memoryview(b"")
+        try:
+            for path, size in targets:
+                # Like UPLOAD, each file is received aside and renamed into place.
+                partial = storage.PartialUpload(path, size, resumable=False)
+                hasher = checksums.new()
+                f = await asyncio.to_thread(partial.open)
+                try:
+                    remaining = size
+                    while remaining:
+                        if not view:
+                            view = memoryview(await self.read_data(frame.request_id))
+                            xfer.mark("net", len(view))
+                            await ratelimit.async_pace(throttle, len(view))
+                            xfer.mark("wait")
+                        n = min(remaining, len(view))
+                        await durable.async_write(f, view[:n])
+                        xfer.mark("disk")
+                        hasher.update(view[:n])
+                        xfer.mark("cpu")
+                        view = view[n:]
+                        remaining -= n
+                except BaseException:
+                    await asyncio.to_thread(f.close)
+                    partial.discard()
+                    raise
+                if verify:
+                    await asyncio.to_thread(f.close)
+                    received.append((partial, hasher.hexdigest()))
+                else:
+                    # One trip to a worker thread per file for the close, the
+                    # rename and the digest sidecar; trees are often many small files.
+                    await asyncio.to_thread(_publish, partial, hasher.hexdigest(), f)
+                xfer.mark("disk")
+                total += size
+
+            discarded, dropped = [], 0
+            if verify:
+                expected = (await self.read_end(frame.request_id)).get("digests") or []
+                for i, (partial, digest) in enumerate(received):
+                    if i >= len(expected) or expected[i] != digest:
+                        discarded.append(i)
+                        dropped += partial.size
+                await asyncio.to_thread(_publish_tree, received, set(discarded))
+                received = []
+                xfer.mark("disk")
+        finally:
+            for partial, _ in received:
+                partial.discard()
+
+        metrics.add_bytes("in", total)
+        xfer.finish(files=len(targets))
+        duration = time.perf_counter() - start_time
+        files = len(targets) - len(discarded)
+        names = [args["files"][i][0] for i in discarded]
+        await self.reply_ok(frame.request_id, f"Folder '{root}' uploaded successfully.",
+                            files=files, dirs=len(directories), bytes=total - dropped, seconds=duration,
+                            discarded=names)
+        print(f"[UPLOAD_TREE] {self.addr} uploaded {files} files ({total - dropped} bytes) "
+              f"into {len(directories)} folders under '{root or '.'}' in {duration:.2f}s"
+              f"{f', discarded {len(names)} that changed on the client' if names else ''}")
+
+    async def on_download(self, frame):
+        args = frame.json()
+        filename = args.get("name")
+        if not filename:
+            await self.reply_err(frame.request_id, "Missing filename")
+            return
+        try:
+            filepath = storage.resolve(filename)
+            # A cache miss may read the whole file into the cache.
+            f = await asyncio.to_thread(storage.open_file, filepath)
+        except ValueError as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+        except (FileNotFoundError, IsADirectoryError):
+            await self.reply_err(frame.request_id, "File not found.")
+            return
+
+        with f:
+            filesize = storage.file_size(f)
+            digest = await asyncio.to_thread(storage.stored_digest, filepath)
+
+            offset = int(args.get("offset", 0))
+            if "length" in args:
+                # Ranged download (one stripe of a striped download): send
+                # `length` bytes from `offset`, clipped to the end of the file.
+                if offset < 0 or offset > filesize or int(args["length"]) < 0:
+                    await self.reply_err(frame.request_id, f"Range outside '{filename}' ({filesize} bytes)")
+                    return
+                end = min(filesize, offset + int(args["length"]))
+            else:
+                # Resume: the client holds `offset` bytes already; trust them
+                # only if their digest matches our copy, otherwise start from zero.
+                end = filesize
+                if offset:
+                    f.seek(0)
+                    if (offset > filesize or args.get("prefix_digest") !=
+                            await asyncio.to_thread(checksums.stream_digest, f, offset)):
+                        offset = 0
+
+            # Compress if the client accepts a codec and a sample of the
+            # content is worth it; otherwise the bytes go out raw (sendfile).
+            codec = None
+            if config.COMPRESSION and args.get("accept") and end > offset:
+                sample = await asyncio.to_thread(transfer.read_chunk, f, offset, compression.SAMPLE_SIZE)
+                codec = compression.choose(sample, args["accept"])
+
+            # The client checks what it receives against the stored digest.
+            # With none stored yet, a whole-file send whose bytes pass through
+            # memory anyway (compressed or cached) hashes them on the way out
+            # and reports the digest in END instead.
+            hasher = None
+            if digest is None and offset == 0 and end == filesize and (
+                    codec is not None or hasattr(f, "buffer")):
+                hasher = checksums.new()
+
+            await self.reply_ok(frame.request_id, size=filesize, offset=offset, length=end - offset,
+                                codec=codec, digest=digest)
+            print(f"[SEND] Sending '{filename}' ({end - offset} bytes from {offset}"
+                  f"{', ' + codec if codec else ''}) to {self.addr}")
+
+            start_time = time.perf_counter()
+            throttle = self.throttle(ratelimit.TRANSFER, ratelimit.SEND)
+            xfer = self.trace.transfer("download", filename, end - offset)
+            sent = offset
+            if codec is not None:
+                encoder = compression.Encoder(codec)
+                mode = codec
+                with buffers.lease(encoder.codec.chunk_size) as buf:
+                    while sent < end:
+                        n = await asyncio.to_thread(transfer.read_chunk_into, f, sent,
+                                                    buf[:min(encoder.codec.chunk_size, end - sent)])
+                        xfer.mark("disk")
+                        if not n:
+                            raise ConnectionError(f"'{filename}' changed size while being sent")
+                        if hasher is not None:
+                            hasher.update(buf[:n])
+                        data = await asyncio.to_thread(encoder.encode, buf[:n])
+                        xfer.mark("cpu")
+                        await ratelimit.async_pace(throttle, len(data))
+                        xfer.mark("wait")
+                        await self.send(Op.DATA, frame.request_id, data)
+                        xfer.mark("net", n)
+                        sent += n
+            else:
+                mode = transfer.MODE_SENDFILE
+                while sent < end:
+                    count = min(config.FRAME_DATA_SIZE, end - sent)
+                    # Wait for tokens before taking the send lock, and hold it
+                    # per frame only, so other streams and control frames
+                    # interleave.
+                    await ratelimit.async_pace(throttle, count)
+                    xfer.mark("wait")
+                    try:
+                        async with self.send_lock.hold():
+                            await self.loop.sock_sendall(self.conn, framing.pack_header(Op.DATA, frame.request_id, count))
+                            n, mode = await transfer.async_send_file(self.loop, self.conn, f, sent, count)
+                    except OSError as e:
+                        raise ConnectionError(f"Sending '{filename}' failed: {e}") from e
+                    xfer.mark("net", n)  # sendfile: disk and network in one call
+                    if n != count:
+                        # The frame header already promised `count` bytes.
+                        raise ConnectionError(f"'{filename}' changed size while being sent")
+                    if hasher is not None:
+                        hasher.update(f.buffer[sent:sent + n])
+                        xfer.mark("cpu")
+                    sent += n
+
+        xfer.finish(mode=mode, offset=offset)
+        stats = transfer.record_transfer("download", filename, self.addr, sent - offset,
+                                         time.perf_counter() - start_time, mode)
+        end_fields = {"size": sent}
+        if hasher is not None:
+            end_fields["digest"] = hasher.hexdigest()
+            await asyncio.to_thread(storage.record_digest, filepath, end_fields["digest"])
+        await self.send_json(Op.END, frame.request_id, end_fields)
+        print(f"[SENT] '{filename}' sent successfully to {self.addr} ({sent - offset} bytes, "
+              f"{mode}, {stats['mbps']:.2f} MB/s)")
+
+    async def on_verify(self, frame):
+        """Digest of a stored file, from its metadata or (once) by reading it.
+
+        With a "digest" argument the reply also says whether it matches.
+        """
+        args = frame.json()
+        filename = args.get("name")
+        if not filename:
+            await self.reply_err(frame.request_id, "Missing filename")
+            return
+        try:
+            filepath = storage.resolve(filename)
+            size = await asyncio.to_thread(storage.stored_size, filepath)
+        except ValueError as e:
+            await self.reply_err(frame.request_id, str(e))
+            return
+        except (FileNotFoundError, IsADirectoryError):
+            await self.reply_err(frame.request_id, "File not found.")
+            return
+
+        digest, computed = await asyncio.to_thread(storage.verify, filepath)
+        fields = {"digest": digest, "algorithm": checksums.ALGORITHM, "size": size, "computed": computed}
+        message = f"'{filename}' {checksums.ALGORITHM} {digest}"
+        if args.get("digest"):
+            fields["match"] = args["digest"] == digest
+            message = f"'{filename}' {'matches' if fields['match'] else 'DIFFERS FROM'} the given digest"
+        await self.reply_ok(frame.request_id, message, **fields)
+
+    async def on_throughput(self, frame):
+        # Timed test: THROUGHPUT {direction: up|down|both, frame_size,
+        # seconds[, interval]} -> OK "READY". "up": the client sends DATA
+        # frames for `seconds`, then END. "down": we send DATA frames for
+        # `seconds`. "both" does the two at once. The final OK has, per
+        # direction, the payload bytes, the duration and the bytes moved in
+        # each `interval`, plus the server's CPU time over the test.
+        # Without "direction" it is the older batched upload test.
+        args = frame.json()
+        if "direction" not in args:
+            await self.throughput_batches(frame, args)
+            return
+        try:
+            direction = args["direction"]
+            if direction not in ("up", "down", "both"):
+                raise ValueError(f"unknown direction '{direction}'")
+            frame_size = int(args.get("frame_size", 1048576))
+            if not config.THROUGHPUT_MIN_FRAME <= frame_size <= config.THROUGHPUT_MAX_FRAME:
+                raise ValueError(f"frame_size must be {config.THROUGHPUT_MIN_FRAME} to "
+                                 f"{config.THROUGHPUT_MAX_FRAME} bytes")
+            seconds = float(args.get("seconds", 10))
+            if not 0 < seconds <= config.THROUGHPUT_MAX_SECONDS:
+                raise ValueError(f"seconds must be above 0 and at most {config.THROUGHPUT_MAX_SECONDS}")
+            interval = max(0.1, float(args.get("interval", 1.0)))
+        except (ValueError, TypeError) as e:
+            await self.reply_err(frame.request_id, f"Invalid parameters: {e}")
+            return
+
+        print(f"[THROUGHPUT] Starting {direction} test: {frame_size}B frames for {seconds:g}s from {self.addr}")
+        await self.reply_ok(frame.request_id, "READY", frame_size=frame_size, seconds=seconds)
+        xfer = self.trace.transfer("throughput", f"{direction} {frame_size}B x {seconds:g}s")
+        cpu_start, thread_start, started = time.process_time(), time.thread_time(), time.perf_counter()
+        result = {}
+        sender = None
+        if direction != "up":
+            sender = self.loop.create_task(self.throughput_send(frame.request_id, frame_size, seconds,
+                                                                interval, xfer))
+        try:
+            if direction != "down":
+                result["up"] = await self.throughput_recv(frame.request_id, interval, xfer)
+            if sender is not None:
+                result["down"] = await sender
+        finally:
+            if sender is not None:
+                sender.cancel()
+
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_start
+        # thread_time is this connection alone under the threaded engine, and
+        # the whole event loop under the asyncio engine.
+        result["cpu"] = {"process_s": cpu, "thread_s": time.thread_time() - thread_start,
+                         "percent": cpu / wall * 100 if wall > 0 else 0.0}
+        xfer.finish(direction=direction, frame_size=frame_size)
+        await self.reply_ok(frame.request_id, **result)
+        for name, r in result.items():
+            if name != "cpu":
+                print(f"[THROUGHPUT] {name}: {r['bytes']:,} bytes in {r['seconds']:.2f}s = "
+                      f"{r['bytes'] / 1_048_576 / r['seconds']:.2f} MB/s ({frame_size}B frames, {self.addr})")
+
+    async def throughput_recv(self, request_id: int, interval: float, xfer) -> dict:
+        """Count DATA frames until the client's END."""
+        throttle = self.throttle(ratelimit.THROUGHPUT, ratelimit.RECV)
+        samples = metrics.RateSamples(interval)
+        while True:
+            frame = await self.next_frame(request_id)
+            if frame.op == Op.END:
+                break
+            if frame.op != Op.DATA:
+                raise framing.ProtocolError(f"Expected DATA, got {framing.op_name(frame.op)}")
+            n = len(frame.payload)
+            self.reader.recycle(frame.payload)  # only counted; the next frame reuses it
+            samples.add(n)
+            xfer.mark("net", n)
+            await ratelimit.async_pace(throttle, n)
+            xfer.mark("wait")
+        metrics.add_bytes("in", samples.total)
+        return samples.summary()
+
+    async def throughput_send(self, request_id: int, frame_size: int, seconds: float,
+                              interval: float, xfer) -> dict:
+        """Send DATA frames of frame_size for `seconds`, from one preallocated block."""
+        throttle = self.throttle(ratelimit.THROUGHPUT, ratelimit.SEND)
+        # Small frames go out several to a send call, so what is measured is
+        # the framing and the network, not one event loop round trip per KB.
+        count = max(1, config.FRAME_DATA_SIZE // frame_size)
+        block = framing.pack_frame(Op.DATA, request_id, bytes(frame_size)) * count
+        samples = metrics.RateSamples(interval)
+        deadline = samples.started + seconds
+        try:
+            while time.perf_counter() < deadline:
+                await ratelimit.async_pace(throttle, count * frame_size)
+                xfer.mark("wait")
+                try:
+                    async with self.send_lock.hold():
+                        await self.loop.sock_sendall(self.conn, block)
+                except OSError as e:
+                    raise ConnectionError(f"Throughput test send failed: {e}") from e
+                samples.add(count * frame_size)
+                xfer.mark("net", count * frame_size)
+        finally:
+            metrics.add_bytes("out", samples.total)
+        return samples.summary()
+
+    async def throughput_batches(self, frame, args):
+        try:
+            frames = int(args["frames"])
+            batches = int(args["batches"])
+        except (KeyError, ValueError) as e:
+            await self.reply_err(frame.request_id, f"Invalid parameters: {e}")
+            return
+
+        frame_size = int(args.get("frame_size", 1024))
+        total_bytes = frame_size * frames * batches
+        print(f"[THROUGHPUT] Starting test: {frames} x {frame_size}B x {batches} batches = "
+              f"{total_bytes/1_048_576:.2f}MB from {self.addr}")
+        await self.reply_ok(frame.request_id, "READY")
+
+        received_total = 0
+        start_time = time.time()
+        throttle = self.throttle(ratelimit.THROUGHPUT, ratelimit.RECV)
+        xfer = self.trace.transfer("throughput", f"{frames} x {frame_size}B x {batches}", total_bytes)
+        for batch in range(1, batches + 1):
+            batch_received = 0
+            for _ in range(frames):
+                batch_received += len(await self.read_data(frame.request_id))
+            received_total += batch_received
+            xfer.mark("net", batch_received)
+            await ratelimit.async_pace(throttle, batch_received)
+            xfer.mark("wait")
+            await self.send_json(Op.ACK, frame.request_id, {"batch": batch})
+            xfer.mark("net")
+
+        duration = time.time() - start_time
+        xfer.finish()
+        metrics.add_bytes("in", received_total)
+        mbps = (received_total / 1_048_576) / duration if duration > 0 else 0
+        await self.reply_ok(frame.request_id, bytes=received_total, seconds=duration, mbps=mbps)
+        print(f"[THROUGHPUT] Complete: {received_total:,} bytes ({received_total/1_048_576:.2f}MB) "
+              f"in {duration:.2f}s = {mbps:.2f} MB/s")
+
+    HANDLERS = {
+        Op.PING: on_ping,
+        Op.HELP: on_help,
+        Op.DIR: on_dir,
+        Op.DELETE: on_delete,
+        Op.UPLOAD_EMPTY: on_upload_empty,
+        Op.UPLOAD: on_upload,
+        Op.UPLOAD_STATUS: on_upload_status,
+        Op.UPLOAD_TREE: on_upload_tree,
+        Op.UPLOAD_CHUNKS: on_upload_chunks,
+        Op.DOWNLOAD: on_download,
+        Op.THROUGHPUT: on_throughput,
+        Op.STATS: on_stats,
+        Op.VERIFY: on_verify,
+    }
+
+
+def _publish(partial, digest: str, writer=None):
+    """Rename a finished upload into place and record its digest (closing
+    its .part file first, if still open). Blocks on the disk."""
+    if writer is not None:
+        writer.close()
+    partial.commit()
+    storage.record_digest(partial.final_path, digest)
+
+
+def _publish_tree(received, discarded):
+    """Put the files of an UPLOAD_TREE in place, except the indexes in
+    discarded, which are thrown away. Blocks on the disk."""
+    for i, (partial, digest) in enumerate(received):
+        if i in discarded:
+            partial.discard()
+        else:
+            _publish(partial, digest)
+
+
+class _SharedExecutor(ThreadPoolExecutor):
+    """A pool that event loops borrow as their default executor.
+
+    A loop shuts its default executor down when it closes; this one stays up
+    for the other loops (its threads end with the process).
+    """
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        pass
+
+
+_io_executor = None
+_io_lock = threading.Lock()
+
+
+def io_executor() -> ThreadPoolExecutor:
+    """The process-wide pool of config.IO_WORKERS threads behind asyncio.to_thread."""
+    global _io_executor
+    with _io_lock:
+        if _io_executor is None:
+            _io_executor = _SharedExecutor(max_workers=config.IO_WORKERS, thread_name_prefix="io")
+        return _io_executor
+
+
+def serve_blocking(conn, addr, initial: bytes = b"", ticket=None, trace=tracing.NULL):
+    """Run a framed session to completion on the calling (client) thread."""
+    async def _run():
+        # Without this every connection's loop would start a default
+        # executor of its own, and the thread count would grow with clients.
+        asyncio.get_running_loop().set_default_executor(io_executor())
+        await FramedSession(conn, addr, initial, ticket, trace).run()
+    asyncio.run(_run())
@@ -0,0 +1,120 @@
+# index.py
+# In-memory metadata index of the storage tree behind DIR.
+#
+# Each directory's entries (name, type, size, mtime) are scanned once with
+# os.scandir and kept, tagged with the directory's own mtime. A listing then
+# costs one stat() per directory instead of a listdir() plus an isdir() per
+# entry; if the mtime moved (something was added, removed or renamed, by us
+# or behind our back) only that directory is rescanned. In-place changes
+# that don't touch the directory's mtime (a file rewritten by UPLOAD_TREE,
+# a new chunked manifest) are applied through refresh(), which storage calls
+# for every write and delete.
+import os
+import stat
+import threading
+from typing import NamedTuple
+
+
+class Entry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+
+
+class MetadataIndex:
+    def __init__(self, root: str, skip: str, file_size):
+        self.root = os.path.abspath(root)
+        self.skip = skip            # name hidden at the top level
+        self.file_size = file_size  # (path, stat_result) -> size reported for a file
+        self._dirs = {}             # relative dir ("" = root) -> (dir mtime_ns, {name: Entry})
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.hits = 0
+
+    def _abs(self, rel: str) -> str:
+        return os.path.join(self.root, *rel.split("/")) if rel else self.root
+
+    def _rel(self, path: str) -> str:
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        return "" if rel == "." else rel.replace(os.sep, "/")
+
+    def _entry(self, path: str, name: str, st) -> Entry:
+        if stat.S_ISDIR(st.st_mode):
+            return Entry(name, True, 0, st.st_mtime)
+        return Entry(name, False, self.file_size(path, st), st.st_mtime)
+
+    def _load(self, rel: str) -> dict:
+        """Entries of directory rel, rescanning it only if it changed. Lock held."""
+        path = self._abs(rel)
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(rel)
+        cached = self._dirs.get(rel)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            self.hits += 1
+            return cached[1]
+
+        entries = {}
+        with os.scandir(path) as it:
+            for item in it:
+                if not rel and item.name == self.skip:
+                    continue
+                try:
+                    entries[item.name] = self._entry(item.path, item.name, item.stat())
+                except FileNotFoundError:
+                    continue  # removed while we scanned
+        self._dirs[rel] = (st.st_mtime_ns, entries)
+        self.scans += 1
+        return entries
+
+    def entries(self, rel: str = "") -> list:
+        """Sorted entries of one directory."""
+        with self._lock:
+            return sorted(self._load(rel).values())
+
+    def walk(self, rel: str = "", recursive: bool = False) -> list:
+        """[(relative path, Entry)] under rel, folders listed before their contents."""
+        out = []
+        with self._lock:
+            pending = [rel]
+            while pending:
+                current = pending.pop(0)
+                for entry in sorted(self._load(current).values()):
+                    path = f"{current}/{entry.name}" if current else entry.name
+                    out.append((path, entry))
+                    if recursive and entry.is_dir:
+                        pending.append(path)
+        return out
+
+    def refresh(self, path: str):
+        """Bring the entry for path (and, if it is gone, its subtree) up to date."""
+        rel = self._rel(path)
+        if not rel:
+            return
+        parent, _, name = rel.rpartition("/")
+        with self._lock:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None or stat.S_ISDIR(st.st_mode):
+                # Its cached listing (if any) is rebuilt on next use.
+                for cached in [d for d in self._dirs if d == rel or d.startswith(rel + "/")]:
+                    del self._dirs[cached]
+            cached = self._dirs.get(parent)
+            if cached is None:
+                return
+            if st is None:
+                cached[1].pop(name, None)
+            else:
+                cached[1][name] = self._entry(path, name, st)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "directories": len(self._dirs),
+                "entries": sum(len(entries) for _, entries in self._dirs.values()),
+                "scans": self.scans,
+                "hits": self.hits,
+            }
@@ -0,0 +1,289 @@
+# metrics.py
+# Server metrics: per-command counters and latency histograms, bytes in and
+# out, commands in flight and time spent on disk I/O.
+#
+# Everything lives in process memory and costs a lock and a few additions
+# per event. STATS shows a summary, and serve_prometheus() publishes the
+# lot in the Prometheus text format on a local port (--metrics-port), so
+# throughput and p99 latency can be graphed instead of grepped from stdout.
+#
+# Latencies go into log-linear histograms in the style of HdrHistogram:
+# each power of two of microseconds is split into SUB_BUCKETS linear
+# buckets, so any recorded value is known to within 1/SUB_BUCKETS (about 6%)
+# from 1 us up to hours, in a few hundred counters.
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+
+# Command names used as labels. Anything else is counted as UNKNOWN, so a
+# client can't create label values at will.
+COMMANDS = frozenset((
+    "PING", "THROUGHPUT", "LOGOUT", "HELP", "DIR", "STATS", "VERIFY", "UPLOAD", "UPLOAD_EMPTY",
+    "UPLOAD_STATUS", "UPLOAD_TREE", "UPLOAD_CHUNKS", "DOWNLOAD", "DELETE",
+))
+TRANSFER_COMMANDS = frozenset(("UPLOAD", "UPLOAD_TREE", "UPLOAD_CHUNKS", "DOWNLOAD", "THROUGHPUT"))
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# Prometheus histogram bucket bounds (seconds), filled from the finer HDR buckets.
+EXPORT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """Log-linear histogram of durations, recorded in whole microseconds."""
+
+    def __init__(self):
+        self.counts = [0] * (2 * SUB_BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def index(us: int) -> int:
+        if us < SUB_BUCKETS:
+            return us
+        exponent = us.bit_length() - SUB_BITS - 1
+        return (exponent + 1) * SUB_BUCKETS + (us >> exponent) - SUB_BUCKETS
+
+    @staticmethod
+    def upper_bound(index: int) -> float:
+        """Upper end (seconds, exclusive) of bucket `index`."""
+        if index < SUB_BUCKETS:
+            return (index + 1) / 1e6
+        exponent = index // SUB_BUCKETS - 1
+        return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << exponent) / 1e6
+
+    def record(self, seconds: float):
+        i = self.index(max(0, int(seconds * 1e6)))
+        with self._lock:
+            if i >= len(self.counts):
+                self.counts.extend([0] * (i + 1 - len(self.counts)))
+            self.counts[i] += 1
+            self.total += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self) -> "Histogram":
+        copy = Histogram()
+        with self._lock:
+            copy.counts, copy.total, copy.sum, copy.max = list(self.counts), self.total, self.sum, self.max
+        return copy
+
+    def quantile(self, q: float) -> float:
+        """The q-quantile in seconds (to bucket precision); 0.0 if empty."""
+        if not self.total:
+            return 0.0
+        rank = max(1, math.ceil(q * self.total))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.upper_bound(i), self.max)
+        return self.max
+
+    def cumulative(self, bounds) -> list:
+        """Counts of values <= each bound (Prometheus buckets)."""
+        result, seen, i = [], 0, 0
+        for bound in bounds:
+            while i < len(self.counts) and self.upper_bound(i) <= bound:
+                seen += self.counts[i]
+                i += 1
+            result.append(seen)
+        return result
+
+
+class RateSamples:
+    """Bytes counted per `interval` seconds since `started`: a throughput time series."""
+
+    def __init__(self, interval: float = 1.0, started: float = None):
+        self.interval = interval
+        self.started = time.perf_counter() if started is None else started
+        self.counts = []
+        self.total = 0
+
+    def add(self, n: int):
+        i = int((time.perf_counter() - self.started) / self.interval)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += n
+        self.total += n
+
+    def summary(self) -> dict:
+        seconds = time.perf_counter() - self.started
+        return {"bytes": self.total, "seconds": seconds, "interval": self.interval,
+                "samples": list(self.counts)}
+
+
+_lock = threading.Lock()
+_commands = {}       # name -> {"count", "errors", "in_flight"}
+_latency = {}        # name -> Histogram
+_bytes = {"in": 0, "out": 0}
+_disk = {}           # op -> {"count", "seconds", "bytes"}
+_started = time.time()
+
+
+def command_name(name: str) -> str:
+    name = name.upper()
+    return name if name in COMMANDS else "UNKNOWN"
+
+
+def command_started(name: str) -> float:
+    """Count a command as in flight; pass the result to command_finished()."""
+    with _lock:
+        entry = _commands.get(name)
+        if entry is None:
+            entry = _commands[name] = {"count": 0, "errors": 0, "in_flight": 0}
+            _latency[name] = Histogram()
+        entry["in_flight"] += 1
+    return time.perf_counter()
+
+
+def command_finished(name: str, started: float, ok: bool = True):
+    seconds = time.perf_counter() - started
+    with _lock:
+        entry = _commands[name]
+        entry["in_flight"] -= 1
+        entry["count"] += 1
+        if not ok:
+            entry["errors"] += 1
+        histogram = _latency[name]
+    histogram.record(seconds)
+
+
+def add_bytes(direction: str, n: int):
+    """Payload bytes received ("in") or sent ("out") by a transfer."""
+    with _lock:
+        _bytes[direction] += n
+
+
+def disk_time(op: str, seconds: float, nbytes: int = 0):
+    """Time spent in a disk read, write or fsync."""
+    with _lock:
+        entry = _disk.get(op)
+        if entry is None:
+            entry = _disk[op] = {"count": 0, "seconds": 0.0, "bytes": 0}
+        entry["count"] += 1
+        entry["seconds"] += seconds
+        entry["bytes"] += nbytes
+
+
+def snapshot() -> dict:
+    with _lock:
+        commands = {name: dict(entry) for name, entry in _commands.items()}
+        histograms = dict(_latency)
+        result = {
+            "uptime_s": time.time() - _started,
+            "bytes_in": _bytes["in"],
+            "bytes_out": _bytes["out"],
+            "disk": {op: dict(entry) for op, entry in _disk.items()},
+        }
+    for name, entry in commands.items():
+        h = histograms[name].snapshot()
+        entry.update({f"p{q * 100:g}_ms": h.quantile(q) * 1000 for q in QUANTILES},
+                     mean_ms=h.sum / h.total * 1000 if h.total else 0.0, max_ms=h.max * 1000)
+    result["commands"] = commands
+    result["active_transfers"] = sum(entry["in_flight"] for name, entry in commands.items()
+                                     if name in TRANSFER_COMMANDS)
+    return result
+
+
+def stats_lines() -> list:
+    """The metrics part of the STATS response."""
+    s = snapshot()
+    lines = [f"Traffic: {s['bytes_in']:,} bytes in, {s['bytes_out']:,} bytes out, "
+             f"{s['active_transfers']} active transfers"]
+    for name, c in sorted(s["commands"].items()):
+        lines.append(f"Command {name}: {c['count']} done ({c['errors']} failed, {c['in_flight']} running), "
+                     f"p50 {c['p50_ms']:.2f} ms, p99 {c['p99_ms']:.2f} ms, max {c['max_ms']:.2f} ms")
+    for op, d in sorted(s["disk"].items()):
+        lines.append(f"Disk {op}: {d['count']} calls, {d['seconds']:.3f}s, {d['bytes']:,} bytes")
+    return lines
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+
+
+def prometheus_text(extra: dict = None) -> str:
+    """All metrics in the Prometheus text exposition format.
+
+    extra: {"name": (type, help, [(labels dict, value), ...])} of further
+    gauges and counters, e.g. from storage.stats().
+    """
+    s = snapshot()
+    with _lock:
+        histograms = {name: h.snapshot() for name, h in _latency.items()}
+    out = []
+
+    def family(name, kind, help_text, samples):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            out.append(f"{name}{_labels(**labels)} {value}")
+
+    commands = sorted(s["commands"].items())
+    family("fileshare_commands_total", "counter", "Commands completed.",
+           [({"command": n}, c["count"]) for n, c in commands])
+    family("fileshare_command_errors_total", "counter", "Commands that failed.",
+           [({"command": n}, c["errors"]) for n, c in commands])
+    family("fileshare_commands_in_flight", "gauge", "Commands being handled.",
+           [({"command": n}, c["in_flight"]) for n, c in commands])
+    family("fileshare_active_transfers", "gauge", "Uploads, downloads and throughput tests in progress.",
+           [({}, s["active_transfers"])])
+
+    out.append("# HELP fileshare_command_duration_seconds Time to handle a command.")
+    out.append("# TYPE fileshare_command_duration_seconds histogram")
+    for name, h in sorted(histograms.items()):
+        for bound, count in zip(EXPORT_BOUNDS, h.cumulative(EXPORT_BOUNDS)):
+            out.append(f'fileshare_command_duration_seconds_bucket{{command="{name}",le="{bound:g}"}} {count}')
+        out.append(f'fileshare_command_duration_seconds_bucket{{command="{name}",le="+Inf"}} {h.total}')
+        out.append(f'fileshare_command_duration_seconds_sum{{command="{name}"}} {h.sum}')
+        out.append(f'fileshare_command_duration_seconds_count{{command="{name}"}} {h.total}')
+    family("fileshare_command_duration_quantile_seconds", "gauge",
+           "Command latency quantiles since start (from the HDR histograms).",
+           [({"command": name, "quantile": f"{q:g}"}, h.quantile(q))
+            for name, h in sorted(histograms.items()) for q in QUANTILES])
+
+    family("fileshare_transfer_bytes_total", "counter", "Payload bytes moved by transfers.",
+           [({"direction": "in"}, s["bytes_in"]), ({"direction": "out"}, s["bytes_out"])])
+    disk = sorted(s["disk"].items())
+    family("fileshare_disk_seconds_total", "counter", "Time spent in disk I/O.",
+           [({"op": op}, d["seconds"]) for op, d in disk])
+    family("fileshare_disk_operations_total", "counter", "Disk I/O calls timed.",
+           [({"op": op}, d["count"]) for op, d in disk])
+    family("fileshare_disk_bytes_total", "counter", "Bytes read or written by timed disk I/O.",
+           [({"op": op}, d["bytes"]) for op, d in disk])
+    family("fileshare_uptime_seconds", "gauge", "Seconds since the server started.", [({}, s["uptime_s"])])
+
+    for name, (kind, help_text, samples) in sorted((extra or {}).items()):
+        family(name, kind, help_text, samples)
+    return "\n".join(out) + "\n"
+
+
+def serve_prometheus(host: str, port: int, extra=None):
+    """Serve GET /metrics on a daemon thread. extra() -> prometheus_text()'s extra."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text(extra() if extra else None).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # scrapes every few seconds would drown the server log
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics on http://{host}:{httpd.server_address[1]}/metrics")
+    return httpd
@@ -0,0 +1,183 @@
+# ratelimit.py
+# Bandwidth shaping for bulk transfers with token buckets.
+#
+# Every byte a transfer moves is charged to up to three buckets per direction
+# (SEND = server to client, RECV = client to server): the global one shared
+# by all clients, the one shared by all connections of the logged-in user,
+# and the one shared by all transfers of a command class (TRANSFER for
+# UPLOAD/DOWNLOAD, THROUGHPUT for the throughput test). A bucket may go into
+# debt; the caller then sleeps until it is paid off, so concurrent transfers
+# queue up in the order they asked and share the rate evenly. Waiting always
+# happens between chunks and never while a lock is held.
+#
+# Control messages (PING, DIR, HELP, STATS, replies) are never charged and
+# never wait. On a framed connection they also jump ahead of queued DATA
+# frames (PriorityLock), so a shaped download cannot delay its own PONGs.
+import asyncio
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+import config
+
+SEND, RECV = "send", "recv"
+TRANSFER, THROUGHPUT = "transfer", "throughput"
+CLASSES = (TRANSFER, THROUGHPUT)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate      # bytes per second
+        self.burst = burst    # most bytes that may go out back to back
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> float:
+        """Take n bytes' worth of tokens; the seconds to wait before sending them."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Shaper:
+    """All buckets, created from the config limits on first use."""
+
+    def __init__(self, global_rate: float, user_rate: float, class_rates: dict, burst_seconds: float):
+        self.global_rate = global_rate
+        self.user_rate = user_rate
+        self.class_rates = {cls: rate for cls, rate in class_rates.items() if rate}
+        self.burst_seconds = burst_seconds
+        self._buckets = {}   # (scope, name, direction) -> TokenBucket
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.waited = 0.0
+        self.shaped_bytes = collections.Counter()  # direction -> bytes charged
+
+    def limited(self, username) -> bool:
+        return bool(self.global_rate or self.class_rates or (self.user_rate and username))
+
+    def _bucket(self, scope: str, name, direction: str, rate: float) -> TokenBucket:
+        key = (scope, name, direction)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    # At least one chunk's worth, or a bucket could never pay for it.
+                    burst = max(rate * self.burst_seconds, config.CHUNK_SIZE)
+                    bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def reserve(self, username, cls: str, direction: str, n: int) -> float:
+        delay = 0.0
+        if self.global_rate:
+            delay = self._bucket("global", None, direction, self.global_rate).reserve(n)
+        if self.user_rate and username:
+            delay = max(delay, self._bucket("user", username, direction, self.user_rate).reserve(n))
+        rate = self.class_rates.get(cls)
+        if rate:
+            delay = max(delay, self._bucket("class", cls, direction, rate).reserve(n))
+        with self._stats_lock:
+            self.shaped_bytes[direction] += n
+            if delay > 0:
+                self.waits += 1
+                self.waited += delay
+        return delay
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "global_rate": self.global_rate,
+                "user_rate": self.user_rate,
+                "class_rates": dict(self.class_rates),
+                "waits": self.waits,
+                "waited_s": self.waited,
+                "sent_bytes": self.shaped_bytes[SEND],
+                "received_bytes": self.shaped_bytes[RECV],
+            }
+
+
+class PriorityLock:
+    """An asyncio lock that hands itself to urgent waiters before bulk ones."""
+
+    def __init__(self):
+        self._locked = False
+        self._urgent = collections.deque()
+        self._bulk = collections.deque()
+
+    async def acquire(self, urgent: bool = False):
+        if not self._locked and not self._urgent and not self._bulk:
+            self._locked = True
+            return
+        queue = self._urgent if urgent else self._bulk
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # handed the lock just as we were cancelled
+            elif waiter in queue:
+                queue.remove(waiter)
+            raise
+
+    def release(self):
+        # Ownership passes straight to the next waiter, so nobody can barge in.
+        for queue in (self._urgent, self._bulk):
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._locked = False
+
+    @contextlib.asynccontextmanager
+    async def hold(self, urgent: bool = False):
+        await self.acquire(urgent)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_shaper = None
+_shaper_lock = threading.Lock()
+
+
+def shaper() -> Shaper:
+    global _shaper
+    with _shaper_lock:
+        if _shaper is None:
+            _shaper = Shaper(config.RATE_LIMIT, config.RATE_LIMIT_PER_USER, config.RATE_LIMIT_CLASSES,
+                             config.RATE_BURST)
+        return _shaper
+
+
+def throttle(username, cls: str, direction: str):
+    """A throttle(n) -> seconds callable for one transfer, or None if nothing limits it."""
+    s = shaper()
+    if not s.limited(username):
+        return None
+    return functools.partial(s.reserve, username, cls, direction)
+
+
+def pace(throttle, n: int):
+    """Charge n bytes and sleep as long as the buckets say (blocking)."""
+    if throttle is not None:
+        delay = throttle(n)
+        if delay > 0:
+            time.sleep(delay)
+
+
+async def async_pace(throttle, n: int):
+    if throttle is not None:
+        delay = throttle(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
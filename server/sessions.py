@@ -0,0 +1,103 @@
+# sessions.py
+# Session tokens: reconnect without sending the password again.
+#
+# A successful LOGIN issues a random token that stands for the user until it
+# expires. A client that reconnects (after a drop, or to open extra
+# connections for a striped download) presents the token instead, which
+# skips password verification entirely. Each connection gets its own token,
+# so one connection's LOGOUT revokes only its own.
+#
+# Tokens live only in memory, so a server restart invalidates them all and
+# clients fall back to a password login. Each use extends a token's life by
+# SESSION_TTL. That keeps the table in expiry order, so eviction only has to
+# pop expired tokens off the front.
+import collections
+import secrets
+import threading
+import time
+
+import config
+
+
+class SessionTable:
+    def __init__(self, ttl: float, capacity: int):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._tokens = collections.OrderedDict()  # token -> (username, expires)
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.resumed = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def _evict(self, now: float):
+        """Drop expired tokens, and the oldest ones beyond capacity. Lock held."""
+        while self._tokens:
+            token, (_, expires) = next(iter(self._tokens.items()))
+            if expires > now and len(self._tokens) <= self.capacity:
+                return
+            del self._tokens[token]
+            self.expired += 1
+
+    def issue(self, username: str) -> str:
+        token = secrets.token_urlsafe(24)
+        now = time.monotonic()
+        with self._lock:
+            self._tokens[token] = (username, now + self.ttl)
+            self.issued += 1
+            self._evict(now)
+        return token
+
+    def resume(self, token: str):
+        """The username a live token belongs to (extending its life), or None."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._tokens.get(token)
+            if entry is None:
+                self.rejected += 1
+                return None
+            self._tokens[token] = (entry[0], now + self.ttl)
+            self._tokens.move_to_end(token)
+            self.resumed += 1
+            return entry[0]
+
+    def revoke(self, token: str):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._evict(time.monotonic())
+            return {
+                "active": len(self._tokens),
+                "issued": self.issued,
+                "resumed": self.resumed,
+                "rejected": self.rejected,
+                "expired": self.expired,
+            }
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def table() -> SessionTable:
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = SessionTable(config.SESSION_TTL, config.SESSION_MAX)
+        return _table
+
+
+def issue(username: str) -> str:
+    return table().issue(username)
+
+
+def resume(token: str):
+    return table().resume(token) if token else None
+
+
+def revoke(token: str):
+    if token:
+        table().revoke(token)
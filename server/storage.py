@@ -0,0 +1,577 @@
+# storage.py
+# Filesystem operations behind the DIR / DELETE / UPLOAD commands, shared by
+# the threaded and asyncio engines so both answer identically.
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import re
+import stat
+import threading
+import time
+import uuid
+
+import admission
+import cache
+import chunkstore
+import config
+import durable
+import index
+import metrics
+import ratelimit
+from common import checksums, compression
+
+# Server bookkeeping (partial uploads, ...) lives in this hidden folder under
+# SERVER_PATH. It is never listed and clients can't address it.
+INTERNAL_DIR = ".fileshare"
+
+
+_chunk_store = None
+_file_cache = None
+_metadata_index = None
+_writing = set()  # .part files open for writing in this process
+_writing_lock = threading.Lock()
+
+
+def ensure_root():
+    os.makedirs(config.SERVER_PATH, exist_ok=True)
+
+
+def internal_path(*parts) -> str:
+    return os.path.join(config.SERVER_PATH, INTERNAL_DIR, *parts)
+
+
+def resolve(name: str, sub: str = None) -> str:
+    """Map a client supplied name (and optional subfolder) into SERVER_PATH."""
+    root = os.path.abspath(config.SERVER_PATH)
+    parts = [root]
+    if sub:
+        parts.append(sub)
+    if name:
+        parts.append(name)
+    path = os.path.abspath(os.path.join(*parts))
+    if path != root and not path.startswith(root + os.sep):
+        raise ValueError("Path escapes the server directory")
+    if os.path.relpath(path, root).split(os.sep)[0] == INTERNAL_DIR:
+        raise ValueError("Reserved path")
+    return path
+
+
+def resolve_entry(name: str, sub: str = None) -> str:
+    """resolve() for a file or folder to create or remove: never SERVER_PATH itself."""
+    path = resolve(name, sub)
+    if path == os.path.abspath(config.SERVER_PATH):
+        raise ValueError("Missing file or folder name")
+    return path
+
+
+def metadata_index() -> index.MetadataIndex:
+    global _metadata_index
+    root = os.path.abspath(config.SERVER_PATH)
+    if _metadata_index is None or _metadata_index.root != root:
+        _metadata_index = index.MetadataIndex(root, INTERNAL_DIR, _indexed_size)
+    return _metadata_index
+
+
+def _indexed_size(path: str, st) -> int:
+    if _chunk_store is not None and _chunk_store.written_by_us(path, st):
+        manifest = _chunk_store.load(path)
+        if manifest is not None:
+            return manifest.size
+    return st.st_size
+
+
+def list_dir() -> str:
+    """Return the DIR response body for the top level of SERVER_PATH."""
+    entries = metadata_index().entries()
+    if not entries:
+        return "OK@No files found."
+
+    file_list = []
+    for entry in entries:
+        if entry.is_dir:
+            file_list.append(f"{entry.name}/ — [DIR]")
+        else:
+            name, extension = os.path.splitext(entry.name)
+            if extension == "":
+                extension = "(unknown type)"
+            file_list.append(f"{name} — {extension}")
+    formatted_list = "\n".join(file_list)
+    return f"Files on server:\n{formatted_list}"
+
+
+def list_entries(folder: str = "", recursive: bool = False, pattern: str = None,
+                 prefix: str = None) -> list:
+    """Entries for a paged DIR: [[path, "dir" | "file", size, mtime]].
+
+    Paths are relative to SERVER_PATH with "/" separators. pattern is a glob
+    matched against the path if it contains "/", else against the name.
+    """
+    path = resolve(folder or "")
+    rel = os.path.relpath(path, os.path.abspath(config.SERVER_PATH))
+    rel = "" if rel == "." else rel.replace(os.sep, "/")
+    rows = []
+    for entry_path, entry in metadata_index().walk(rel, recursive):
+        if prefix and not entry_path.startswith(prefix):
+            continue
+        if pattern and not fnmatch.fnmatchcase(entry_path if "/" in pattern else entry.name, pattern):
+            continue
+        rows.append([entry_path, "dir" if entry.is_dir else "file", entry.size, entry.mtime])
+    return rows
+
+
+def make_dir(folder_name: str) -> str:
+    folder_path = resolve_entry(folder_name)
+    os.makedirs(folder_path, exist_ok=True)
+    invalidate(folder_path)
+    return folder_path
+
+
+def upload_path(filename: str, sub: str = None) -> str:
+    """Create the destination folder for an upload and return the file path."""
+    subpath = resolve("", sub)
+    os.makedirs(subpath, exist_ok=True)
+    return resolve_entry(filename, sub)
+
+
+def plan_tree(root: str, dirs, files):
+    """Validate an UPLOAD_TREE manifest.
+
+    Returns (directories to create, [(file path, size)]) with every path
+    resolved inside SERVER_PATH, so the caller can create each directory
+    once up front instead of once per file.
+    """
+    base = resolve(root)
+    directories = {base}
+    for rel in dirs:
+        directories.add(resolve(rel, root))
+
+    targets = []
+    for rel, size in files:
+        size = int(size)
+        if size < 0:
+            raise ValueError(f"Negative size for '{rel}'")
+        path = resolve(rel, root)
+        if path == base:
+            raise ValueError("File entry without a name")
+        targets.append((path, size))
+        directories.add(os.path.dirname(path))
+    return sorted(directories), targets
+
+
+def make_dirs(directories):
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+        invalidate(directory)
+
+
+def delete(name: str) -> str:
+    """Delete a file or folder. Returns "File" or "Folder"."""
+    path_to_delete = resolve_entry(name)
+    if not os.path.exists(path_to_delete):
+        raise FileNotFoundError(name)
+
+    if _chunk_store is not None:
+        for _, manifest in manifests(path_to_delete):
+            _chunk_store.forget(manifest)
+        _chunk_store.unmark(path_to_delete)
+    if os.path.isdir(path_to_delete):
+        shutil.rmtree(path_to_delete)
+        shutil.rmtree(meta_path(path_to_delete, folder=True), ignore_errors=True)
+        kind = "Folder"
+    else:
+        os.remove(path_to_delete)
+        kind = "File"
+    _remove_quietly(meta_path(path_to_delete))
+    invalidate(path_to_delete)
+    return kind
+
+
+# ----------------------------------------------------------------------
+# File metadata: the content digest of each stored file, recorded when the
+# file is written (hashed as it streams in), so VERIFY and DOWNLOAD answer
+# without reading the file again. Sidecars mirror the tree under
+# INTERNAL_DIR/meta and carry the stat key of the file they describe; a file
+# changed behind the server's back has no valid digest until it is re-hashed.
+# ----------------------------------------------------------------------
+def meta_path(path: str, folder: bool = False) -> str:
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(config.SERVER_PATH))
+    return internal_path("meta", rel if folder else rel + ".json")
+
+
+def _stat_key(st) -> list:
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def record_digest(path: str, digest: str, st=None):
+    """Store digest for the file now at path (st: its stat, if already known)."""
+    st = st or os.stat(path)
+    meta = meta_path(path)
+    os.makedirs(os.path.dirname(meta), exist_ok=True)
+    tmp = f"{meta}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"algorithm": checksums.ALGORITHM, "digest": digest, "stat": _stat_key(st)}, f)
+    os.replace(tmp, meta)
+
+
+def stored_digest(path: str):
+    """The recorded digest of path, or None if there is none or the file changed since."""
+    try:
+        st = os.stat(path)
+        with open(meta_path(path)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("stat") != _stat_key(st) or meta.get("algorithm") != checksums.ALGORITHM:
+        return None
+    return meta.get("digest")
+
+
+def compute_digest(path: str) -> str:
+    """Hash path in full and record the result (for files with no valid digest)."""
+    f, st = _open_stored(path)
+    with f:
+        digest = checksums.stream_digest(f)
+    record_digest(path, digest, st)
+    return digest
+
+
+def verify(path: str):
+    """(digest, computed) for VERIFY: the recorded digest, or a fresh one."""
+    digest = stored_digest(path)
+    if digest is not None:
+        return digest, False
+    return compute_digest(path), True
+
+
+class PartialUpload:
+    """An upload in progress, kept as <target key>-<upload id>.part under
+    INTERNAL_DIR/partial.
+
+    Every upload gets its own upload id, so two clients uploading the same
+    name at once write separate files; whichever finishes last is the one
+    left in place. The received offset is the size of the .part file, so it
+    survives both dropped connections and server restarts. A sidecar .json
+    records the target and the announced size; find() offers the largest
+    such upload of the same target and size for resuming, unless it is still
+    being written. commit() renames the finished file into place, so a
+    half-received upload never appears under its real name. A non-resumable
+    upload (one file of UPLOAD_TREE) skips the sidecar.
+    """
+
+    ID = re.compile(r"[0-9a-f]{32}")
+
+    def __init__(self, final_path: str, size: int, resumable: bool = True, upload_id: str = None):
+        if upload_id is not None and not self.ID.fullmatch(upload_id):
+            raise ValueError("Bad upload id")
+        self.final_path = final_path
+        self.size = size
+        self.resumable = resumable
+        self.upload_id = upload_id or uuid.uuid4().hex
+        self.prefix = self.target_key(final_path) + "-"
+        self.part_path = internal_path("partial", self.prefix + self.upload_id + ".part")
+        self.state_path = internal_path("partial", self.prefix + self.upload_id + ".json")
+
+    @staticmethod
+    def target_key(final_path: str) -> str:
+        rel = os.path.relpath(final_path, os.path.abspath(config.SERVER_PATH))
+        return hashlib.sha1(rel.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def find(cls, final_path: str, size: int) -> "PartialUpload":
+        """The interrupted upload of final_path with this size that holds the
+        most bytes, or a new upload if there is none. Blocks on the disk."""
+        prefix = cls.target_key(final_path) + "-"
+        best, best_offset = None, 0
+        try:
+            names = os.listdir(internal_path("partial"))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            upload_id = name[len(prefix):-len(".json")]
+            if not (name.startswith(prefix) and name.endswith(".json") and cls.ID.fullmatch(upload_id)):
+                continue
+            partial = cls(final_path, size, upload_id=upload_id)
+            offset = partial.offset()
+            if offset > best_offset and not partial.writing():
+                best, best_offset = partial, offset
+        return best or cls(final_path, size)
+
+    def offset(self) -> int:
+        """Bytes already received for this upload, or 0 if it can't be resumed."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state.get("path") != self.final_path or state.get("size") != self.size:
+                return 0
+            return min(os.path.getsize(self.part_path), self.size)
+        except (OSError, ValueError):
+            return 0
+
+    def writing(self) -> bool:
+        """Whether a connection has this upload open right now."""
+        with _writing_lock:
+            return self.part_path in _writing
+
+    def open(self, offset: int = 0) -> durable.Writer:
+        """Open the .part file for writing at offset (0 starts over).
+
+        Starting a resumable upload over also drops earlier interrupted
+        uploads of the same target, as long as no connection is still
+        writing them.
+        """
+        with _writing_lock:
+            if self.part_path in _writing:
+                raise ValueError("This upload is still in progress on another connection")
+            _writing.add(self.part_path)
+        try:
+            os.makedirs(os.path.dirname(self.part_path), exist_ok=True)
+            if not offset and self.resumable:
+                self._discard_others()
+                with open(self.state_path, "w") as state:
+                    json.dump({"path": self.final_path, "size": self.size}, state)
+            return durable.Writer(self.part_path, self.size, offset, on_close=self._closed)
+        except BaseException:
+            self._closed()
+            raise
+
+    def _closed(self):
+        with _writing_lock:
+            _writing.discard(self.part_path)
+
+    def _discard_others(self):
+        for name in os.listdir(os.path.dirname(self.part_path)):
+            if not name.startswith(self.prefix) or name.startswith(self.prefix + self.upload_id + "."):
+                continue
+            path = internal_path("partial", name)
+            with _writing_lock:
+                if os.path.splitext(path)[0] + ".part" in _writing:
+                    continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def commit(self):
+        commit_file(self.part_path, self.final_path)
+        self.discard()
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# ----------------------------------------------------------------------
+# Storage backends. "plain" keeps every file as is; "chunked" replaces it
+# with a manifest into the deduplicating chunk store (chunkstore.py). Reads
+# go through open_file(), which understands both, so a tree written by either
+# backend can be served by the other.
+# ----------------------------------------------------------------------
+def chunked() -> bool:
+    return config.STORAGE_BACKEND == "chunked"
+
+
+def chunk_store() -> chunkstore.ChunkStore:
+    global _chunk_store
+    root = internal_path("chunks")
+    if _chunk_store is None or _chunk_store.root != root:
+        _chunk_store = chunkstore.ChunkStore(root, internal_path("manifests"), config.SERVER_PATH)
+    return _chunk_store
+
+
+def load_chunk_store():
+    """Sweep unreferenced chunks and count the store. Returns chunks removed."""
+    if not chunked() and not os.path.isdir(internal_path("chunks")):
+        return 0
+    return chunk_store().sweep(manifest for _, manifest in manifests())
+
+
+def commit_file(src: str, dest: str):
+    """Move a fully received file into place (src may equal dest).
+
+    Durable per config.FSYNC_POLICY, so this may block on the disk.
+    """
+    if chunked():
+        chunk_store().ingest(src, dest)
+    elif src != dest:
+        durable.replace(src, dest)
+    invalidate(dest)
+
+
+def file_cache() -> cache.FileCache:
+    global _file_cache
+    if _file_cache is None or _file_cache.capacity != config.CACHE_SIZE:
+        _file_cache = cache.FileCache(config.CACHE_SIZE, config.CACHE_MAX_FILE)
+    return _file_cache
+
+
+def invalidate(path: str):
+    """path (a file or a whole folder) was written or removed: drop its cached
+    contents and update its DIR index entry."""
+    if _file_cache is not None:
+        _file_cache.invalidate(path)
+    if _metadata_index is not None:
+        _metadata_index.refresh(path)
+
+
+def _open_stored(path: str):
+    """(file object, os.stat_result of the file actually opened)."""
+    f = open(path, "rb")
+    st = os.fstat(f.fileno())
+    # Only manifests the chunked backend registered are read as such; a
+    # client's file that happens to start with the magic is served as is.
+    registered = _chunk_store is not None and _chunk_store.written_by_us(path, st)
+    manifest = chunkstore.read_manifest(f) if registered else None
+    if manifest is None:
+        f.seek(0)
+        return f, st
+    f.close()
+    return chunk_store().open(manifest), st
+
+
+def open_file(path: str):
+    """Open a stored file for reading.
+
+    Hot files are served from the in-memory cache; manifests of the chunked
+    backend are reassembled. Raises FileNotFoundError or IsADirectoryError.
+    """
+    st = os.stat(path)
+    if stat.S_ISDIR(st.st_mode):
+        raise IsADirectoryError(path)
+    files = file_cache()
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    buffer = files.get(path, key)
+    if buffer is not None:
+        return cache.CachedFile(buffer)
+
+    f, st = _open_stored(path)
+    if not files.admits(file_size(f)):
+        return f
+    start = time.perf_counter()
+    with f:
+        data = f.read()
+    metrics.disk_time("read", time.perf_counter() - start, len(data))
+    return cache.CachedFile(files.put(path, (st.st_ino, st.st_size, st.st_mtime_ns), data))
+
+
+def stored_size(path: str) -> int:
+    """Size of a stored file's contents, without reading or caching them."""
+    f, _ = _open_stored(path)
+    with f:
+        return file_size(f)
+
+
+def file_size(f) -> int:
+    size = getattr(f, "size", None)  # ChunkedFile / CachedFile
+    return size if size is not None else os.fstat(f.fileno()).st_size
+
+
+def manifests(top: str = None):
+    """Yield (path, Manifest) for every chunked file under top (default: all)."""
+    top = top or config.SERVER_PATH
+    store = chunk_store()
+    if os.path.isfile(top):
+        manifest = store.load(top)
+        if manifest is not None:
+            yield top, manifest
+        return
+    for current, dirs, files in os.walk(top):
+        if os.path.abspath(current) == os.path.abspath(config.SERVER_PATH):
+            dirs[:] = [d for d in dirs if d != INTERNAL_DIR]
+        for name in files:
+            path = os.path.join(current, name)
+            manifest = store.load(path)
+            if manifest is not None:
+                yield path, manifest
+
+
+def stats() -> dict:
+    result = {"backend": config.STORAGE_BACKEND}
+    if chunked():
+        result.update(chunk_store().stats())
+    result["cache"] = file_cache().stats()
+    result["index"] = metadata_index().stats()
+    result["compression"] = compression.stats()
+    result["durability"] = durable.stats()
+    result["connections"] = admission.manager().stats()
+    result["shaping"] = ratelimit.shaper().stats()
+    result["metrics"] = metrics.snapshot()
+    return result
+
+
+def metric_families() -> dict:
+    """Gauges and counters from stats() for the Prometheus exporter."""
+    s = stats()
+    n, c, r, d = s["connections"], s["cache"], s["shaping"], s["durability"]
+    families = {
+        "fileshare_connections": ("gauge", "Client connections being served or waiting for a worker.",
+                                  [({"state": "active"}, n["active"]), ({"state": "queued"}, n["queued"])]),
+        "fileshare_connections_rejected_total": ("counter", "Connections turned away with ERR@BUSY.", [
+            ({"reason": "capacity"}, n["rejected_capacity"]), ({"reason": "per_ip"}, n["rejected_per_ip"]),
+            ({"reason": "per_user"}, n["rejected_per_user"])]),
+        "fileshare_cache_bytes": ("gauge", "Bytes held by the DOWNLOAD cache.", [({}, c["bytes"])]),
+        "fileshare_cache_requests_total": ("counter", "DOWNLOAD cache lookups.",
+                                           [({"result": "hit"}, c["hits"]), ({"result": "miss"}, c["misses"])]),
+        "fileshare_shaping_waits_total": ("counter", "Times a transfer waited for bandwidth tokens.",
+                                          [({}, r["waits"])]),
+        "fileshare_shaping_wait_seconds_total": ("counter", "Time transfers spent waiting for tokens.",
+                                                 [({}, r["waited_s"])]),
+        "fileshare_fsyncs_total": ("counter", "fsync calls made for uploads.",
+                                   [({"target": "file"}, d["file_syncs"]), ({"target": "dir"}, d["dir_syncs"])]),
+    }
+    if "dedup_ratio" in s:
+        families["fileshare_dedup_ratio"] = ("gauge", "Logical bytes stored per byte on disk.",
+                                             [({}, s["dedup_ratio"])])
+    return families
+
+
+def stats_text(s: dict = None) -> str:
+    """The STATS response body (without the OK@ prefix) for stats() output s."""
+    s = s or stats()
+    lines = [f"Storage backend: {s['backend']}"]
+    if "dedup_ratio" in s:
+        lines.append(f"Files: {s['files']} ({s['logical_bytes']:,} bytes)")
+        lines.append(f"Unique chunks: {s['unique_chunks']} ({s['stored_bytes']:,} bytes on disk)")
+        lines.append(f"Dedup ratio: {s['dedup_ratio']:.2f}x")
+        if s["upload_bytes"]:
+            saved = 1 - s["upload_bytes_sent"] / s["upload_bytes"]
+            lines.append(f"Upload bytes skipped: {saved:.1%} of {s['upload_bytes']:,}")
+    c = s["cache"]
+    lines.append(f"Cache: {c['entries']} files, {c['bytes']:,} of {c['capacity']:,} bytes, "
+                 f"{c['hits']} hits, {c['misses']} misses ({c['hit_ratio']:.1%}), "
+                 f"{c['evictions']} evictions, {c['invalidations']} invalidations")
+    i = s["index"]
+    lines.append(f"Index: {i['directories']} folders, {i['entries']} entries, "
+                 f"{i['scans']} scans, {i['hits']} hits")
+    n = s["connections"]
+    lines.append(f"Connections: {n['active']} active, {n['queued']} queued (peak {n['peak']}, "
+                 f"limit {n['max_connections']}), {n['rejected']} rejected "
+                 f"({n['rejected_capacity']} over capacity, {n['rejected_per_ip']} per IP, "
+                 f"{n['rejected_per_user']} per user)")
+    r = s["shaping"]
+    if r["global_rate"] or r["user_rate"] or r["class_rates"]:
+        limits = [f"{name} {rate / 1048576:.1f} MB/s" for name, rate in
+                  [("global", r["global_rate"]), ("per user", r["user_rate"])] + sorted(r["class_rates"].items())
+                  if rate]
+        lines.append(f"Shaping: {', '.join(limits)}; {r['sent_bytes']:,} bytes sent, "
+                     f"{r['received_bytes']:,} received, {r['waits']} waits ({r['waited_s']:.2f}s)")
+    d = s["durability"]
+    lines.append(f"Durability: {d['policy']}, {d['file_syncs']} file fsyncs "
+                 f"(avg {d['file_sync_avg_ms']:.2f} ms), {d['dir_syncs']} directory fsyncs "
+                 f"(avg {d['dir_sync_avg_ms']:.2f} ms)")
+    for name, z in sorted(s["compression"].items()):
+        lines.append(f"Compression {name}: {z['raw_bytes']:,} raw / {z['wire_bytes']:,} wire bytes "
+                     f"({z['ratio']:.2f}x), {z['cpu_seconds']:.3f}s CPU")
+    lines.extend(metrics.stats_lines())
+    return "\n".join(lines)
@@ -0,0 +1,238 @@
+# tracing.py
+# Opt-in tracing and profiling of client connections.
+#
+# With --trace FILE, a sampled fraction of connections (--trace-sample)
+# records spans in the Chrome trace event format: the handshake, every
+# command and every transfer. A transfer also records when its first byte
+# arrived, a progress marker every TRACE_PROGRESS_BYTES, and where its time
+# went: network (socket calls), disk (file reads and writes), cpu (hashing,
+# compression) and wait (bandwidth shaping). Load the file in
+# chrome://tracing or https://ui.perfetto.dev; each connection shows up as
+# its own track.
+#
+# With --profile-sample, that fraction of connections also runs under
+# cProfile, and a .prof file per connection lands in --profile-dir. cProfile
+# only sees the thread it was started on. Under the threaded engine that is
+# exactly the connection. Under the asyncio engine it is the whole event
+# loop while the connection is open, and only one connection is profiled at
+# a time.
+#
+# Connections that are not sampled get NULL, whose methods do nothing, so
+# with tracing off the hot loops pay one no-op method call per chunk
+# (tests/trace_benchmark.py measures it).
+import cProfile
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+import config
+
+_ids = itertools.count(1)
+_epoch = time.perf_counter()
+_profiling = set()        # ids of threads with a profiler running
+_profiling_lock = threading.Lock()
+
+
+def _us(t: float) -> float:
+    return round((t - _epoch) * 1e6, 1)
+
+
+class TraceFile:
+    """Chrome trace events appended to a file, one JSON object per line.
+
+    The file is a JSON array whose closing bracket is written at shutdown
+    (trace viewers accept it missing, e.g. after a kill).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = open(path, "w")
+        self._f.write("[\n")
+        self._first = True
+
+    def write(self, events: list):
+        if not events:
+            return
+        text = ",\n".join(json.dumps(e, separators=(",", ":")) for e in events)
+        with self._lock:
+            if self._f.closed:
+                return
+            self._f.write(text if self._first else ",\n" + text)
+            self._first = False
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._f.closed:
+                self._f.write("\n]\n")
+                self._f.close()
+
+
+class NullTransfer:
+    def mark(self, phase: str, nbytes: int = 0):
+        pass
+
+    def finish(self, **args):
+        pass
+
+
+class NullTrace:
+    enabled = False
+
+    def span(self, name: str, started: float, **args):
+        pass
+
+    def instant(self, name: str, **args):
+        pass
+
+    def transfer(self, kind: str, name: str, size: int = None) -> NullTransfer:
+        return NULL_TRANSFER
+
+    def close(self):
+        pass
+
+
+NULL_TRANSFER = NullTransfer()
+NULL = NullTrace()
+
+
+class Transfer:
+    """Time accounting for one upload or download.
+
+    Call mark(phase) after each step of the loop: the time since the
+    previous mark is charged to that phase ("net", "disk", "cpu", or "wait"
+    for bandwidth shaping), and nbytes counts towards progress.
+    """
+
+    def __init__(self, trace: "ConnectionTrace", kind: str, name: str, size):
+        self.trace = trace
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.started = self.last = time.perf_counter()
+        self.phases = {"net": 0.0, "disk": 0.0, "cpu": 0.0, "wait": 0.0}
+        self.bytes = 0
+        self.next_progress = config.TRACE_PROGRESS_BYTES
+
+    def mark(self, phase: str, nbytes: int = 0):
+        now = time.perf_counter()
+        self.phases[phase] += now - self.last
+        self.last = now
+        if nbytes:
+            if not self.bytes:
+                self.trace.instant(f"{self.kind} first byte", file=self.name,
+                                   after_ms=round((now - self.started) * 1000, 3))
+            self.bytes += nbytes
+            if self.bytes >= self.next_progress:
+                self.next_progress += config.TRACE_PROGRESS_BYTES
+                self.trace.instant(f"{self.kind} progress", file=self.name, bytes=self.bytes,
+                                   **self._breakdown(now))
+
+    def _breakdown(self, now: float) -> dict:
+        elapsed = now - self.started
+        fields = {f"{phase}_ms": round(t * 1000, 3) for phase, t in self.phases.items()}
+        fields["other_ms"] = round((elapsed - sum(self.phases.values())) * 1000, 3)
+        fields["mb_s"] = round(self.bytes / 1048576 / elapsed, 2) if elapsed > 0 else 0.0
+        return fields
+
+    def finish(self, **args):
+        now = time.perf_counter()
+        self.trace.span(f"{self.kind} {self.name}", self.started, bytes=self.bytes, size=self.size,
+                        **self._breakdown(now), **args)
+
+
+class ConnectionTrace:
+    enabled = True
+
+    def __init__(self, addr, record: bool, profile: bool):
+        self.tid = next(_ids)
+        self.addr = addr
+        self.started = time.perf_counter()
+        self.record = record
+        self.events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": self.tid,
+                        "args": {"name": f"{addr[0]}:{addr[1]} #{self.tid}"}}] if record else []
+        self.profiler = None
+        if profile:
+            thread = threading.get_ident()
+            with _profiling_lock:
+                if thread not in _profiling:
+                    _profiling.add(thread)
+                    self.profiler = cProfile.Profile()
+            if self.profiler is not None:
+                self.profiler.enable()
+
+    def _add(self, event: dict):
+        if self.record:
+            event.update(pid=os.getpid(), tid=self.tid)
+            self.events.append(event)
+            if len(self.events) >= 1000:  # long-lived connection: don't hoard
+                _flush(self.events)
+                self.events = []
+
+    def span(self, name: str, started: float, **args):
+        """A complete event from perf_counter() value `started` until now."""
+        now = time.perf_counter()
+        self._add({"name": name, "ph": "X", "ts": _us(started), "dur": round((now - started) * 1e6, 1),
+                   "args": args})
+
+    def instant(self, name: str, **args):
+        self._add({"name": name, "ph": "i", "s": "t", "ts": _us(time.perf_counter()), "args": args})
+
+    def transfer(self, kind: str, name: str, size: int = None) -> Transfer:
+        return Transfer(self, kind, name, size)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(config.PROFILE_DIR, exist_ok=True)
+            host, port = self.addr[0], self.addr[1]
+            path = os.path.join(config.PROFILE_DIR, f"conn-{self.tid}-{host}_{port}.prof")
+            self.profiler.dump_stats(path)
+            with _profiling_lock:
+                _profiling.discard(threading.get_ident())
+            self.profiler = None
+            print(f"[PROFILE] {self.addr}: {path}")
+        if self.record:
+            self.span("connection", self.started)
+            _flush(self.events)
+            self.events = []
+
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+
+def _flush(events: list):
+    with _trace_lock:
+        trace_file = _trace_file
+    if trace_file is not None:
+        trace_file.write(events)
+
+
+def start():
+    """Open the trace file named by config.TRACE_FILE, if any."""
+    global _trace_file
+    with _trace_lock:
+        if config.TRACE_FILE and _trace_file is None:
+            _trace_file = TraceFile(config.TRACE_FILE)
+
+
+def stop():
+    global _trace_file
+    with _trace_lock:
+        trace_file, _trace_file = _trace_file, None
+    if trace_file is not None:
+        trace_file.close()
+
+
+def connection(addr):
+    """The tracer for a new connection: a ConnectionTrace if sampled, else NULL."""
+    record = bool(config.TRACE_FILE) and random.random() < config.TRACE_SAMPLE
+    profile = random.random() < config.PROFILE_SAMPLE
+    if not record and not profile:
+        return NULL
+    return ConnectionTrace(addr, record, profile)
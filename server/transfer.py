@@ -0,0 +1,210 @@
+# transfer.py
+# File -> socket transfer paths for DOWNLOAD. The zero-copy path hands the
+# file descriptor to the kernel with os.sendfile (or loop.sock_sendfile in
+# the asyncio engine); the chunked read()/sendall() loop is kept as the
+# fallback for platforms and files where sendfile is not available.
+#
+# A shaped transfer (ratelimit.throttle) is sent one CHUNK_SIZE piece at a
+# time, each after the wait its token buckets ask for. The chunked loop reads
+# into a pooled buffer (common/buffers.py) and sends slices of it; in the
+# asyncio engine the reads run on a worker thread, one piece ahead of the send.
+import asyncio
+import collections
+import errno
+import io
+import os
+import socket
+import threading
+import time
+
+import config
+import metrics
+import ratelimit
+from common import buffers
+
+MODE_SENDFILE = "sendfile"
+MODE_CHUNKED = "chunked"
+MODE_CACHE = "cache"
+
+# Bytes the asyncio chunked loop reads per trip to a worker thread.
+ASYNC_READ_SIZE = 262144
+
+# errno values meaning "sendfile cannot be used here", not "the peer went away"
+_SENDFILE_UNSUPPORTED = {
+    errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+    getattr(errno, "EOPNOTSUPP", errno.EINVAL), getattr(errno, "ENOTSUP", errno.EINVAL),
+}
+
+# Most recent per-transfer stats, newest last.
+RECENT_TRANSFERS = collections.deque(maxlen=256)
+_stats_lock = threading.Lock()
+
+
+def _file_fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+
+
+def _sendfile(conn: socket.socket, fileno: int, offset: int, count: int) -> int:
+    sent = 0
+    while sent < count:
+        n = os.sendfile(conn.fileno(), fileno, offset + sent, count - sent)
+        if n == 0:  # file shrank underneath us
+            break
+        sent += n
+    return sent
+
+
+def _send_chunked(conn: socket.socket, f, offset: int, count: int) -> int:
+    f.seek(offset)
+    sent = 0
+    with buffers.lease(config.CHUNK_SIZE) as buf:
+        while sent < count:
+            n = _readinto(f, buf[:min(config.CHUNK_SIZE, count - sent)])
+            if not n:
+                break
+            conn.sendall(buf[:n])
+            sent += n
+    return sent
+
+
+def send_file(conn: socket.socket, f, offset: int, count: int, throttle=None):
+    """Send count bytes of f starting at offset. Returns (bytes_sent, mode)."""
+    if throttle is None:
+        return _send_file(conn, f, offset, count)
+    sent, mode = 0, MODE_CHUNKED
+    while sent < count:
+        n = min(config.CHUNK_SIZE, count - sent)
+        ratelimit.pace(throttle, n)
+        piece, mode = _send_file(conn, f, offset + sent, n)
+        sent += piece
+        if piece < n:
+            break
+    return sent, mode
+
+
+def _send_file(conn: socket.socket, f, offset: int, count: int):
+    buffer = getattr(f, "buffer", None)  # cache.CachedFile: already in memory
+    if buffer is not None:
+        data = buffer[offset:offset + count]
+        conn.sendall(data)
+        return len(data), MODE_CACHE
+    fileno = _file_fileno(f)
+    if config.ZERO_COPY and hasattr(os, "sendfile") and fileno is not None:
+        try:
+            return _sendfile(conn, fileno, offset, count), MODE_SENDFILE
+        except OSError as e:
+            if e.errno not in _SENDFILE_UNSUPPORTED:
+                raise
+    return _send_chunked(conn, f, offset, count), MODE_CHUNKED
+
+
+async def async_send_file(loop, conn: socket.socket, f, offset: int, count: int, throttle=None):
+    """asyncio version of send_file() for non-blocking sockets."""
+    if throttle is None:
+        return await _async_send_file(loop, conn, f, offset, count)
+    sent, mode = 0, MODE_CHUNKED
+    while sent < count:
+        n = min(config.CHUNK_SIZE, count - sent)
+        await ratelimit.async_pace(throttle, n)
+        piece, mode = await _async_send_file(loop, conn, f, offset + sent, n)
+        sent += piece
+        if piece < n:
+            break
+    return sent, mode
+
+
+async def _async_send_file(loop, conn: socket.socket, f, offset: int, count: int):
+    buffer = getattr(f, "buffer", None)
+    if buffer is not None:
+        data = buffer[offset:offset + count]
+        await loop.sock_sendall(conn, data)
+        return len(data), MODE_CACHE
+    if config.ZERO_COPY and _file_fileno(f) is not None:
+        try:
+            sent = await loop.sock_sendfile(conn, f, offset, count, fallback=False)
+            return sent, MODE_SENDFILE
+        except (asyncio.SendfileNotAvailableError, NotImplementedError):
+            pass
+    return await _async_send_chunked(loop, conn, f, offset, count), MODE_CHUNKED
+
+
+async def _async_send_chunked(loop, conn: socket.socket, f, offset: int, count: int) -> int:
+    # Reads run on a worker thread so neither the disk (nor the chunk files
+    # behind a ChunkedFile) blocks the event loop.
+    if count <= ASYNC_READ_SIZE:
+        # One piece (a framed DOWNLOAD sends a frame per call): one trip.
+        with buffers.lease(ASYNC_READ_SIZE) as buf:
+            n = await asyncio.to_thread(read_chunk_into, f, offset, buf[:count])
+            if n:
+                await loop.sock_sendall(conn, buf[:n])
+            return n
+
+    # Longer runs use two pooled buffers: one is sent while the next piece
+    # is read into the other.
+    def read_ahead(position, view):
+        return asyncio.ensure_future(asyncio.to_thread(read_chunk_into, f, position, view))
+
+    sent = 0
+    with buffers.lease(ASYNC_READ_SIZE) as front, buffers.lease(ASYNC_READ_SIZE) as back:
+        reading = read_ahead(offset, front[:ASYNC_READ_SIZE])
+        try:
+            while reading is not None:
+                n = await reading
+                reading = None
+                if not n:
+                    break
+                if sent + n < count:
+                    reading = read_ahead(offset + sent + n, back[:min(ASYNC_READ_SIZE, count - sent - n)])
+                await loop.sock_sendall(conn, front[:n])
+                sent += n
+                front, back = back, front
+        finally:
+            if reading is not None:
+                # The thread is still filling a leased buffer; let it finish first.
+                await asyncio.gather(reading, return_exceptions=True)
+    return sent
+
+
+def _read(f, count: int) -> bytes:
+    start = time.perf_counter()
+    data = f.read(count)
+    metrics.disk_time("read", time.perf_counter() - start, len(data))
+    return data
+
+
+def _readinto(f, view: memoryview) -> int:
+    start = time.perf_counter()
+    n = f.readinto(view)
+    metrics.disk_time("read", time.perf_counter() - start, n)
+    return n
+
+
+def read_chunk(f, offset: int, count: int) -> bytes:
+    f.seek(offset)
+    return _read(f, count)
+
+
+def read_chunk_into(f, offset: int, view: memoryview) -> int:
+    f.seek(offset)
+    return _readinto(f, view)
+
+
+def record_transfer(kind: str, name: str, peer, nbytes: int, seconds: float, mode: str) -> dict:
+    mbps = (nbytes / 1_048_576) / seconds if seconds > 0 else 0.0
+    stats = {
+        "kind": kind,
+        "name": name,
+        "peer": str(peer),
+        "bytes": nbytes,
+        "seconds": round(seconds, 6),
+        "mbps": round(mbps, 2),
+        "mode": mode,
+        "time": time.time(),
+    }
+    with _stats_lock:
+        RECENT_TRANSFERS.append(stats)
+    metrics.add_bytes("out" if kind == "download" else "in", nbytes)
+    return stats
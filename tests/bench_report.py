@@ -0,0 +1,145 @@
+# bench_report.py
+# Static reports of a stored benchmark run (results_store.py): a Markdown
+# and an HTML page with the run's environment and configuration, a table of
+# its metrics against the baseline, and per metric a PNG with the two sample
+# distributions and the metric's median across earlier runs of the suite.
+#
+# Plots are drawn with matplotlib's Agg backend, so no display is needed;
+# without matplotlib the pages are written without them.
+import html
+import json
+import os
+
+from results_store import summary
+
+
+def _fmt(v, spec=".2f"):
+    return format(v, spec) if v is not None else "n/a"
+
+
+def _plot(name: str, run: dict, baseline, history: list, path: str) -> bool:
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        return False
+
+    m = run["metrics"][name]
+    fig, (dist, trend) = plt.subplots(1, 2, figsize=(11, 4))
+    data, labels = [m["samples"]], ["current"]
+    if baseline is not None and name in baseline["metrics"]:
+        data.insert(0, baseline["metrics"][name]["samples"])
+        labels.insert(0, "baseline")
+    dist.boxplot([d or [0.0] for d in data], showfliers=True)
+    dist.set_xticklabels(labels)
+    dist.set_title(f"{name} ({m['better']} is better)")
+    dist.set_ylabel(m["unit"])
+    dist.grid(alpha=0.3)
+
+    points = [(r["created"][:19], summary(r["metrics"][name]["samples"]).get("median"))
+              for r in history if name in r["metrics"]]
+    points = [(t, v) for t, v in points if v is not None]
+    if points:
+        trend.plot(range(len(points)), [v for _, v in points], "o-")
+        trend.set_xticks(range(len(points)))
+        trend.set_xticklabels([t for t, _ in points], rotation=30, ha="right", fontsize=7)
+    trend.set_title("median per run")
+    trend.set_ylabel(m["unit"])
+    trend.grid(alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+    return True
+
+
+def _rows(run: dict, comparison: list) -> list:
+    """(metric, unit, n, median, p95, baseline median, change, p, status) per metric."""
+    compared = {c["metric"]: c for c in comparison}
+    rows = []
+    for name, m in run["metrics"].items():
+        s = summary(m["samples"])
+        c = compared.get(name)
+        rows.append((
+            name, m["unit"], str(s["n"]), _fmt(s.get("median")), _fmt(s.get("p95")),
+            _fmt(c["baseline"].get("median")) if c else "",
+            f"{c['change']:+.1%}" if c and c["change"] is not None else "",
+            _fmt(c["p_value"], ".3g") if c else "",
+            c["status"] if c else "no baseline",
+        ))
+    return rows
+
+
+HEADERS = ("metric", "unit", "n", "median", "p95", "baseline median", "change", "p", "status")
+
+
+def _header_lines(run: dict, baseline) -> list:
+    git = run["git"]
+    env = run["environment"]
+    return [
+        f"Suite: {run['suite']}",
+        f"Created: {run['created']}",
+        f"Revision: {git['revision'] or 'unknown'}{' (uncommitted changes)' if git['dirty'] else ''}"
+        f"{' on ' + git['branch'] if git['branch'] else ''}",
+        f"Machine: {env['hostname']}, {env['platform']}, {env['cpus']} CPUs, "
+        f"{env['implementation']} {env['python']}",
+        f"Baseline: {baseline['id'] if baseline else 'none'}",
+    ]
+
+
+def write_markdown(run: dict, baseline, comparison: list, images: dict, path: str):
+    lines = [f"# Benchmark run {run['id']}", ""]
+    lines += [f"- {line}" for line in _header_lines(run, baseline)]
+    regressions = [c["metric"] for c in comparison if c["status"] == "regression"]
+    lines += ["", f"**{len(regressions)} regression(s)**: {', '.join(regressions)}" if regressions
+              else "No regressions.", ""]
+    lines += ["| " + " | ".join(HEADERS) + " |", "|" + "---|" * len(HEADERS)]
+    for row in _rows(run, comparison):
+        cells = list(row)
+        if cells[-1] == "regression":
+            cells[-1] = "**regression**"
+        lines.append("| " + " | ".join(cells) + " |")
+    lines += ["", "## Configuration", "", "```json", json.dumps(run["config"], indent=2), "```", ""]
+    for name, image in images.items():
+        lines += [f"## {name}", "", f"![{name}]({image})", ""]
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def write_html(run: dict, baseline, comparison: list, images: dict, path: str):
+    e = html.escape
+    out = ["<!DOCTYPE html>", "<html><head><meta charset='utf-8'>",
+           f"<title>Benchmark run {e(run['id'])}</title>",
+           "<style>body{font-family:sans-serif;margin:2em}table{border-collapse:collapse}"
+           "td,th{border:1px solid #ccc;padding:4px 8px;text-align:right}td:first-child{text-align:left}"
+           "tr.regression{background:#fdd}tr.improvement{background:#dfd}</style>",
+           "</head><body>", f"<h1>Benchmark run {e(run['id'])}</h1>", "<ul>"]
+    out += [f"<li>{e(line)}</li>" for line in _header_lines(run, baseline)]
+    out += ["</ul>", "<table>", "<tr>" + "".join(f"<th>{e(h)}</th>" for h in HEADERS) + "</tr>"]
+    for row in _rows(run, comparison):
+        out.append(f"<tr class='{e(row[-1].replace(' ', '-'))}'>" + "".join(f"<td>{e(c)}</td>" for c in row) + "</tr>")
+    out += ["</table>", "<h2>Configuration</h2>", f"<pre>{e(json.dumps(run['config'], indent=2))}</pre>"]
+    for name, image in images.items():
+        out += [f"<h2>{e(name)}</h2>", f"<img src='{e(image)}' alt='{e(name)}'>"]
+    out.append("</body></html>")
+    with open(path, "w") as f:
+        f.write("\n".join(out))
+
+
+def write_report(run: dict, baseline, comparison: list, history: list, out_dir: str,
+                 formats=("md", "html")) -> list:
+    """Write the report files (and plots) for run into out_dir; returns their paths."""
+    os.makedirs(out_dir, exist_ok=True)
+    images = {}
+    for name in run["metrics"]:
+        image = f"{run['id']}-{name}.png"
+        if _plot(name, run, baseline, history, os.path.join(out_dir, image)):
+            images[name] = image
+    paths = []
+    if "md" in formats:
+        paths.append(os.path.join(out_dir, f"{run['id']}.md"))
+        write_markdown(run, baseline, comparison, images, paths[-1])
+    if "html" in formats:
+        paths.append(os.path.join(out_dir, f"{run['id']}.html"))
+        write_html(run, baseline, comparison, images, paths[-1])
+    return paths
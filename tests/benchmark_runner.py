@@ -0,0 +1,208 @@
+# benchmark_runner.py
+# Run benchmark suites headless, keep every run, and compare runs.
+#
+# Suites:
+#   network     PING latency and up/down throughput (network_performance.py)
+#   throughput  goodput per DATA frame size (throughput_benchmark.py)
+#   load        per-operation latency under many clients (load_test.py)
+#   latency     PING round trips, idle and next to a bulk transfer (latency_benchmark.py)
+#
+# Options the runner doesn't know are passed to the suite.
+#
+#   python tests/benchmark_runner.py run throughput --set-baseline -- --seconds 5
+#   python tests/benchmark_runner.py run load --fail-on-regression -- --clients 200
+#   python tests/benchmark_runner.py list
+#   python tests/benchmark_runner.py compare 20250101T120000Z-load --baseline 20241201T --report
+#
+# Each run is saved with its environment, configuration, git revision and raw
+# samples (results_store.py), compared with its suite's baseline (Mann-Whitney
+# U test, p < --alpha, median moved more than --threshold the wrong way), and
+# written up as Markdown and HTML with PNG plots (bench_report.py).
+# --fail-on-regression makes the exit status 1 when any metric regressed.
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_report  # noqa: E402
+from results_store import ALPHA, DEFAULT_STORE, THRESHOLD, ResultsStore, compare, metric  # noqa: E402
+
+SUITES = ("network", "throughput", "load", "latency")
+
+
+def add_store_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("results")
+    group.add_argument("--store", default=DEFAULT_STORE, help="results store directory")
+    group.add_argument("--set-baseline", action="store_true", help="make this run the suite's baseline")
+    group.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    group.add_argument("--alpha", type=float, default=ALPHA, help="significance level")
+    group.add_argument("--threshold", type=float, default=THRESHOLD,
+                       help="relative change of the median that counts (0.05 = 5%%)")
+    group.add_argument("--report-dir", help="where reports go (default: <store>/reports)")
+    group.add_argument("--no-report", action="store_true", help="don't write Markdown/HTML reports")
+
+
+def print_comparison(comparison: list, baseline_id: str):
+    print(f"\nCompared with baseline {baseline_id}:")
+    print(f"{'metric':<28}{'unit':>6}{'baseline':>11}{'current':>11}{'change':>9}{'p':>9}  status")
+    for c in comparison:
+        before, after = c["baseline"].get("median"), c["current"].get("median")
+        print(f"{c['metric']:<28}{c['unit']:>6}"
+              f"{format(before, '11.2f') if before is not None else 'n/a':>11}"
+              f"{format(after, '11.2f') if after is not None else 'n/a':>11}"
+              f"{format(c['change'], '+9.1%') if c['change'] is not None else '':>9}"
+              f"{format(c['p_value'], '9.3g') if c['p_value'] is not None else '':>9}"
+              f"  {c['status'].upper() if c['status'] == 'regression' else c['status']}")
+
+
+def report(store: ResultsStore, run: dict, baseline, comparison: list, out_dir: str = None) -> list:
+    history = store.runs(run["suite"])
+    paths = bench_report.write_report(run, baseline, comparison, history,
+                                      out_dir or os.path.join(store.path, "reports"))
+    for path in paths:
+        print(f"Report: {path}")
+    return paths
+
+
+def record(suite: str, config: dict, metrics: dict, raw, args) -> int:
+    """Save a run, compare it with the baseline and report; returns the exit status."""
+    store = ResultsStore(args.store)
+    baseline = store.baseline(suite)
+    run = store.save(suite, config, metrics, raw)
+    print(f"\nSaved run {run['id']} in {store.runs_dir}")
+    comparison = []
+    if baseline is not None:
+        comparison = compare(run, baseline, args.alpha, args.threshold)
+        print_comparison(comparison, baseline["id"])
+    else:
+        print(f"No baseline for '{suite}' yet (use --set-baseline).")
+    if args.set_baseline:
+        store.set_baseline(run)
+        print(f"Run {run['id']} is now the '{suite}' baseline.")
+    if not args.no_report:
+        report(store, run, baseline, comparison, args.report_dir)
+    regressions = [c["metric"] for c in comparison if c["status"] == "regression"]
+    if regressions:
+        print(f"REGRESSION in {', '.join(regressions)}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def network_suite(argv: list) -> tuple:
+    import network_performance
+    return network_performance.collect(network_performance.build_parser().parse_args(argv))
+
+
+def throughput_suite(argv: list) -> tuple:
+    import throughput_benchmark
+    args = throughput_benchmark.build_parser().parse_args(argv)
+    results = throughput_benchmark.run(args)
+    throughput_benchmark.print_results(results)
+    metrics = {}
+    for r in results:
+        for name in ("up", "down"):
+            if name in r:
+                samples = r[name]["samples_mb_s"]
+                # The last sample covers a partial interval.
+                metrics[f"{name}_{r['frame_size']}B_mb_s"] = metric("MB/s", "higher", samples[:-1] or samples)
+    config = {k: v for k, v in vars(args).items() if k not in ("password", "json")}
+    return config, metrics, results
+
+
+def load_suite(argv: list) -> tuple:
+    import load_test
+    args = load_test.build_parser().parse_args(argv)
+    result = load_test.run(args)
+    load_test.print_report(result)
+    metrics = {f"{op.lower()}_ms": metric("ms", "lower", o["samples_ms"])
+               for op, o in result["operations"].items() if o["samples_ms"]}
+    return result["config"], metrics, result
+
+
+def latency_suite(argv: list) -> tuple:
+    import latency_benchmark
+    args = latency_benchmark.build_parser().parse_args(argv)
+    result = latency_benchmark.run(args)
+    latency_benchmark.print_results(result)
+    metrics = {}
+    for phase in ("idle", "loaded"):
+        if phase in result:
+            probe = result[phase]
+            metrics[f"{phase}_rtt_ms"] = metric("ms", "lower", probe["samples_ms"])
+            if probe["stats"]["n"]:
+                metrics[f"{phase}_jitter_ms"] = metric("ms", "lower", [probe["stats"]["jitter"]])
+    config = {k: v for k, v in vars(args).items() if k not in ("password", "json")}
+    return config, metrics, result
+
+
+RUNNERS = {"network": network_suite, "throughput": throughput_suite, "load": load_suite,
+           "latency": latency_suite}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark runs, baselines and regression reports")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run a suite and record it")
+    run_parser.add_argument("suite", choices=SUITES)
+    add_store_arguments(run_parser)
+
+    list_parser = commands.add_parser("list", help="list stored runs")
+    list_parser.add_argument("--suite", choices=SUITES)
+    list_parser.add_argument("--store", default=DEFAULT_STORE)
+
+    baseline_parser = commands.add_parser("baseline", help="make a stored run its suite's baseline")
+    baseline_parser.add_argument("run", help="run id (or unique prefix)")
+    baseline_parser.add_argument("--store", default=DEFAULT_STORE)
+
+    compare_parser = commands.add_parser("compare", help="compare a stored run with a baseline")
+    compare_parser.add_argument("run", help="run id (or unique prefix)")
+    compare_parser.add_argument("--baseline", help="run to compare with (default: the suite's baseline)")
+    compare_parser.add_argument("--store", default=DEFAULT_STORE)
+    compare_parser.add_argument("--alpha", type=float, default=ALPHA)
+    compare_parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    compare_parser.add_argument("--fail-on-regression", action="store_true")
+    compare_parser.add_argument("--report", action="store_true", help="also write Markdown/HTML reports")
+    compare_parser.add_argument("--report-dir", help="where reports go (default: <store>/reports)")
+
+    args, rest = parser.parse_known_args()
+    if rest and rest[0] == "--":
+        rest = rest[1:]
+    if rest and args.command != "run":
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+
+    store = ResultsStore(args.store)
+    if args.command == "run":
+        config, metrics, raw = RUNNERS[args.suite](rest)
+        sys.exit(record(args.suite, config, metrics, raw, args))
+
+    if args.command == "list":
+        baselines = {suite: (b or {}).get("id") for suite, b in
+                     ((s, store.baseline(s)) for s in SUITES)}
+        for run in store.runs(args.suite):
+            rev = (run["git"]["revision"] or "")[:8] + ("+" if run["git"]["dirty"] else "")
+            mark = "  (baseline)" if baselines.get(run["suite"]) == run["id"] else ""
+            print(f"{run['id']:<44}{run['suite']:<12}{rev:<11}{len(run['metrics'])} metrics{mark}")
+        return
+
+    try:
+        run = store.load(args.run)
+        baseline = store.load(args.baseline) if getattr(args, "baseline", None) else store.baseline(run["suite"])
+    except KeyError as e:
+        parser.error(e.args[0])
+    if args.command == "baseline":
+        store.set_baseline(run)
+        print(f"Run {run['id']} is now the '{run['suite']}' baseline.")
+        return
+
+    if baseline is None:
+        parser.error(f"no baseline for '{run['suite']}'; pass --baseline")
+    comparison = compare(run, baseline, args.alpha, args.threshold)
+    print_comparison(comparison, baseline["id"])
+    if args.report:
+        report(store, run, baseline, comparison, args.report_dir)
+    regressions = [c["metric"] for c in comparison if c["status"] == "regression"]
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+
+if __name__ == "__main__":
+    main()
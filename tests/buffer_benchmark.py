@@ -0,0 +1,327 @@
+# buffer_benchmark.py
+# Allocations and throughput of the receive loops, before and after the
+# reusable-buffer layer (common/buffers.py, framing.FrameReader).
+#
+# Each case receives --megabytes over a loopback TCP connection fed by a
+# sender thread, once with the loop as it was (kept here as reference code)
+# and once with the code in the tree:
+#
+#   upload           text UPLOAD loop: conn.recv(64K) per piece, vs
+#                    recv_into a pooled buffer and write/hash its slices
+#   length-prefixed  legacy THROUGHPUT messages: recv + "data += chunk", vs
+#                    recv_length_prefixed_into one reused buffer
+#   frames           client reader thread: recv_frame (bytearray, then a
+#                    bytes copy per header and payload), vs FrameReader
+#   async-frames     server AsyncFrameReader: sock_recv + += + slice copy,
+#                    vs recv_into a fixed ring buffer
+#
+# Allocations are counted in a separate pass under tracemalloc: each receive
+# step (one recv or one frame) is run on its own and the memory it needed
+# above what it started with is its transient allocation. "allocs/MB"
+# counts the steps that needed 1 KiB or more, "alloc MB/MB" adds up how
+# much. The timed pass runs without tracemalloc.
+#
+#   python tests/buffer_benchmark.py
+#   python tests/buffer_benchmark.py --cases frames,async-frames --frame-size 1K,64K,1M --megabytes 512
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from common import buffers, checksums, framing  # noqa: E402
+from common.framing import Op  # noqa: E402
+
+CHUNK_SIZE = 65536  # the text protocol's upload piece
+SEND_BLOCK = 262144
+ALLOC_THRESHOLD = 1024
+CASES = ("upload", "length-prefixed", "frames", "async-frames")
+
+
+# ----------------------------------------------------------------------------
+# The loops as they were
+# ----------------------------------------------------------------------------
+
+def legacy_recv_length_prefixed(conn: socket.socket) -> bytes:
+    length_data = b""
+    while len(length_data) < 4:
+        chunk = conn.recv(4 - len(length_data))
+        if not chunk:
+            raise ConnectionError("Connection closed while reading length")
+        length_data += chunk
+    length = struct.unpack("!I", length_data)[0]
+    data = b""
+    while len(data) < length:
+        chunk = conn.recv(min(CHUNK_SIZE, length - len(data)))
+        if not chunk:
+            raise ConnectionError("Connection closed while reading data")
+        data += chunk
+    return data
+
+
+def legacy_recv_exact(conn: socket.socket, n: int) -> bytes:
+    data = bytearray(n)
+    framing.recv_into_exact(conn, memoryview(data))
+    return bytes(data)
+
+
+def legacy_recv_frame(conn: socket.socket) -> framing.Frame:
+    op, flags, request_id, length = framing.parse_header(legacy_recv_exact(conn, framing.HEADER_SIZE))
+    payload = legacy_recv_exact(conn, length) if length else b""
+    return framing.Frame(op, request_id, flags, payload)
+
+
+class LegacyAsyncFrameReader:
+    def __init__(self, loop, conn: socket.socket, bufsize: int = 262144):
+        self.loop = loop
+        self.conn = conn
+        self.bufsize = bufsize
+        self._buf = bytearray()
+
+    async def read_exact(self, n: int) -> bytes:
+        if n >= self.bufsize and len(self._buf) < n:
+            data = bytearray(n)
+            view = memoryview(data)
+            received = len(self._buf)
+            view[:received] = self._buf
+            del self._buf[:]
+            while received < n:
+                count = await self.loop.sock_recv_into(self.conn, view[received:])
+                if not count:
+                    raise ConnectionError("Connection closed while reading data")
+                received += count
+            return data
+        while len(self._buf) < n:
+            chunk = await self.loop.sock_recv(self.conn, max(self.bufsize, n - len(self._buf)))
+            if not chunk:
+                raise ConnectionError("Connection closed while reading data")
+            self._buf += chunk
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    async def read_frame(self) -> framing.Frame:
+        op, flags, request_id, length = framing.parse_header(await self.read_exact(framing.HEADER_SIZE))
+        payload = await self.read_exact(length) if length else b""
+        return framing.Frame(op, request_id, flags, payload)
+
+
+# ----------------------------------------------------------------------------
+# Receive steps: each call takes one piece/message/frame off the socket and
+# returns how many payload bytes it was.
+# ----------------------------------------------------------------------------
+
+def upload_steps(conn, sink, hasher, legacy: bool):
+    if legacy:
+        def step():
+            chunk = conn.recv(CHUNK_SIZE)
+            sink.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            return len(chunk)
+        return step, None
+    pool = buffers.pool(CHUNK_SIZE)
+    buf = pool.acquire()
+    view = memoryview(buf)
+
+    def step():
+        n = conn.recv_into(view, CHUNK_SIZE)
+        sink.write(view[:n])
+        if hasher is not None:
+            hasher.update(view[:n])
+        return n
+    return step, lambda: pool.release(buf)
+
+
+def length_prefixed_steps(conn, legacy: bool):
+    if legacy:
+        return (lambda: len(legacy_recv_length_prefixed(conn))), None
+    buf = bytearray(1024)
+    return (lambda: framing.recv_length_prefixed_into(conn, buf)), None
+
+
+def frame_steps(conn, legacy: bool):
+    if legacy:
+        return (lambda: len(legacy_recv_frame(conn).payload)), None
+    reader = framing.FrameReader(conn)
+    return (lambda: len(reader.read_frame().payload)), None
+
+
+# ----------------------------------------------------------------------------
+# Harness
+# ----------------------------------------------------------------------------
+
+def connected_pair() -> tuple:
+    listener = socket.create_server(("127.0.0.1", 0))
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+    for sock in (sender, receiver):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sender, receiver
+
+
+def feed(sock: socket.socket, block: bytes):
+    """Send block over and over until the receiver hangs up."""
+    try:
+        while True:
+            sock.sendall(block)
+    except OSError:
+        pass
+
+
+def wire_block(case: str, frame_size: int) -> bytes:
+    if case == "upload":
+        return bytes(SEND_BLOCK)
+    if case == "length-prefixed":
+        unit = framing.pack_length_prefixed(bytes(frame_size))
+    else:
+        unit = framing.pack_frame(Op.DATA, 1, bytes(frame_size))
+    return unit * max(1, SEND_BLOCK // len(unit))
+
+
+def measure(case: str, frame_size: int, legacy: bool, total: int, alloc_steps: int, hash_upload: bool) -> dict:
+    sender, receiver = connected_pair()
+    feeder = threading.Thread(target=feed, args=(sender, wire_block(case, frame_size)), daemon=True)
+    feeder.start()
+    sink = open(os.devnull, "wb")
+    try:
+        if case == "async-frames":
+            result = asyncio.run(measure_async(receiver, legacy, total, alloc_steps))
+        else:
+            if case == "upload":
+                step, done = upload_steps(receiver, sink, checksums.new() if hash_upload else None, legacy)
+            elif case == "length-prefixed":
+                step, done = length_prefixed_steps(receiver, legacy)
+            else:
+                step, done = frame_steps(receiver, legacy)
+            result = run_steps(step, total, alloc_steps)
+            if done is not None:
+                done()
+    finally:
+        receiver.close()  # resets the connection, which stops the feeder
+        feeder.join()
+        sender.close()
+        sink.close()
+    result.update(case=case, frame_size=frame_size if case != "upload" else CHUNK_SIZE,
+                  variant="before" if legacy else "after")
+    return result
+
+
+def summarize(received: int, seconds: float, alloc_bytes: int, allocs: int, counted: int) -> dict:
+    mb = counted / 1048576 or 1
+    return {"mb_s": received / 1048576 / seconds if seconds > 0 else 0.0,
+            "allocs_per_mb": allocs / mb, "alloc_mb_per_mb": alloc_bytes / 1048576 / mb}
+
+
+def run_steps(step, total: int, alloc_steps: int) -> dict:
+    # Warm up (pools, first buffers), then time, then count allocations.
+    for _ in range(8):
+        step()
+    received = 0
+    started = time.perf_counter()
+    while received < total:
+        received += step()
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    alloc_bytes = allocs = counted = 0
+    try:
+        for _ in range(alloc_steps):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            counted += step()
+            extra = tracemalloc.get_traced_memory()[1] - before
+            if extra >= ALLOC_THRESHOLD:
+                allocs += 1
+                alloc_bytes += extra
+    finally:
+        tracemalloc.stop()
+    return summarize(received, seconds, alloc_bytes, allocs, counted)
+
+
+async def measure_async(conn: socket.socket, legacy: bool, total: int, alloc_steps: int) -> dict:
+    loop = asyncio.get_running_loop()
+    conn.setblocking(False)
+    reader = LegacyAsyncFrameReader(loop, conn) if legacy else framing.AsyncFrameReader(loop, conn)
+    for _ in range(8):
+        await reader.read_frame()
+    received = 0
+    started = time.perf_counter()
+    while received < total:
+        received += len((await reader.read_frame()).payload)
+    seconds = time.perf_counter() - started
+
+    tracemalloc.start()
+    alloc_bytes = allocs = counted = 0
+    try:
+        for _ in range(alloc_steps):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            counted += len((await reader.read_frame()).payload)
+            extra = tracemalloc.get_traced_memory()[1] - before
+            if extra >= ALLOC_THRESHOLD:
+                allocs += 1
+                alloc_bytes += extra
+    finally:
+        tracemalloc.stop()
+    return summarize(received, seconds, alloc_bytes, allocs, counted)
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip("B")
+    scale = {"K": 1024, "M": 1048576}.get(text[-1:], 1)
+    return int(float(text.rstrip("KM")) * scale)
+
+
+def print_results(results: list):
+    print(f"\n{'case':<17}{'frame':>9}{'variant':>9}{'MB/s':>10}{'allocs/MB':>11}{'alloc MB/MB':>13}{'speedup':>9}")
+    before = {}
+    for r in results:
+        key = (r["case"], r["frame_size"])
+        speedup = ""
+        if r["variant"] == "before":
+            before[key] = r
+        elif key in before and before[key]["mb_s"]:
+            speedup = f"{r['mb_s'] / before[key]['mb_s']:.2f}x"
+        print(f"{r['case']:<17}{r['frame_size']:>9}{r['variant']:>9}{r['mb_s']:>10.1f}"
+              f"{r['allocs_per_mb']:>11.1f}{r['alloc_mb_per_mb']:>13.2f}{speedup:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive-loop allocations and throughput, before and after")
+    parser.add_argument("--cases", default=",".join(CASES), help=f"comma separated, from {', '.join(CASES)}")
+    parser.add_argument("--frame-size", default="1K,64K", help="message/frame sizes (not used by upload)")
+    parser.add_argument("--megabytes", type=float, default=256, help="data received per timed run")
+    parser.add_argument("--alloc-steps", type=int, default=2000, help="steps counted under tracemalloc")
+    parser.add_argument("--hash", action="store_true", help="hash uploads as the server does")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    cases = [c.strip() for c in args.cases.split(",")]
+    for case in cases:
+        if case not in CASES:
+            parser.error(f"unknown case '{case}'")
+    total = int(args.megabytes * 1048576)
+    results = []
+    for case in cases:
+        sizes = [CHUNK_SIZE] if case == "upload" else [parse_size(s) for s in args.frame_size.split(",")]
+        for size in sizes:
+            for legacy in (True, False):
+                print(f"{case} {size}B {'before' if legacy else 'after'}...", file=sys.stderr)
+                results.append(measure(case, size, legacy, total, args.alloc_steps, args.hash))
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
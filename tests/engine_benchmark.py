@@ -0,0 +1,198 @@
+# engine_benchmark.py
+# Compare the threaded and asyncio server engines under many idle clients.
+#
+# For each engine a local server is started on loopback, N clients connect
+# and log in, then a sample of them send PINGs while the rest stay idle.
+# Reports connect time, PING latency and the server's RSS / thread count
+# (read from /proc, so those two columns are Linux only).
+#
+#   python tests/engine_benchmark.py --clients 2000
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(ROOT, "server", "2nd_server.py")
+FORMAT = "utf-8"
+SIZE = 1024
+USERNAME = "Dennis"
+PASSWORD = "password"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit(needed: int):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+def proc_status(pid: int) -> dict:
+    stats = {"rss_mb": None, "threads": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def write_users(path: str, names, password: str = PASSWORD):
+    """A user store where every one of names logs in with password (as the
+    legacy MD5 hash, which the server upgrades on first login)."""
+    md5 = hashlib.md5(password.encode()).hexdigest()
+    with open(path, "w") as f:
+        json.dump({name: md5 for name in names}, f)
+
+
+def start_server(engine: str, port: int, root: str, extra=()) -> subprocess.Popen:
+    """Start a local server with extra command-line flags; returns once it accepts connections."""
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--engine", engine, "--host", "127.0.0.1",
+         "--port", str(port), "--root", root] + list(extra),
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{engine} server did not start")
+
+
+async def open_client(port: int):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.read(SIZE)  # welcome
+    writer.write(f"LOGIN@{USERNAME}@{PASSWORD}".encode(FORMAT))
+    await writer.drain()
+    resp = (await reader.read(SIZE)).decode(FORMAT)
+    if not resp.startswith("OK@AUTH_SUCCESS"):
+        raise ConnectionError(resp)
+    return reader, writer
+
+
+async def ping(reader, writer) -> float:
+    start = time.perf_counter()
+    writer.write(b"PING")
+    await writer.drain()
+    resp = await reader.read(SIZE)
+    if resp != b"PONG":
+        raise ConnectionError(resp)
+    return (time.perf_counter() - start) * 1000
+
+
+async def run_clients(port: int, clients: int, pings: int, pid: int) -> dict:
+    start = time.perf_counter()
+    connections = []
+    failures = 0
+    # Connect in waves so the benchmark measures the server, not SYN drops.
+    for offset in range(0, clients, 200):
+        wave = await asyncio.gather(
+            *(open_client(port) for _ in range(offset, min(offset + 200, clients))),
+            return_exceptions=True,
+        )
+        for result in wave:
+            if isinstance(result, Exception):
+                failures += 1
+            else:
+                connections.append(result)
+    connect_s = time.perf_counter() - start
+
+    loaded = proc_status(pid)
+    latencies = []
+    sample = connections[:: max(1, len(connections) // 50)]
+    for _ in range(pings):
+        latencies.extend(await asyncio.gather(*(ping(r, w) for r, w in sample)))
+
+    for _, writer in connections:
+        writer.close()
+    await asyncio.gather(*(w.wait_closed() for _, w in connections), return_exceptions=True)
+
+    return {
+        "connected": len(connections),
+        "failed": failures,
+        "connect_s": connect_s,
+        "ping_p50_ms": statistics.median(latencies) if latencies else None,
+        "ping_p99_ms": (statistics.quantiles(latencies, n=100)[98]
+                        if len(latencies) >= 2 else None),
+        "server_rss_mb": loaded["rss_mb"],
+        "server_threads": loaded["threads"],
+    }
+
+
+def benchmark(engine: str, clients: int, pings: int) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory() as root:
+        # Every client comes from one IP and logs in as one user, so lift the
+        # admission limits above the client count.
+        limit = str(clients + 64)
+        proc = start_server(engine, port, root, ["--max-connections", limit, "--workers", limit,
+                                                 "--max-per-ip", "0", "--max-per-user", "0"])
+        try:
+            idle = proc_status(proc.pid)
+            result = asyncio.run(run_clients(port, clients, pings, proc.pid))
+            result["idle_rss_mb"] = idle["rss_mb"]
+        finally:
+            proc.terminate()
+            proc.wait()
+    result["engine"] = engine
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Threaded vs asyncio engine benchmark")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--pings", type=int, default=20, help="PING rounds over the sampled clients")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients * 2 + 256)
+
+    results = []
+    for engine in args.engines:
+        print(f"Benchmarking {engine} engine with {args.clients} clients...")
+        results.append(benchmark(engine, args.clients, args.pings))
+
+    print("\n" + "=" * 78)
+    print(f"{'engine':<10}{'clients':>9}{'connect s':>11}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'RSS MB':>9}{'idle MB':>9}{'threads':>9}")
+    for r in results:
+        def fmt(v, spec):
+            return format(v, spec) if v is not None else "n/a"
+        print(f"{r['engine']:<10}{r['connected']:>9}{r['connect_s']:>11.2f}"
+              f"{fmt(r['ping_p50_ms'], '9.2f')}{fmt(r['ping_p99_ms'], '9.2f')}"
+              f"{fmt(r['server_rss_mb'], '9.1f')}{fmt(r['idle_rss_mb'], '9.1f')}"
+              f"{fmt(r['server_threads'], '9d')}")
+    print("=" * 78)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
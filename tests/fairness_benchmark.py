@@ -0,0 +1,187 @@
+# fairness_benchmark.py
+# Bulk downloads next to interactive clients, with and without shaping.
+#
+# A local server is started once per scenario (no limits, a global limit, a
+# per-user limit, a limit on the transfer class). While it runs:
+#
+#   bulk         --bulk users each DOWNLOAD a large file over and over,
+#   greedy       one more user does the same over --greedy connections,
+#   interactive  --interactive clients send PING every 10 ms and DIR every
+#                100 ms and time the replies.
+#
+# Reports the aggregate download rate, each user's share (with Jain's
+# fairness index over users: 1.0 means perfectly even) and the PING / DIR
+# latency the interactive clients saw.
+#
+#   python tests/fairness_benchmark.py --limit 100 --duration 10
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import FORMAT, SIZE, free_port, start_server, write_users  # noqa: E402
+
+PASSWORD = "password"
+FILENAME = "bulk.bin"
+
+
+def login(port: int, username: str) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.settimeout(30)
+    sock.recv(SIZE)
+    sock.send(f"LOGIN@{username}@{PASSWORD}".encode(FORMAT))
+    reply = sock.recv(SIZE).decode(FORMAT)
+    if not reply.startswith("OK@AUTH_SUCCESS"):
+        raise RuntimeError(f"login as {username} failed: {reply}")
+    return sock
+
+
+def bulk_client(port: int, username: str, deadline: float, counts: dict, key):
+    """Download FILENAME in a loop until deadline; counts[key] = bytes received."""
+    sock = login(port, username)
+    buf = bytearray(1048576)
+    received = 0
+    try:
+        while time.perf_counter() < deadline:
+            sock.send(f"DOWNLOAD@{FILENAME}".encode(FORMAT))
+            size = int(sock.recv(SIZE).decode(FORMAT).split("@")[1])
+            sock.send(b"READY")
+            left = size
+            while left and time.perf_counter() < deadline:
+                n = sock.recv_into(buf, min(left, len(buf)))
+                if not n:
+                    return
+                left -= n
+                received += n
+            if left:
+                return  # out of time mid-file; closing drops the rest
+    finally:
+        counts[key] = received
+        sock.close()
+
+
+def interactive_client(port: int, username: str, deadline: float, pings: list, dirs: list):
+    sock = login(port, username)
+    try:
+        n = 0
+        while time.perf_counter() < deadline:
+            command, latencies = ("DIR", dirs) if n % 10 == 0 else ("PING", pings)
+            start = time.perf_counter()
+            sock.send(command.encode(FORMAT))
+            sock.recv(65536)
+            latencies.append((time.perf_counter() - start) * 1000)
+            n += 1
+            time.sleep(0.01)
+    finally:
+        sock.close()
+
+
+def jain(values: list) -> float:
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values)) if any(values) else 0.0
+
+
+def p99(values: list):
+    return statistics.quantiles(values, n=100)[98] if len(values) >= 2 else None
+
+
+def run_scenario(name: str, extra: list, args) -> dict:
+    port = free_port()
+    users = [f"bulk{i}" for i in range(args.bulk)] + ["greedy", "interactive"]
+    with tempfile.TemporaryDirectory() as root:
+        data = os.path.join(root, "data")
+        os.makedirs(data)
+        with open(os.path.join(data, FILENAME), "wb") as f:
+            f.write(os.urandom(args.file_mb * 1048576))
+        users_file = os.path.join(root, "users.json")
+        write_users(users_file, users)
+        proc = start_server(args.engine, port, data, ["--users", users_file, "--max-per-user", "0",
+                                                      "--cache-size", "0", "--no-compression"] + extra)
+        try:
+            # Log everyone in once first so the scrypt migration is not timed.
+            for username in users:
+                login(port, username).close()
+
+            counts, pings, dirs = {}, [], []
+            deadline = time.perf_counter() + args.duration
+            threads = [threading.Thread(target=bulk_client, args=(port, f"bulk{i}", deadline, counts, (f"bulk{i}", 0)))
+                       for i in range(args.bulk)]
+            threads += [threading.Thread(target=bulk_client, args=(port, "greedy", deadline, counts, ("greedy", i)))
+                        for i in range(args.greedy)]
+            threads += [threading.Thread(target=interactive_client, args=(port, "interactive", deadline, pings, dirs))
+                        for _ in range(args.interactive)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    per_user = {}
+    for (username, _), n in counts.items():
+        per_user[username] = per_user.get(username, 0) + n
+    rates = {u: n / args.duration / 1048576 for u, n in sorted(per_user.items())}
+    return {
+        "scenario": name,
+        "engine": args.engine,
+        "total_mb_s": sum(rates.values()),
+        "user_mb_s": rates,
+        "jain": jain(list(rates.values())),
+        "ping_p50_ms": statistics.median(pings) if pings else None,
+        "ping_p99_ms": p99(pings),
+        "dir_p99_ms": p99(dirs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bandwidth shaping fairness benchmark")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--bulk", type=int, default=3, help="users downloading over one connection each")
+    parser.add_argument("--greedy", type=int, default=4, help="connections of the one greedy user")
+    parser.add_argument("--interactive", type=int, default=2, help="clients sending PING / DIR")
+    parser.add_argument("--file-mb", type=int, default=64, help="size of the file downloaded")
+    parser.add_argument("--duration", type=float, default=8.0, help="seconds per scenario")
+    parser.add_argument("--limit", type=float, default=100.0, metavar="MB/s",
+                        help="global / class limit; the per-user limit is this over the number of users")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    per_user = args.limit / (args.bulk + 1)
+    scenarios = [
+        ("unlimited", []),
+        (f"global {args.limit:g}", ["--rate-limit", str(args.limit)]),
+        (f"per user {per_user:.3g}", ["--user-rate-limit", str(per_user)]),
+        (f"transfer {args.limit:g}", ["--class-rate-limit", f"transfer={args.limit}"]),
+    ]
+
+    results = []
+    for name, extra in scenarios:
+        print(f"Running '{name}' on the {args.engine} engine...")
+        results.append(run_scenario(name, extra, args))
+
+    def fmt(v, spec):
+        return format(v, spec) if v is not None else "n/a"
+
+    print("\n" + "=" * 88)
+    print(f"{'scenario':<18}{'MB/s':>9}{'min user':>10}{'max user':>10}{'greedy':>9}{'Jain':>7}"
+          f"{'PING p50':>9}{'PING p99':>9}{'DIR p99':>9}")
+    for r in results:
+        rates = r["user_mb_s"]
+        print(f"{r['scenario']:<18}{r['total_mb_s']:>9.1f}{min(rates.values(), default=0):>10.1f}"
+              f"{max(rates.values(), default=0):>10.1f}{rates.get('greedy', 0):>9.1f}{r['jain']:>7.3f}"
+              f"{fmt(r['ping_p50_ms'], '9.2f')}{fmt(r['ping_p99_ms'], '9.2f')}{fmt(r['dir_p99_ms'], '9.2f')}")
+    print("=" * 88)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# fsync_benchmark.py
+# Cost of each upload durability policy (server/durable.py).
+#
+# Writes files through the server's own upload path (storage.PartialUpload:
+# buffered, preallocated .part file, then commit) into a scratch folder and
+# times each file from first write to the end of the commit, once per fsync
+# policy and file size. Point --root at the disk you care about: fsync cost
+# depends entirely on the device (and is near zero on tmpfs).
+#
+#   python tests/fsync_benchmark.py --root /srv/scratch --sizes 4096 1048576 16777216
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+import config
+import durable
+import storage
+
+WRITE_SIZE = 262144  # the server's DATA frame size
+
+
+def write_files(folder: str, size: int, count: int) -> list:
+    """Upload count files of size bytes; returns the seconds each one took."""
+    payload = os.urandom(min(size, WRITE_SIZE)) if size else b""
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        partial = storage.PartialUpload(os.path.join(folder, f"f{i}"), size, resumable=False)
+        with partial.open() as f:
+            written = 0
+            while written < size:
+                n = min(len(payload), size - written)
+                f.write(payload[:n])
+                written += n
+        partial.commit()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(policy: str, size: int, count: int, scratch: str) -> dict:
+    config.FSYNC_POLICY = policy
+    folder = os.path.join(scratch, f"{policy}-{size}")
+    os.makedirs(folder)
+    before = durable.stats()
+    times = write_files(folder, size, count)
+    after = durable.stats()
+    total = sum(times)
+    times.sort()
+    return {
+        "policy": policy,
+        "size": size,
+        "files": count,
+        "p50_ms": statistics.median(times) * 1000,
+        "p99_ms": times[min(len(times) - 1, int(len(times) * 0.99))] * 1000,
+        "mb_per_s": size * count / total / 1048576 if total else 0.0,
+        "fsyncs": (after["file_syncs"] - before["file_syncs"]) + (after["dir_syncs"] - before["dir_syncs"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload durability (fsync policy) benchmark")
+    parser.add_argument("--root", default=None, help="scratch folder on the disk to test (default: a temp dir)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4096, 1048576, 16777216])
+    parser.add_argument("--total", type=int, default=64 * 1048576,
+                        help="bytes written per size and policy (at least 10 files, at most --max-files)")
+    parser.add_argument("--max-files", type=int, default=500)
+    parser.add_argument("--policies", nargs="+", choices=durable.POLICIES, default=list(durable.POLICIES))
+    parser.add_argument("--no-preallocate", action="store_true")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="fsync-bench-", dir=args.root)
+    config.SERVER_PATH = scratch
+    config.STORAGE_BACKEND = "plain"
+    config.CACHE_SIZE = 0
+    config.PREALLOCATE = not args.no_preallocate
+    storage.ensure_root()
+
+    results = []
+    try:
+        print(f"{'policy':<10} {'size':>10} {'files':>6} {'p50 ms':>9} {'p99 ms':>9} {'MB/s':>9} {'fsyncs':>7}")
+        for size in args.sizes:
+            count = max(10, min(args.max_files, args.total // max(size, 1)))
+            for policy in args.policies:
+                r = run(policy, size, count, scratch)
+                results.append(r)
+                print(f"{r['policy']:<10} {r['size']:>10} {r['files']:>6} {r['p50_ms']:>9.3f} "
+                      f"{r['p99_ms']:>9.3f} {r['mb_per_s']:>9.1f} {r['fsyncs']:>7}")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# latency_benchmark.py
+# Round-trip latency of the framed protocol, idle and under load.
+#
+# Each PING carries a sequence number and the client's send time
+# (perf_counter_ns); the server echoes the payload in its PONG, so the RTT
+# is taken from the echoed timestamp the moment the PONG is read, not from
+# when a caller got round to waiting for it. A sender thread keeps up to
+# --depth PINGs in flight (1 = one at a time, more = pipelined) and paces
+# them --interval ms apart; the first --warmup replies are discarded.
+#
+# TCP does not lose messages, so nothing here is "packet loss": a PING with
+# no PONG within --timeout is counted as a timeout and ends the probe.
+#
+# With --load up|down|both the probe runs a second time next to a bulk
+# THROUGHPUT transfer on --load-streams other connections (see
+# throughput_benchmark.py). The rise of the median RTT over the idle run is
+# the queueing delay the bulk data adds (bufferbloat).
+#
+#   python tests/latency_benchmark.py --count 1000 --depth 8
+#   python tests/latency_benchmark.py --load both --load-seconds 10 --interval 10
+#   python tests/latency_benchmark.py --host 192.168.1.10 --user Dennis --password ... --load down
+import argparse
+import json
+import os
+import select
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import free_port  # noqa: E402
+from load_test import percentile  # noqa: E402
+from throughput_benchmark import open_stream, parse_size, run_throughput, start_server, write_users  # noqa: E402
+
+from common import framing  # noqa: E402  (throughput_benchmark put the repo root on sys.path)
+from common.framing import Op  # noqa: E402
+
+PING = struct.Struct("!QQ")  # sequence number, send time in perf_counter_ns
+LOAD_RAMP = 1.0  # seconds the bulk transfer runs before the loaded probe starts
+# Histogram bucket upper bounds in ms: 1-2-5 steps from 10 us to 10 s.
+BUCKETS = [m * 10.0 ** e for e in range(-2, 4) for m in (1, 2, 5)] + [10000.0]
+
+
+def latency_stats(samples: list) -> dict:
+    """min/avg/p50/p90/p99/max and jitter (mean change between consecutive RTTs)
+    of RTTs in ms, in the order the PINGs were sent."""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    jitter = (statistics.fmean(abs(b - a) for a, b in zip(samples, samples[1:]))
+              if len(samples) > 1 else 0.0)
+    return {"n": len(samples), "min": ordered[0], "avg": statistics.fmean(samples),
+            "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            "p50": percentile(ordered, 0.50), "p90": percentile(ordered, 0.90),
+            "p99": percentile(ordered, 0.99), "max": ordered[-1], "jitter": jitter}
+
+
+def histogram(samples: list) -> list:
+    """[(bucket upper bound in ms, count), ...] over BUCKETS, empty ends trimmed."""
+    counts = [0] * len(BUCKETS)
+    for v in samples:
+        for i, bound in enumerate(BUCKETS):
+            if v <= bound or i == len(BUCKETS) - 1:
+                counts[i] += 1
+                break
+    used = [i for i, n in enumerate(counts) if n]
+    if not used:
+        return []
+    return [(BUCKETS[i], counts[i]) for i in range(used[0], used[-1] + 1)]
+
+
+class Probe:
+    """PINGs on one logged-in connection: a sender thread keeps up to `depth`
+    unanswered, `interval` s apart; run() reads the PONGs."""
+
+    def __init__(self, sock: socket.socket, depth: int = 1, interval: float = 0.0, size: int = PING.size):
+        self.sock = sock
+        self.depth = depth
+        self.interval = interval
+        self.padding = bytes(max(0, size - PING.size))
+        self.window = threading.Semaphore(depth)
+        self.lock = threading.Lock()
+        self.pending = {}  # seq -> send time (perf_counter_ns) of unanswered PINGs
+        self.done = False  # the sender has sent its last PING
+
+    def send(self, total: int, deadline: float):
+        """PING frames seq 0..total-1, or until the deadline."""
+        started = time.perf_counter()
+        try:
+            for seq in range(total):
+                while not self.window.acquire(timeout=0.1):
+                    if self.done:
+                        return
+                if self.interval:
+                    delay = started + seq * self.interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                with self.lock:
+                    if self.done or deadline and time.perf_counter() >= deadline:
+                        return
+                    sent = time.perf_counter_ns()
+                    self.pending[seq] = sent
+                framing.send_frame(self.sock, Op.PING, seq % 0xFFFFFFFF + 1,
+                                   PING.pack(seq, sent) + self.padding)
+        except OSError:
+            pass  # run() sees the connection fail too
+        finally:
+            with self.lock:
+                self.done = True
+
+    def run(self, count: int, warmup: int = 10, timeout: float = 5.0, duration: float = None) -> dict:
+        """RTTs (ms) of warmup + count PINGs, or of those sent in `duration`
+        seconds, with the warm-up left out."""
+        deadline = time.perf_counter() + duration if duration else None
+        total = warmup + count if not duration else 1 << 62
+        sender = threading.Thread(target=self.send, args=(total, deadline), daemon=True)
+        rtts = {}
+        out_of_order = last_seq = timeouts = 0
+        sender.start()
+        try:
+            while True:
+                # Poll so the end of the run (and a lost reply) is noticed
+                # while no PONG is on its way.
+                if not select.select([self.sock], [], [], 0.05)[0]:
+                    with self.lock:
+                        if self.done and not self.pending:
+                            break
+                        oldest = min(self.pending.values(), default=None)
+                    if oldest is not None and time.perf_counter_ns() - oldest > timeout * 1e9:
+                        timeouts = len(self.pending)
+                        break
+                    continue
+                frame = framing.recv_frame(self.sock)
+                now = time.perf_counter_ns()
+                if frame.op == Op.ERR:
+                    raise ConnectionError(frame.json().get("message", "PING failed"))
+                if frame.op != Op.PONG:
+                    continue
+                seq, sent = PING.unpack_from(frame.payload)
+                with self.lock:
+                    self.pending.pop(seq, None)
+                self.window.release()
+                if seq < last_seq:
+                    out_of_order += 1
+                last_seq = max(last_seq, seq)
+                if seq >= warmup:
+                    rtts[seq] = (now - sent) / 1e6
+        finally:
+            with self.lock:
+                self.done = True
+            sender.join()
+        samples = [rtts[seq] for seq in sorted(rtts)]
+        return {"count": len(samples), "warmup": warmup, "depth": self.depth,
+                "interval_ms": self.interval * 1000, "size": PING.size + len(self.padding),
+                "timeouts": timeouts, "out_of_order": out_of_order,
+                "stats": latency_stats(samples), "histogram": histogram(samples), "samples_ms": samples}
+
+
+def run_probe(sock: socket.socket, count: int, warmup: int = 10, depth: int = 1, interval: float = 0.0,
+              size: int = PING.size, timeout: float = 5.0, duration: float = None) -> dict:
+    """Probe an already logged-in connection (see Probe.run)."""
+    return Probe(sock, depth, interval, size).run(count, warmup, timeout, duration)
+
+
+def run_latency(host: str, port: int, login: dict, count: int = 200, warmup: int = 10, depth: int = 1,
+                interval: float = 0.0, size: int = PING.size, timeout: float = 5.0, load: str = None,
+                load_seconds: float = 10.0, load_streams: int = 4, load_frame_size: int = 1048576) -> dict:
+    """Idle probe, then (with `load`) a second probe during a bulk transfer."""
+    sock, reply = open_stream(host, port, login)
+    try:
+        result = {"idle": run_probe(sock, count, warmup, depth, interval, size, timeout)}
+        if load:
+            # The bulk streams reuse the probe's session.
+            bulk_login = {"token": reply["token"]} if reply.get("token") else login
+            bulk = {}
+
+            def transfer():
+                try:
+                    bulk.update(run_throughput(host, port, bulk_login, load, load_frame_size,
+                                               load_seconds, load_streams))
+                except Exception as e:
+                    bulk["error"] = str(e)
+
+            loader = threading.Thread(target=transfer, daemon=True)
+            loader.start()
+            time.sleep(LOAD_RAMP)
+            # Stop probing a little before the transfer does, so every PING
+            # saw the queues full.
+            loaded = run_probe(sock, count, warmup, depth, interval, size, timeout,
+                               duration=max(0.5, load_seconds - LOAD_RAMP - 0.5))
+            loader.join()
+            if "error" in bulk:
+                raise ConnectionError(f"Bulk transfer failed: {bulk['error']}")
+            loaded["load"] = bulk
+            result["loaded"] = loaded
+            idle, busy = result["idle"]["stats"], loaded["stats"]
+            if idle["n"] and busy["n"]:
+                result["bufferbloat_ms"] = busy["p50"] - idle["p50"]
+        try:
+            framing.send_json(sock, Op.LOGOUT, 1, {})
+        except OSError:
+            pass
+    finally:
+        sock.close()
+    return result
+
+
+def print_probe(name: str, probe: dict):
+    s = probe["stats"]
+    print(f"\n{name}: {probe['count']} RTTs (after {probe['warmup']} warm-up), depth {probe['depth']}, "
+          f"{probe['size']}B PINGs, every {probe['interval_ms']:g} ms")
+    if not s["n"]:
+        print("  no replies")
+        return
+    print(f"  min {s['min']:.3f}  avg {s['avg']:.3f}  p50 {s['p50']:.3f}  p90 {s['p90']:.3f}  "
+          f"p99 {s['p99']:.3f}  max {s['max']:.3f}  jitter {s['jitter']:.3f}  (ms)")
+    if probe["timeouts"] or probe["out_of_order"]:
+        print(f"  timeouts {probe['timeouts']}, out of order {probe['out_of_order']}")
+    top = max(n for _, n in probe["histogram"])
+    for bound, n in probe["histogram"]:
+        print(f"  <= {bound:>9g} ms {n:>7} {'#' * max(1 if n else 0, round(n / top * 50))}")
+
+
+def print_results(result: dict):
+    print_probe("Idle", result["idle"])
+    if "loaded" in result:
+        load = result["loaded"]["load"]
+        rates = ", ".join(f"{name} {load[name]['goodput_mb_s']:.1f} MB/s" for name in ("up", "down")
+                          if name in load)
+        print_probe(f"Under load ({load['direction']}, {load['streams']} streams: {rates})", result["loaded"])
+        if "bufferbloat_ms" in result:
+            print(f"\nBufferbloat: median RTT {result['bufferbloat_ms']:+.3f} ms under load")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="PING round-trip latency, idle and under load")
+    parser.add_argument("--host", help="server to test (default: start one on loopback)")
+    parser.add_argument("--port", type=int, default=4450)
+    parser.add_argument("--user", default="bench")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="engine of the local server")
+    parser.add_argument("--count", type=int, default=200, help="RTTs to keep (idle probe)")
+    parser.add_argument("--warmup", type=int, default=10, help="replies to discard first")
+    parser.add_argument("--depth", type=int, default=1, help="PINGs in flight at once (pipelining)")
+    parser.add_argument("--interval", type=float, default=0.0, help="ms between PINGs (0 = back to back)")
+    parser.add_argument("--size", default="16", help="PING payload size, at least 16 bytes")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for a PONG")
+    parser.add_argument("--load", choices=("up", "down", "both"),
+                        help="probe again during a bulk transfer in this direction")
+    parser.add_argument("--load-seconds", type=float, default=10.0)
+    parser.add_argument("--load-streams", type=int, default=4)
+    parser.add_argument("--load-frame-size", default="1M")
+    parser.add_argument("--json", help="write results to this file")
+    return parser
+
+
+def run(args) -> dict:
+    """run_latency() against --host or a local server."""
+    if not 1 <= args.depth <= 64:
+        raise ValueError("--depth must be 1..64 (the server's requests in flight per connection)")
+    login = {"username": args.user, "password": args.password}
+    proc = tmp = None
+    host, port = args.host, args.port
+    if host is None:
+        tmp = tempfile.TemporaryDirectory()
+        users = os.path.join(tmp.name, "users.json")
+        write_users(users, [args.user], args.password)
+        host, port = "127.0.0.1", free_port()
+        proc = start_server(args.engine, port, os.path.join(tmp.name, "data"), ["--users", users])
+    try:
+        return run_latency(host, port, login, args.count, args.warmup, args.depth, args.interval / 1000,
+                           max(PING.size, parse_size(args.size)), args.timeout, args.load,
+                           args.load_seconds, args.load_streams, parse_size(args.load_frame_size))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            tmp.cleanup()
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    try:
+        result = run(args)
+    except ValueError as e:
+        parser.error(str(e))
+    print_results(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
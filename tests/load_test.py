@@ -0,0 +1,454 @@
+# load_test.py
+# Many simulated clients against a local server, reported as JSON.
+#
+# A server is started on loopback with a scratch user store and a few seed
+# files. --clients simulated clients then log in and run a weighted mix of
+# operations (--mix) until --duration is up, each waiting an exponential
+# think time (--think) between operations. Clients are asyncio tasks spread
+# over --processes worker processes, so the load generator itself is not the
+# bottleneck. Uploaded sizes follow --sizes:
+#
+#   fixed:1M            every file 1 MiB
+#   uniform:4K-4M       evenly spread between the two
+#   lognormal:64K:1.5   median 64 KiB, sigma 1.5 (many small, a few large)
+#
+# Operations: LOGIN (a new connection: handshake, login, logout), DIR, PING,
+# UPLOAD, DOWNLOAD (a seed file or one of the client's uploads) and DELETE
+# (one of the client's uploads; clients with none upload instead).
+#
+# The report has, per operation: count, errors by message, ops/s, MB/s and
+# p50 / p95 / p99 / max latency and a random sample of up to SAMPLES_KEPT
+# latencies; plus the server's RSS and thread count sampled through the run
+# (from /proc, so Linux only).
+#
+#   python tests/load_test.py --clients 500 --duration 30 --json load.json
+#   python tests/load_test.py --mix PING=50,DIR=20,DOWNLOAD=30 --engine asyncio
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import shlex
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import (FORMAT, ROOT, SIZE, free_port, proc_status, raise_fd_limit,  # noqa: E402
+                              start_server, write_users)
+
+sys.path.insert(0, ROOT)
+from common import framing  # noqa: E402
+from common.framing import Op  # noqa: E402
+
+PASSWORD = "password"
+OPERATIONS = ("LOGIN", "DIR", "PING", "UPLOAD", "DOWNLOAD", "DELETE")
+DEFAULT_MIX = "PING=30,DIR=20,DOWNLOAD=25,UPLOAD=15,DELETE=5,LOGIN=5"
+FRAME_SIZE = 262144  # DATA payload per upload frame, as the real client sends
+MAX_FILE = 64 * 1048576
+SEED_FILES = 8
+SAMPLES_KEPT = 2000  # latencies per operation kept in the report for later comparison
+
+
+class OpError(Exception):
+    """The server answered ERR (the message is what the report counts)."""
+
+
+def parse_size(text: str) -> int:
+    """'4096', '64K', '16M' -> bytes."""
+    text = text.strip().upper().rstrip("B")
+    scale = {"K": 1024, "M": 1048576, "G": 1073741824}.get(text[-1:], 1)
+    return int(float(text.rstrip("KMG")) * scale)
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        op, _, weight = item.partition("=")
+        op = op.strip().upper()
+        if op not in OPERATIONS:
+            raise ValueError(f"unknown operation {op!r} (one of {', '.join(OPERATIONS)})")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+class SizeDistribution:
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        if kind == "fixed":
+            self.size = parse_size(params)
+        elif kind == "uniform":
+            low, _, high = params.partition("-")
+            self.low, self.high = parse_size(low), parse_size(high)
+        elif kind == "lognormal":
+            median, _, sigma = params.partition(":")
+            self.mu, self.sigma = math.log(parse_size(median)), float(sigma or 1.0)
+        else:
+            raise ValueError(f"unknown size distribution {spec!r}")
+
+    def sample(self, rng: random.Random) -> int:
+        if self.kind == "fixed":
+            size = self.size
+        elif self.kind == "uniform":
+            size = rng.randint(self.low, self.high)
+        else:
+            size = int(rng.lognormvariate(self.mu, self.sigma))
+        return max(1, min(size, MAX_FILE))
+
+
+class Client:
+    """A framed-protocol connection on asyncio streams, one request at a time."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.request_id = 0
+
+    @classmethod
+    async def connect(cls, port: int, username: str) -> "Client":
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        client = cls(reader, writer)
+        try:
+            welcome = (await reader.read(SIZE)).decode(FORMAT)
+            if welcome.startswith("ERR@BUSY"):
+                raise OpError("BUSY")
+            if not welcome.startswith("OK"):
+                raise ConnectionError(welcome or "Connection closed by server")
+            await client.call(Op.HELLO, versions=list(framing.SUPPORTED_VERSIONS))
+            await client.call(Op.LOGIN, username=username, password=PASSWORD)
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    def close(self):
+        self.writer.close()
+
+    async def frame(self) -> framing.Frame:
+        op, flags, request_id, length = framing.parse_header(
+            await self.reader.readexactly(framing.HEADER_SIZE))
+        payload = await self.reader.readexactly(length) if length else b""
+        frame = framing.Frame(op, request_id, flags, payload)
+        if op == Op.ERR:
+            raise OpError(frame.json().get("message", "Request failed"))
+        return frame
+
+    def send(self, op: int, **args) -> int:
+        self.request_id += 1
+        self.writer.write(framing.pack_json(op, self.request_id, args))
+        return self.request_id
+
+    async def call(self, op: int, **args) -> dict:
+        self.send(op, **args)
+        return (await self.frame()).json()
+
+    async def ping(self) -> int:
+        self.request_id += 1
+        self.writer.write(framing.pack_frame(Op.PING, self.request_id, b"load"))
+        await self.frame()
+        return 0
+
+    async def dir(self) -> int:
+        return len((await self.call(Op.DIR)).get("message", ""))
+
+    async def upload(self, name: str, size: int, data: memoryview) -> int:
+        request_id = self.send(Op.UPLOAD, name=name, size=size)
+        sent = 0
+        while sent < size:
+            n = min(FRAME_SIZE, size - sent)
+            self.writer.write(framing.pack_header(Op.DATA, request_id, n))
+            self.writer.write(data[:n])
+            await self.writer.drain()
+            sent += n
+        await self.frame()
+        return size
+
+    async def download(self, name: str) -> int:
+        self.send(Op.DOWNLOAD, name=name)
+        await self.frame()  # OK with the size
+        received = 0
+        while True:
+            frame = await self.frame()
+            if frame.op == Op.END:
+                return received
+            received += len(frame.payload)
+
+    async def delete(self, name: str) -> int:
+        await self.call(Op.DELETE, name=name)
+        return 0
+
+    async def logout(self):
+        await self.call(Op.LOGOUT)
+        self.close()
+
+
+class Recorder:
+    """Per-operation latencies, bytes and error counts of one worker process."""
+
+    def __init__(self):
+        self.ops = {op: {"latencies": [], "bytes": 0, "errors": {}} for op in OPERATIONS}
+
+    def ok(self, op: str, seconds: float, nbytes: int):
+        entry = self.ops[op]
+        entry["latencies"].append(seconds)
+        entry["bytes"] += nbytes
+
+    def error(self, op: str, e: BaseException):
+        message = str(e) if isinstance(e, OpError) else type(e).__name__
+        errors = self.ops[op]["errors"]
+        errors[message] = errors.get(message, 0) + 1
+
+
+async def run_client(cid: int, args, deadline: float, seeds: list, payload: memoryview, recorder: Recorder):
+    rng = random.Random(args.seed * 100003 + cid)
+    sizes = SizeDistribution(args.sizes)
+    mix = parse_mix(args.mix)
+    ops, weights = list(mix), list(mix.values())
+    username = f"user{cid % args.users}"
+    await asyncio.sleep(args.ramp * cid / args.clients)
+
+    client = None
+    uploads = []
+    count = 0
+    while time.time() < deadline:
+        op = "LOGIN" if client is None else rng.choices(ops, weights)[0]
+        if op == "DELETE" and not uploads:
+            op = "UPLOAD"
+        started = time.perf_counter()
+        try:
+            if client is None:
+                # The client's own session (again, after a failure).
+                client = await asyncio.wait_for(Client.connect(args.port, username), args.timeout)
+                nbytes = 0
+            elif op == "LOGIN":
+                extra = await asyncio.wait_for(Client.connect(args.port, username), args.timeout)
+                await asyncio.wait_for(extra.logout(), args.timeout)
+                nbytes = 0
+            elif op == "PING":
+                nbytes = await asyncio.wait_for(client.ping(), args.timeout)
+            elif op == "DIR":
+                nbytes = await asyncio.wait_for(client.dir(), args.timeout)
+            elif op == "UPLOAD":
+                count += 1
+                name = f"load_{cid}_{count}.bin"
+                nbytes = await asyncio.wait_for(client.upload(name, sizes.sample(rng), payload), args.timeout)
+                uploads.append(name)
+            elif op == "DOWNLOAD":
+                nbytes = await asyncio.wait_for(client.download(rng.choice(seeds + uploads)), args.timeout)
+            else:
+                name = uploads.pop(rng.randrange(len(uploads)))
+                nbytes = await asyncio.wait_for(client.delete(name), args.timeout)
+            recorder.ok(op, time.perf_counter() - started, nbytes)
+        except OpError as e:
+            recorder.error(op, e)
+            if client is None:
+                await asyncio.sleep(0.1)  # refused (e.g. BUSY); don't hammer
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, framing.ProtocolError) as e:
+            # The connection can't be trusted after this; start a new one.
+            recorder.error(op, e)
+            if client is not None:
+                client.close()
+            client = None
+            await asyncio.sleep(0.1)
+        if args.think > 0:
+            await asyncio.sleep(rng.expovariate(1000 / args.think))
+    if client is not None:
+        try:
+            await asyncio.wait_for(client.logout(), args.timeout)
+        except Exception:
+            client.close()
+
+
+def worker(cids: list, args, deadline: float, seeds: list) -> dict:
+    """One process: its share of the clients as asyncio tasks."""
+    raise_fd_limit(len(cids) * 2 + 256)
+    recorder = Recorder()
+    payload = memoryview(os.urandom(FRAME_SIZE))
+
+    async def run():
+        await asyncio.gather(*(run_client(cid, args, deadline, seeds, payload, recorder) for cid in cids))
+
+    asyncio.run(run())
+    return recorder.ops
+
+
+def percentile(sorted_values: list, q: float):
+    """Nearest-rank percentile of a sorted list (None if it is empty)."""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))]
+
+
+def summarize(parts: list, duration: float) -> dict:
+    report = {}
+    for op in OPERATIONS:
+        latencies = sorted(x for part in parts for x in part[op]["latencies"])
+        errors = {}
+        for part in parts:
+            for message, n in part[op]["errors"].items():
+                errors[message] = errors.get(message, 0) + n
+        failed = sum(errors.values())
+        if not latencies and not failed:
+            continue
+        nbytes = sum(part[op]["bytes"] for part in parts)
+        report[op] = {
+            "count": len(latencies),
+            "errors": failed,
+            "error_rate": failed / (len(latencies) + failed),
+            "errors_by_message": errors,
+            "ops_s": len(latencies) / duration,
+            "mb_s": nbytes / 1048576 / duration,
+            **{f"p{q * 100:g}_ms": (v * 1000 if (v := percentile(latencies, q)) is not None else None)
+               for q in (0.5, 0.95, 0.99)},
+            "max_ms": latencies[-1] * 1000 if latencies else None,
+            "samples_ms": [round(v * 1000, 3) for v in
+                           (random.Random(0).sample(latencies, SAMPLES_KEPT)
+                            if len(latencies) > SAMPLES_KEPT else latencies)],
+        }
+    return report
+
+
+def prepare(root: str, args) -> list:
+    """Users file and seed files; returns the seed file names."""
+    write_users(os.path.join(root, "users.json"), [f"user{i}" for i in range(args.users)], PASSWORD)
+    data = os.path.join(root, "data")
+    os.makedirs(data)
+    rng = random.Random(args.seed)
+    sizes = SizeDistribution(args.sizes)
+    seeds = []
+    for i in range(SEED_FILES):
+        name = f"seed_{i}.bin"
+        with open(os.path.join(data, name), "wb") as f:
+            f.write(os.urandom(sizes.sample(rng)))
+        seeds.append(name)
+    return seeds
+
+
+async def warm_up(args):
+    """Log every user in once, so the MD5 -> scrypt upgrade isn't in the results."""
+    async def login(i):
+        client = await Client.connect(args.port, f"user{i}")
+        await client.logout()
+    for offset in range(0, args.users, 50):
+        await asyncio.gather(*(login(i) for i in range(offset, min(offset + 50, args.users))))
+
+
+def run(args) -> dict:
+    args.processes = max(1, min(args.processes, args.clients))
+    raise_fd_limit(args.clients * 2 + 256)
+    with tempfile.TemporaryDirectory() as root:
+        seeds = prepare(root, args)
+        args.port = free_port()
+        # All clients come from one address, so lift the per-IP and per-user
+        # limits and give every client a worker thread.
+        limit = str(2 * args.clients + 64)
+        proc = start_server(args.engine, args.port, os.path.join(root, "data"),
+                            ["--users", os.path.join(root, "users.json"), "--max-connections", limit,
+                             "--workers", limit, "--max-per-ip", "0", "--max-per-user", "0"]
+                            + shlex.split(args.server_args))
+        try:
+            asyncio.run(warm_up(args))
+            idle = proc_status(proc.pid)
+            shares = [list(range(p, args.clients, args.processes)) for p in range(args.processes)]
+            deadline = time.time() + args.ramp + args.duration
+            samples = []
+            started = time.time()
+            with multiprocessing.Pool(args.processes) as pool:
+                pending = pool.starmap_async(worker, [(share, args, deadline, seeds) for share in shares if share])
+                while not pending.ready():
+                    status = proc_status(proc.pid)
+                    samples.append({"t": round(time.time() - started, 2), **status})
+                    pending.wait(0.5)
+                parts = pending.get()
+            elapsed = time.time() - started
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    rss = [s["rss_mb"] for s in samples if s["rss_mb"] is not None]
+    threads = [s["threads"] for s in samples if s["threads"] is not None]
+    operations = summarize(parts, elapsed)
+    return {
+        "config": {"engine": args.engine, "clients": args.clients, "processes": args.processes,
+                   "users": args.users, "duration_s": args.duration, "ramp_s": args.ramp,
+                   "think_ms": args.think, "mix": parse_mix(args.mix), "sizes": args.sizes,
+                   "server_args": args.server_args, "seed": args.seed},
+        "elapsed_s": elapsed,
+        "operations": operations,
+        "totals": {
+            "count": sum(o["count"] for o in operations.values()),
+            "errors": sum(o["errors"] for o in operations.values()),
+            "ops_s": sum(o["ops_s"] for o in operations.values()),
+            "mb_s": sum(o["mb_s"] for o in operations.values()),
+        },
+        "server": {
+            "idle_rss_mb": idle["rss_mb"],
+            "rss_mb_max": max(rss, default=None),
+            "rss_mb_end": rss[-1] if rss else None,
+            "threads_max": max(threads, default=None),
+            "threads_end": threads[-1] if threads else None,
+            "samples": samples,
+        },
+    }
+
+
+def print_report(report: dict):
+    def fmt(v, spec):
+        return format(v, spec) if v is not None else "n/a"
+
+    c = report["config"]
+    print("\n" + "=" * 86, file=sys.stderr)
+    print(f"{c['clients']} clients, {c['engine']} engine, {report['elapsed_s']:.1f}s", file=sys.stderr)
+    print(f"{'op':<10}{'count':>9}{'errors':>8}{'ops/s':>9}{'MB/s':>8}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>10}", file=sys.stderr)
+    for op, o in report["operations"].items():
+        print(f"{op:<10}{o['count']:>9}{o['errors']:>8}{o['ops_s']:>9.1f}{o['mb_s']:>8.1f}"
+              f"{fmt(o['p50_ms'], '9.2f')}{fmt(o['p95_ms'], '9.2f')}{fmt(o['p99_ms'], '9.2f')}"
+              f"{fmt(o['max_ms'], '10.1f')}", file=sys.stderr)
+    s = report["server"]
+    print(f"server RSS {fmt(s['idle_rss_mb'], '.1f')} MB idle, {fmt(s['rss_mb_max'], '.1f')} MB peak; "
+          f"{fmt(s['threads_max'], 'd')} threads peak", file=sys.stderr)
+    print("=" * 86, file=sys.stderr)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Load test with many simulated clients")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="worker processes the clients are spread over")
+    parser.add_argument("--users", type=int, default=50, help="accounts the clients log in as")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load after the ramp")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which clients start")
+    parser.add_argument("--think", type=float, default=50.0, metavar="MS",
+                        help="mean pause between a client's operations (0: none)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--sizes", default="lognormal:64K:1.5",
+                        help="upload / seed file sizes: fixed:N, uniform:MIN-MAX or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds before an operation counts as failed")
+    parser.add_argument("--server-args", default="", help="extra server flags, e.g. \"--fsync none\"")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default="-", help="write the report here ('-': stdout)")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    parse_mix(args.mix)
+    SizeDistribution(args.sizes)
+    report = run(args)
+    print_report(report)
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
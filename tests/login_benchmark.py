@@ -0,0 +1,149 @@
+# login_benchmark.py
+# LOGIN throughput under a reconnect storm.
+#
+# A local server is started with a scratch user store whose entries are in
+# the old MD5 format, so the first login of each user also migrates it to
+# scrypt. Then waves of clients connect and log in concurrently:
+#
+#   first   the right password, first login of each account (MD5 -> scrypt)
+#   cached  the right password again (verified logins skip the KDF)
+#   wrong   a wrong password (the full KDF every time)
+#
+# While a storm runs, one already logged-in client keeps sending PING; its
+# latency shows whether password hashing stalls everyone else.
+#
+#   python tests/login_benchmark.py --logins 2000 --concurrency 200
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import FORMAT, SIZE, free_port, raise_fd_limit, start_server, write_users  # noqa: E402
+
+PASSWORD = "password"
+
+
+async def login(port: int, username: str, password: str) -> tuple:
+    """(seconds, succeeded) for one connect + LOGIN."""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        await reader.read(SIZE)  # welcome
+        writer.write(f"LOGIN@{username}@{password}".encode(FORMAT))
+        await writer.drain()
+        resp = (await reader.read(SIZE)).decode(FORMAT)
+    finally:
+        writer.close()
+    return time.perf_counter() - start, resp.startswith("OK@AUTH_SUCCESS")
+
+
+async def pinger(port: int, stop: asyncio.Event) -> list:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.read(SIZE)
+    writer.write(f"LOGIN@user0@{PASSWORD}".encode(FORMAT))
+    await writer.drain()
+    await reader.read(SIZE)
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        writer.write(b"PING")
+        await writer.drain()
+        await reader.read(SIZE)
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.01)
+    writer.close()
+    return latencies
+
+
+async def storm(port: int, users: int, logins: int, concurrency: int, password: str) -> dict:
+    stop = asyncio.Event()
+    ping_task = asyncio.create_task(pinger(port, stop))
+    await asyncio.sleep(0.2)
+
+    times, ok = [], 0
+    start = time.perf_counter()
+    for offset in range(0, logins, concurrency):
+        wave = await asyncio.gather(
+            *(login(port, f"user{i % users}", password) for i in range(offset, min(offset + concurrency, logins))),
+            return_exceptions=True,
+        )
+        for result in wave:
+            if isinstance(result, Exception):
+                continue
+            times.append(result[0] * 1000)
+            ok += result[1]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    pings = await ping_task
+
+    return {
+        "logins": len(times),
+        "accepted": ok,
+        "per_s": len(times) / elapsed if elapsed else 0.0,
+        "p50_ms": statistics.median(times) if times else None,
+        "p99_ms": statistics.quantiles(times, n=100)[98] if len(times) >= 2 else None,
+        "ping_p99_ms": statistics.quantiles(pings, n=100)[98] if len(pings) >= 2 else None,
+    }
+
+
+def benchmark(engine: str, args) -> list:
+    port = free_port()
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        users = os.path.join(root, "users.json")
+        write_users(users, [f"user{i}" for i in range(args.users)])
+        proc = start_server(engine, port, os.path.join(root, "data"),
+                            ["--users", users, "--auth-workers", str(args.auth_workers)])
+        try:
+            for mode, password in (("first", PASSWORD), ("cached", PASSWORD), ("wrong", "wrong")):
+                r = asyncio.run(storm(port, args.users, args.logins, args.concurrency, password))
+                r.update(engine=engine, mode=mode)
+                results.append(r)
+            with open(users) as f:
+                migrated = sum(1 for h in json.load(f).values() if h.startswith("scrypt$"))
+            print(f"{migrated} of {args.users} accounts migrated to scrypt")
+        finally:
+            proc.terminate()
+            proc.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LOGIN throughput benchmark")
+    parser.add_argument("--logins", type=int, default=1000, help="logins per storm")
+    parser.add_argument("--concurrency", type=int, default=100, help="clients logging in at once")
+    parser.add_argument("--users", type=int, default=50, help="distinct accounts")
+    parser.add_argument("--auth-workers", type=int, default=4)
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.concurrency * 2 + 256)
+
+    results = []
+    for engine in args.engines:
+        print(f"Benchmarking LOGIN on the {engine} engine...")
+        results.extend(benchmark(engine, args))
+
+    def fmt(v, spec):
+        return format(v, spec) if v is not None else "n/a"
+
+    print("\n" + "=" * 74)
+    print(f"{'engine':<10}{'mode':<14}{'logins':>8}{'ok':>7}{'per s':>9}{'p50 ms':>9}{'p99 ms':>9}{'PING p99':>9}")
+    for r in results:
+        print(f"{r['engine']:<10}{r['mode']:<14}{r['logins']:>8}{r['accepted']:>7}{r['per_s']:>9.1f}"
+              f"{fmt(r['p50_ms'], '9.2f')}{fmt(r['p99_ms'], '9.2f')}{fmt(r['ping_p99_ms'], '9.2f')}")
+    print("=" * 74)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,183 +1,133 @@
 # network_performance.py
-import socket
+# Latency and throughput from this machine to a server.
+#
+# Runs headless: each run is saved to the results store (results_store.py)
+# with its raw PING round trips and per-second throughput, compared with the
+# baseline of the "network" suite, and written up as a Markdown and HTML
+# report with plots (see benchmark_runner.py for the options).
+#
+#   python tests/network_performance.py --host 192.168.1.10 --set-baseline
+#   python tests/network_performance.py --local --fail-on-regression
+import argparse
+import os
+import sys
+import tempfile
 import time
-import struct
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
 
-SERVER_HOST = "172.20.10.2"
-SERVER_PORT = 4450
-FORMAT = "utf-8"
-SIZE = 1024
-
-
-def _send_msg(conn: socket.socket, msg: str):
-    conn.sendall(msg.encode(FORMAT))
-
-def _recv_msg(conn: socket.socket) -> str:
-    data = conn.recv(SIZE)
-    if not data:
-        raise ConnectionError("Socket closed during recv")
-    return data.decode(FORMAT).strip()
-
-def measure_latency(conn, num_pings: int = 50):
-    latencies = []
-    for i in range(1, num_pings + 1):
-        try:
-            start = time.perf_counter()
-            _send_msg(conn, "PING")
-            resp = _recv_msg(conn)
-            if resp != "PONG":
-                raise ValueError(f"Expected PONG, got {resp}")
-            elapsed = (time.perf_counter() - start) * 1000
-            latencies.append(elapsed)
-            print(f"  Ping {i:2d}: {elapsed:6.2f} ms")
-        except Exception as e:
-            print(f"  Ping {i:2d}: FAILED ({e})")
-            latencies.append(None)
-    return latencies
-
-
-def measure_throughput(conn, size_kb: int = 100, iterations: int = 20):
-    chunk = b"x" * 1024
-    total_kb = size_kb * iterations
-    total_bytes = total_kb * 1024
-
-    print(f"\nSending {total_kb} KB ({total_bytes/1_048_576:.2f} MB)...")
-    _send_msg(conn, f"THROUGHPUT@{size_kb}@{iterations}")
-
-    try:
-        ready = _recv_msg(conn)
-        if ready != "READY":
-            raise ConnectionError(f"Server not ready: {ready}")
-    except Exception as e:
-        raise ConnectionError(f"Failed to get READY: {e}")
+# Make the shared `common` package importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-    start_time = time.perf_counter()
-    for batch in range(1, iterations + 1):
-        for _ in range(size_kb):
-            conn.sendall(struct.pack("!I", len(chunk)) + chunk)
-        ack = _recv_msg(conn)
-        print(f"  Batch {batch}/{iterations} sent (ACK: {ack})")
-        time.sleep(0.01)
+import benchmark_runner  # noqa: E402
+from latency_benchmark import print_probe, run_latency  # noqa: E402
+from results_store import metric  # noqa: E402
+from throughput_benchmark import free_port, parse_size, run_throughput, start_server, write_users  # noqa: E402
 
-    duration = time.perf_counter() - start_time
-    mbps = total_bytes / (1_048_576 * duration) if duration > 0 else 0
-    return mbps
+SERVER_HOST = "172.20.10.2"
+SERVER_PORT = 4450
 
 
-def calculate_packet_loss(latencies):
-    sent = len(latencies)
-    received = sum(1 for l in latencies if l is not None)
-    return ((sent - received) / sent) * 100 if sent else 0
+def measure_latency(host: str, port: int, username: str, password: str, num_pings: int = 50,
+                    warmup: int = 10):
+    """PING round trips after a warm-up (latency_benchmark.py)."""
+    result = run_latency(host, port, {"username": username, "password": password}, num_pings, warmup)
+    print_probe("Idle", result["idle"])
+    return result["idle"]
+
+
+def measure_throughput(host: str, port: int, username: str, password: str, direction: str = "both",
+                       frame_size: int = 1048576, seconds: float = 10.0, streams: int = 4):
+    """Goodput of `streams` parallel connections (throughput_benchmark.py)."""
+    print(f"\n{direction} for {seconds:g}s: {streams} streams, {frame_size // 1024} KB frames...")
+    result = run_throughput(host, port, {"username": username, "password": password},
+                            direction, frame_size, seconds, streams)
+    for name in ("up", "down"):
+        if name in result:
+            samples = ", ".join(f"{mb:.1f}" for mb in result[name]["samples_mb_s"])
+            print(f"  {name:>4}: {result[name]['goodput_mb_s']:8.2f} MB/s  (per second: {samples})")
+    print(f"  CPU : client {result['client_cpu_pct']:.0f}%, server {result['server_cpu_pct']:.0f}%")
+    return result
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Latency and throughput to a file server")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--local", action="store_true", help="start a server on loopback and test that")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="engine of the --local server")
+    parser.add_argument("--user", default="Dennis")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--pings", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=10, help="PINGs to discard before measuring")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the throughput test")
+    parser.add_argument("--streams", type=int, default=4, help="parallel throughput connections")
+    parser.add_argument("--frame-size", default="1M", help="DATA frame size of the throughput test")
+    return parser
+
+
+def collect(args) -> tuple:
+    """Run the tests; returns (config, metrics, raw results) for the results store."""
+    host, port = args.host, args.port
+    proc = tmp = None
+    if args.local:
+        tmp = tempfile.TemporaryDirectory()
+        users = os.path.join(tmp.name, "users.json")
+        write_users(users, [args.user], args.password)
+        host, port = "127.0.0.1", free_port()
+        proc = start_server(args.engine, port, os.path.join(tmp.name, "data"), ["--users", users])
+    try:
+        print(f"Connecting to {host}:{port} ...")
+        print(f"=== LATENCY TEST ({args.pings} pings) ===")
+        latency = measure_latency(host, port, args.user, args.password, args.pings, args.warmup)
+
+        print("\n=== THROUGHPUT TEST ===")
+        throughput = measure_throughput(host, port, args.user, args.password, "both",
+                                        parse_size(args.frame_size), args.seconds, args.streams)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            tmp.cleanup()
+
+    config = {"host": host, "port": port, "local": args.local, "engine": args.engine if args.local else None,
+              "user": args.user, "pings": args.pings, "warmup": args.warmup, "seconds": args.seconds,
+              "streams": args.streams, "frame_size": parse_size(args.frame_size)}
+    metrics = {"ping_ms": metric("ms", "lower", latency["samples_ms"])}
+    for name in ("up", "down"):
+        # The last sample covers a partial second.
+        samples = throughput[name]["samples_mb_s"]
+        metrics[f"{'upload' if name == 'up' else 'download'}_mb_s"] = metric("MB/s", "higher",
+                                                                            samples[:-1] or samples)
+    raw = {"latency": latency, "throughput": throughput}
+    return config, metrics, raw
 
 
 def main():
-    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn.settimeout(20.0)
-
-    # CONNECT
+    parser = build_parser()
+    benchmark_runner.add_store_arguments(parser)
+    args = parser.parse_args()
     try:
-        print(f"Connecting to {SERVER_HOST}:{SERVER_PORT} ...")
-        conn.connect((SERVER_HOST, SERVER_PORT))
-        print("Connected.\n")
+        config, metrics, raw = collect(args)
     except Exception as e:
-        print(f"Connection failed: {e}")
-        return
-
-    
-    try:
-        welcome = conn.recv(SIZE).decode(FORMAT).strip()
-        print(f"[SERVER WELCOME] {welcome}")
-    except Exception as e:
-        print(f"[WARNING] No welcome: {e}")
-
-    # LOGIN (raw send + raw recv)
-    username = 'Dennis'
-    password = 'password'
-    conn.send(f"LOGIN@{username}@{password}".encode(FORMAT))
-
-    login_resp = conn.recv(SIZE).decode(FORMAT)
-    parts = login_resp.split("@")
-    if len(parts) < 2 or parts[0] != "OK" or parts[1] != "AUTH_SUCCESS":
-       
-        conn.close()
-        return
-
-    # Latency
-    print("=== LATENCY TEST (50 pings) ===")
-    latencies = measure_latency(conn, num_pings=50)
-
-    # Throughput
-    print("\n=== THROUGHPUT TEST ===")
-    try:
-        throughput = measure_throughput(conn, size_kb=100, iterations=20)
-    except Exception as e:
-        print(f"Throughput failed: {e}")
-        throughput = 0.0
-
-    # Logout
-    try:
-        _send_msg(conn, "LOGOUT")
-        _recv_msg(conn)
-    except:
-        pass
-    conn.close()
-
-    # Results
-    valid = [l for l in latencies if l is not None]
-    avg_latency = sum(valid) / len(valid) if valid else float('inf')
-    packet_loss = calculate_packet_loss(latencies)
+        print(f"Benchmark failed: {e}")
+        sys.exit(2)
 
+    latency = raw["latency"]["stats"]
     print("\n" + "="*60)
     print(" " * 20 + "NETWORK PERFORMANCE")
     print("="*60)
-    print(f"Average Latency : {avg_latency:6.2f} ms")
-    print(f"Throughput      : {throughput:6.2f} MB/s")
-    print(f"Packet Loss     : {packet_loss:6.1f} %")
-    print(f"Successful pings: {len(valid)} / {len(latencies)}")
+    if latency["n"]:
+        print(f"Latency         : {latency['avg']:6.2f} ms avg, {latency['p50']:.2f} p50, "
+              f"{latency['p99']:.2f} p99")
+        print(f"Jitter          : {latency['jitter']:6.2f} ms")
+    print(f"Upload          : {raw['throughput']['up']['goodput_mb_s']:6.2f} MB/s")
+    print(f"Download        : {raw['throughput']['down']['goodput_mb_s']:6.2f} MB/s")
+    print(f"Timed out pings : {raw['latency']['timeouts']}")
     print("Timestamp",time.strftime("%Y-%m-%d %H:%M:%S"))
     print("="*60)
-    
-
-    results = {
-        "Average_Latency_ms": avg_latency,
-        "Throughput_MBps": throughput,
-        "Packet_Loss_percent": packet_loss,
-        "Successful_Pings": len(valid),
-        "Total_Pings": len(latencies),
-        "Timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-    }
-
-    
-    latency_df = pd.DataFrame({
-        "Ping_Number": list(range(1, len(latencies)+1)),
-        "Latency_ms": [l if l is not None else None for l in latencies],
-    })
-
-    # Combine into one report file
-    summary_df = pd.DataFrame([results])
-    summary_df.to_csv("network_summary.csv", mode="a", index=False)
-    latency_df.to_csv("latency_details.csv", index=False)
-
-    # Table
-    if valid:
-        plt.figure(figsize=(10, 5))
-        idx = np.arange(len(latencies))
-        good = [l for l in latencies if l is not None]
-        bad  = [i for i, l in enumerate(latencies) if l is None]
-        plt.plot(idx[:len(good)], good, 'go-', label='Success', markersize=4)
-        if bad:
-            plt.plot(bad, [avg_latency]*len(bad), 'rx', label='Failed', markersize=8)
-        plt.axhline(avg_latency, color='orange', linestyle='--', label=f'Avg {avg_latency:.1f} ms')
-        plt.title("Ping Latency Over Time")
-        plt.xlabel("Ping #")
-        plt.ylabel("Latency (ms)")
-        plt.legend()
-        plt.grid(alpha=0.3)
-        plt.tight_layout()
-        plt.show()
+
+    sys.exit(benchmark_runner.record("network", config, metrics, raw, args))
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,182 @@
+# results_store.py
+# Stored benchmark runs and comparisons between them.
+#
+# Every run is one JSON file under <store>/runs/: the suite that produced
+# it, when, the git revision, the machine and Python it ran on, the
+# configuration, and its metrics with their raw samples (PING latencies,
+# per-second throughput, ...) so later runs can be tested against it rather
+# than against a single averaged number. <store>/baselines.json names the
+# run each suite is compared against.
+#
+# compare() tests each metric of a run against the baseline with a
+# two-sided Mann-Whitney U test (no assumption that latencies are normal)
+# and calls it a regression when the difference is significant (p < alpha)
+# and the median moved the wrong way by more than the threshold.
+import datetime
+import json
+import math
+import os
+import platform
+import socket
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_STORE = os.path.join(ROOT, "benchmark_results")
+ALPHA = 0.05
+THRESHOLD = 0.05  # relative change of the median that counts
+
+
+def metric(unit: str, better: str, samples) -> dict:
+    """A metric entry: better is "lower" (latency) or "higher" (throughput)."""
+    return {"unit": unit, "better": better, "samples": [float(v) for v in samples]}
+
+
+def git_info() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True,
+                                  timeout=10).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return ""
+    return {"revision": git("rev-parse", "HEAD") or None,
+            "branch": git("rev-parse", "--abbrev-ref", "HEAD") or None,
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def environment() -> dict:
+    return {"hostname": socket.gethostname(), "platform": platform.platform(),
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "python": platform.python_version(), "implementation": platform.python_implementation()}
+
+
+class ResultsStore:
+    def __init__(self, path: str = DEFAULT_STORE):
+        self.path = path
+        self.runs_dir = os.path.join(path, "runs")
+
+    def save(self, suite: str, config: dict, metrics: dict, raw=None) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        git = git_info()
+        run_id = f"{now:%Y%m%dT%H%M%SZ}-{suite}-{(git['revision'] or 'norev')[:8]}"
+        run = {"id": run_id, "suite": suite, "created": now.isoformat(), "git": git,
+               "environment": environment(), "config": config, "metrics": metrics, "raw": raw}
+        os.makedirs(self.runs_dir, exist_ok=True)
+        tmp = os.path.join(self.runs_dir, run_id + ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(run, f, indent=2)
+        os.replace(tmp, os.path.join(self.runs_dir, run_id + ".json"))
+        return run
+
+    def load(self, run_id: str) -> dict:
+        """A run by id (or unique id prefix), or by path to its file."""
+        if os.path.isfile(run_id):
+            path = run_id
+        else:
+            matches = [name for name in self._names() if name.startswith(run_id)]
+            if len(matches) != 1:
+                raise KeyError(f"{'No' if not matches else 'More than one'} stored run matches '{run_id}'")
+            path = os.path.join(self.runs_dir, matches[0])
+        with open(path) as f:
+            return json.load(f)
+
+    def _names(self) -> list:
+        try:
+            return sorted(name for name in os.listdir(self.runs_dir) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def runs(self, suite: str = None) -> list:
+        """Stored runs, oldest first."""
+        runs = [self.load(os.path.join(self.runs_dir, name)) for name in self._names()]
+        return [run for run in runs if suite is None or run["suite"] == suite]
+
+    def _baselines(self) -> dict:
+        try:
+            with open(os.path.join(self.path, "baselines.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def baseline(self, suite: str):
+        run_id = self._baselines().get(suite)
+        return self.load(run_id) if run_id else None
+
+    def set_baseline(self, run: dict):
+        baselines = self._baselines()
+        baselines[run["suite"]] = run["id"]
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "baselines.json"), "w") as f:
+            json.dump(baselines, f, indent=2)
+
+
+def summary(samples: list) -> dict:
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pct(q):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+    return {"n": len(ordered), "mean": statistics.fmean(ordered), "median": statistics.median(ordered),
+            "stdev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+            "min": ordered[0], "p95": pct(0.95), "p99": pct(0.99), "max": ordered[-1]}
+
+
+def mann_whitney(a: list, b: list) -> float:
+    """Two-sided p-value of the Mann-Whitney U test (normal approximation,
+    with tie and continuity corrections)."""
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+    combined = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    rank_sum = 0.0
+    ties = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1  # average rank of the tied group
+        t = j - i + 1
+        ties += t ** 3 - t
+        rank_sum += rank * sum(1 for k in range(i, j + 1) if combined[k][1] == 0)
+        i = j + 1
+    u = rank_sum - n1 * (n1 + 1) / 2
+    mean = n1 * n2 / 2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+    z = (abs(u - mean) - 0.5) / sigma
+    return min(1.0, math.erfc(max(z, 0.0) / math.sqrt(2)))
+
+
+def compare(run: dict, baseline: dict, alpha: float = ALPHA, threshold: float = THRESHOLD) -> list:
+    """One entry per metric the two runs share, with a status of
+    "regression", "improvement", "unchanged" or "insufficient data"."""
+    results = []
+    for name, current in run["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None:
+            continue
+        a, b = base["samples"], current["samples"]
+        before, after = summary(a), summary(b)
+        entry = {"metric": name, "unit": current["unit"], "better": current["better"],
+                 "baseline": before, "current": after, "change": None, "p_value": None}
+        if not a or not b:
+            entry["status"] = "insufficient data"
+            results.append(entry)
+            continue
+        change = (after["median"] - before["median"]) / before["median"] if before["median"] else 0.0
+        worse = change > 0 if current["better"] == "lower" else change < 0
+        entry["change"] = change
+        if len(a) >= 3 and len(b) >= 3:
+            entry["p_value"] = mann_whitney(a, b)
+            significant = entry["p_value"] < alpha
+        else:
+            # Single values (e.g. a run's total ops/s): the threshold alone decides.
+            significant = True
+        if significant and abs(change) > threshold:
+            entry["status"] = "regression" if worse else "improvement"
+        else:
+            entry["status"] = "unchanged"
+        results.append(entry)
+    return results
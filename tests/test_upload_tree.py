@@ -0,0 +1,84 @@
+# test_upload_tree.py
+# FramedClient.upload_tree against files that change while being streamed.
+#
+#   python -m pytest tests/test_upload_tree.py
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from client import session  # noqa: E402
+from common import framing  # noqa: E402
+from common.framing import Op  # noqa: E402
+
+
+class RecordingClient(session.FramedClient):
+    """Records what upload_tree sends instead of writing to a socket."""
+
+    def __init__(self):
+        super().__init__(sock=None)
+        self.data = bytearray()
+        self.end = None
+
+    def send_frame(self, op, request_id, payload=b"", flags=0):
+        if op == Op.DATA:
+            self.data += payload
+
+    def send_json(self, op, request_id, **args):
+        if op == Op.END:
+            self.end = args
+
+    def recv_reply(self, request_id):
+        return framing.Frame(Op.OK, request_id, 0, b"{}")
+
+
+class ShrinkThenGrow:
+    """A file whose reads come up short once and then return data again."""
+
+    def __init__(self, f, first: int):
+        self.f = f
+        self.reads = [first, 0]
+
+    def readinto(self, view):
+        if self.reads:
+            n = self.reads.pop(0)
+            if not n:
+                return 0
+            return self.f.readinto(view[:n])
+        return self.f.readinto(view)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+
+class UploadTreeTest(unittest.TestCase):
+    def test_file_that_shrinks_then_grows_is_padded_and_dropped(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "a.bin"), "wb") as f:
+                f.write(b"x" * (session.CHUNK_SIZE + 1000))
+            real_open = open
+
+            def fake_open(path, mode="r", *args, **kwargs):
+                return ShrinkThenGrow(real_open(path, mode, *args, **kwargs), 300)
+
+            client = RecordingClient()
+            with mock.patch.object(session, "open", fake_open, create=True):
+                summary = client.upload_tree(folder, "up")
+
+        self.assertEqual(summary["changed"], ["a.bin"])
+        self.assertEqual(client.end, {"digests": [None]})
+        # Padded to the end of the manifest size, not refilled once it grew back.
+        self.assertEqual(bytes(client.data), b"x" * 300 + bytes(session.CHUNK_SIZE + 700))
+
+
+if __name__ == "__main__":
+    unittest.main()
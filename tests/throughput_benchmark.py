@@ -0,0 +1,276 @@
+# throughput_benchmark.py
+# Network throughput of the framed data path (THROUGHPUT with a direction).
+#
+# Each stream is a connection of its own, driven by a thread with plain
+# blocking sockets: DATA frames are sent from one preallocated block and
+# received with recv_into into one preallocated buffer, so the client costs
+# little next to what it measures. For every frame size the test reports:
+#
+#   goodput  payload MB/s per direction, all streams together
+#   samples  MB/s in each second of the run (each stream counted as its
+#            data arrived: on the server for up, here for down)
+#   cpu      client and server process CPU time over wall time; 100% is one
+#            core busy
+#
+# Without --host a local server is started on loopback.
+#
+#   python tests/throughput_benchmark.py --direction both --frame-size 4K,64K,1M,16M --streams 4
+#   python tests/throughput_benchmark.py --host 192.168.1.10 --port 4450 --user Dennis --password ...
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import FORMAT, ROOT, SIZE, free_port, start_server, write_users  # noqa: E402
+
+sys.path.insert(0, ROOT)
+from common import framing  # noqa: E402
+from common.framing import Op  # noqa: E402
+
+SEND_BLOCK = 262144  # small frames are sent this many bytes' worth at a time
+REQUEST_ID = 1
+
+
+def parse_size(text: str) -> int:
+    """'1024', '64K', '16M' -> bytes."""
+    text = text.strip().upper().rstrip("B")
+    scale = {"K": 1024, "M": 1048576}.get(text[-1:], 1)
+    return int(float(text.rstrip("KM")) * scale)
+
+
+def open_stream(host: str, port: int, login: dict) -> tuple:
+    """Connect, negotiate the framed protocol and log in; returns (socket, LOGIN reply)."""
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        welcome = sock.recv(SIZE).decode(FORMAT)
+        if not welcome.startswith("OK"):
+            raise ConnectionError(welcome or "Connection closed by server")
+        framing.send_json(sock, Op.HELLO, REQUEST_ID, {"versions": list(framing.SUPPORTED_VERSIONS)})
+        reply_frame(sock)
+        framing.send_json(sock, Op.LOGIN, REQUEST_ID, login)
+        return sock, reply_frame(sock)
+    except Exception:
+        sock.close()
+        raise
+
+
+def reply_frame(sock: socket.socket) -> dict:
+    frame = framing.recv_frame(sock)
+    if frame.op == Op.ERR:
+        raise ConnectionError(frame.json().get("message", "Request failed"))
+    return frame.json()
+
+
+class Samples:
+    """Bytes per `interval` since `started` (as metrics.RateSamples on the server)."""
+
+    def __init__(self, interval: float, started: float):
+        self.interval = interval
+        self.started = started
+        self.counts = []
+        self.total = 0
+
+    def add(self, n: int):
+        i = int((time.perf_counter() - self.started) / self.interval)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += n
+        self.total += n
+
+
+def send_data(sock: socket.socket, frame_size: int, seconds: float):
+    """DATA frames for `seconds`, then END."""
+    count = max(1, SEND_BLOCK // frame_size)
+    block = framing.pack_frame(Op.DATA, REQUEST_ID, bytes(frame_size)) * count
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sock.sendall(block)
+    framing.send_json(sock, Op.END, REQUEST_ID)
+
+
+def receive_data(sock: socket.socket, frame_size: int, samples: Samples) -> dict:
+    """Count DATA frames until the final OK; returns its body."""
+    header = bytearray(framing.HEADER_SIZE)
+    header_view = memoryview(header)
+    payload = bytearray(frame_size)
+    payload_view = memoryview(payload)
+    while True:
+        framing.recv_into_exact(sock, header_view)
+        op, flags, _, length = framing.parse_header(header)
+        if op != Op.DATA:
+            frame = framing.Frame(op, REQUEST_ID, flags, framing.recv_exact(sock, length))
+            if op == Op.ERR:
+                raise ConnectionError(frame.json().get("message", "Throughput test failed"))
+            if op == Op.OK:
+                return frame.json()
+            continue
+        if length > len(payload):
+            payload_view.release()
+            payload.extend(bytes(length - len(payload)))
+            payload_view = memoryview(payload)
+        framing.recv_into_exact(sock, payload_view[:length])
+        samples.add(length)
+
+
+def run_stream(sock: socket.socket, direction: str, frame_size: int, seconds: float,
+               interval: float, barrier: threading.Barrier, result: dict):
+    try:
+        framing.send_json(sock, Op.THROUGHPUT, REQUEST_ID,
+                          {"direction": direction, "frame_size": frame_size, "seconds": seconds,
+                           "interval": interval})
+        reply_frame(sock)  # READY
+    except Exception:
+        barrier.abort()
+        raise
+    barrier.wait()
+    samples = Samples(interval, time.perf_counter())
+    sender = None
+    if direction != "down":
+        sender = threading.Thread(target=send_data, args=(sock, frame_size, seconds), daemon=True)
+        sender.start()
+    result["server"] = receive_data(sock, frame_size, samples)
+    if sender is not None:
+        sender.join()
+    result["down_samples"] = samples.counts
+
+
+def add_samples(total: list, counts: list):
+    if len(counts) > len(total):
+        total.extend([0] * (len(counts) - len(total)))
+    for i, n in enumerate(counts):
+        total[i] += n
+
+
+def run_throughput(host: str, port: int, login: dict, direction: str = "up", frame_size: int = 1048576,
+                   seconds: float = 10.0, streams: int = 1, interval: float = 1.0) -> dict:
+    """One test of `streams` parallel connections; goodput in MB/s per direction."""
+    first, reply = open_stream(host, port, login)
+    socks = [first]
+    try:
+        # Extra streams log in with the first one's session token.
+        extra_login = {"token": reply["token"]} if reply.get("token") else login
+        socks += [open_stream(host, port, extra_login)[0] for _ in range(streams - 1)]
+        results = [{} for _ in socks]
+        barrier = threading.Barrier(len(socks) + 1)
+        threads = [threading.Thread(target=run_stream, daemon=True,
+                                    args=(sock, direction, frame_size, seconds, interval, barrier, result))
+                   for sock, result in zip(socks, results)]
+        for t in threads:
+            t.start()
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            raise ConnectionError("A stream was refused; see the server log")
+        cpu_start, started = time.process_time(), time.perf_counter()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_start
+    finally:
+        for sock in socks:
+            sock.close()
+    if any("server" not in r for r in results):
+        raise ConnectionError("A stream failed; see the server log")
+
+    summary = {"direction": direction, "frame_size": frame_size, "streams": len(socks),
+               "seconds": wall, "interval": interval}
+    for name in ("up", "down"):
+        if name == "up" and direction == "down" or name == "down" and direction == "up":
+            continue
+        series = []
+        total = 0
+        duration = 0.0
+        for r in results:
+            server = r["server"][name]
+            # Downloads are counted where they arrive: here.
+            add_samples(series, r["down_samples"] if name == "down" else server["samples"])
+            total += sum(r["down_samples"]) if name == "down" else server["bytes"]
+            duration = max(duration, server["seconds"])
+        summary[name] = {
+            "bytes": total,
+            "goodput_mb_s": total / 1048576 / duration if duration > 0 else 0.0,
+            "samples_mb_s": [n / 1048576 / interval for n in series],
+        }
+    # The server's process CPU covers all streams; they ran side by side.
+    summary["client_cpu_pct"] = cpu / wall * 100 if wall > 0 else 0.0
+    summary["server_cpu_pct"] = max(r["server"]["cpu"]["percent"] for r in results)
+    return summary
+
+
+def print_results(results: list):
+    print("\n" + "=" * 86)
+    print(f"{'frame':>9}{'streams':>8}{'dir':>6}{'goodput MB/s':>14}{'min/s':>9}{'max/s':>9}"
+          f"{'client CPU':>12}{'server CPU':>12}")
+    for r in results:
+        for name in ("up", "down"):
+            if name not in r:
+                continue
+            # The last sample covers a partial interval; leave it out of min/max.
+            full = r[name]["samples_mb_s"][:-1] or r[name]["samples_mb_s"]
+            print(f"{r['frame_size']:>9}{r['streams']:>8}{name:>6}{r[name]['goodput_mb_s']:>14.1f}"
+                  f"{min(full, default=0):>9.1f}{max(full, default=0):>9.1f}"
+                  f"{r['client_cpu_pct']:>11.0f}%{r['server_cpu_pct']:>11.0f}%")
+    print("=" * 86)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Framed protocol throughput benchmark")
+    parser.add_argument("--host", help="server to test (default: start one on loopback)")
+    parser.add_argument("--port", type=int, default=4450)
+    parser.add_argument("--user", default="bench")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="engine of the local server")
+    parser.add_argument("--direction", choices=("up", "down", "both"), default="up")
+    parser.add_argument("--frame-size", default="1K,64K,1M,16M",
+                        help="comma separated DATA frame sizes, 1K to 16M; one run each")
+    parser.add_argument("--streams", type=int, default=1, help="parallel connections")
+    parser.add_argument("--seconds", type=float, default=5.0, help="length of each run")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds per sample")
+    parser.add_argument("--json", help="write results to this file")
+    return parser
+
+
+def run(args) -> list:
+    """One run_throughput() per --frame-size, against --host or a local server."""
+    sizes = [parse_size(s) for s in args.frame_size.split(",")]
+    login = {"username": args.user, "password": args.password}
+    proc = tmp = None
+    host, port = args.host, args.port
+    if host is None:
+        tmp = tempfile.TemporaryDirectory()
+        users = os.path.join(tmp.name, "users.json")
+        write_users(users, [args.user], args.password)
+        host, port = "127.0.0.1", free_port()
+        proc = start_server(args.engine, port, os.path.join(tmp.name, "data"), ["--users", users])
+    try:
+        results = []
+        for size in sizes:
+            print(f"Running {args.direction} with {size}B frames, {args.streams} stream(s), {args.seconds:g}s...")
+            results.append(run_throughput(host, port, login, args.direction, size, args.seconds,
+                                          args.streams, args.interval))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            tmp.cleanup()
+    return results
+
+
+def main():
+    args = build_parser().parse_args()
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
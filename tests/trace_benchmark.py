@@ -0,0 +1,171 @@
+# trace_benchmark.py
+# What tracing and profiling (server/tracing.py) cost.
+#
+# Two parts:
+#
+#   hooks   in-process: the time a no-op tracer hook takes, next to the work
+#           it sits beside in an upload loop (recv 64 KiB from a socket,
+#           write it to a file, hash it). This is the whole price of
+#           tracing when it is off.
+#   server  end to end: UPLOAD, DOWNLOAD and PING against a local server
+#           with tracing off, with --trace but no connection sampled, with
+#           every connection traced, and with every connection profiled.
+#
+#   python tests/trace_benchmark.py --engine threaded --mb 64 --rounds 5
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from engine_benchmark import FORMAT, PASSWORD, ROOT, SIZE, USERNAME, free_port, start_server  # noqa: E402
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "server"))
+import tracing  # noqa: E402
+from common import checksums  # noqa: E402
+
+CHUNK = 65536
+
+
+def hook_costs(chunks: int) -> dict:
+    """ns per no-op hook call, and ns per 64 KiB of real upload-loop work."""
+    xfer = tracing.NULL.transfer("upload", "x", 0)
+    n = 1000000
+    mark_ns = min(timeit.repeat(lambda: xfer.mark("net", CHUNK), number=n, repeat=5)) / n * 1e9
+    span_ns = min(timeit.repeat(lambda: tracing.NULL.span("PING", 0.0, ok=True), number=n, repeat=5)) / n * 1e9
+
+    a, b = socket.socketpair()
+    payload = os.urandom(CHUNK)
+    hasher = checksums.new()
+    with tempfile.TemporaryFile() as f:
+        start = time.perf_counter()
+        for _ in range(chunks):
+            a.sendall(payload)
+            got = 0
+            while got < CHUNK:
+                data = b.recv(CHUNK - got)
+                got += len(data)
+                f.write(data)
+                hasher.update(data)
+        chunk_ns = (time.perf_counter() - start) / chunks * 1e9
+    a.close()
+    b.close()
+    # An upload loop marks four phases per chunk.
+    return {"mark_ns": mark_ns, "span_ns": span_ns, "chunk_ns": chunk_ns,
+            "overhead_pct": 4 * mark_ns / chunk_ns * 100}
+
+
+def session(port: int) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.recv(SIZE)
+    sock.send(f"LOGIN@{USERNAME}@{PASSWORD}".encode(FORMAT))
+    sock.recv(SIZE)
+    return sock
+
+
+def upload(sock: socket.socket, payload: bytes) -> float:
+    start = time.perf_counter()
+    sock.send(b"UPLOAD@trace_bench.bin")
+    sock.recv(SIZE)
+    sock.send(str(len(payload)).encode(FORMAT))
+    sock.recv(SIZE)
+    sock.sendall(payload)
+    sock.recv(SIZE)
+    return time.perf_counter() - start
+
+
+def download(sock: socket.socket, buf: bytearray) -> float:
+    start = time.perf_counter()
+    sock.send(b"DOWNLOAD@trace_bench.bin")
+    size = int(sock.recv(SIZE).decode(FORMAT).split("@")[1])
+    sock.send(b"READY")
+    while size:
+        size -= sock.recv_into(buf, min(size, len(buf)))
+    return time.perf_counter() - start
+
+
+def run_mode(name: str, extra: list, args, payload: bytes) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory() as root:
+        trace_file = os.path.join(root, "trace.json")
+        extra = [a.replace("{trace}", trace_file).replace("{profiles}", os.path.join(root, "profiles"))
+                 for a in extra]
+        proc = start_server(args.engine, port, os.path.join(root, "data"),
+                            ["--cache-size", "0", "--no-compression", "--fsync", "none"] + extra)
+        try:
+            up, down, pings = [], [], []
+            buf = bytearray(1048576)
+            for _ in range(args.rounds):
+                # A new connection per round, so sampling decisions apply.
+                sock = session(port)
+                up.append(upload(sock, payload))
+                down.append(download(sock, buf))
+                for _ in range(args.pings):
+                    start = time.perf_counter()
+                    sock.send(b"PING")
+                    sock.recv(SIZE)
+                    pings.append((time.perf_counter() - start) * 1e6)
+                sock.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+        trace_bytes = os.path.getsize(trace_file) if os.path.exists(trace_file) else 0
+
+    mb = len(payload) / 1048576
+    return {
+        "mode": name,
+        "upload_mb_s": mb / statistics.median(up),
+        "download_mb_s": mb / statistics.median(down),
+        "ping_p50_us": statistics.median(pings),
+        "trace_bytes": trace_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracing / profiling overhead benchmark")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--mb", type=int, default=64, help="size of the file uploaded and downloaded")
+    parser.add_argument("--rounds", type=int, default=5, help="connections per mode (median is reported)")
+    parser.add_argument("--pings", type=int, default=500, help="PINGs per connection")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    hooks = hook_costs(2000)
+    print(f"no-op hooks: mark {hooks['mark_ns']:.0f} ns, span {hooks['span_ns']:.0f} ns; "
+          f"64 KiB of upload work {hooks['chunk_ns'] / 1000:.1f} us; "
+          f"tracing off adds {hooks['overhead_pct']:.3f}% to the upload loop")
+
+    modes = [
+        ("off", []),
+        ("trace, 0% sampled", ["--trace", "{trace}", "--trace-sample", "0"]),
+        ("trace, 100%", ["--trace", "{trace}"]),
+        ("profile, 100%", ["--profile-sample", "1", "--profile-dir", "{profiles}"]),
+    ]
+    payload = os.urandom(args.mb * 1048576)
+    results = []
+    for name, extra in modes:
+        print(f"Running '{name}' on the {args.engine} engine...")
+        results.append(run_mode(name, extra, args, payload))
+
+    base = results[0]
+    print("\n" + "=" * 78)
+    print(f"{'mode':<20}{'up MB/s':>10}{'down MB/s':>11}{'PING p50 us':>13}{'vs off (up/ping)':>18}{'trace KB':>9}")
+    for r in results:
+        rel = f"{r['upload_mb_s'] / base['upload_mb_s'] - 1:+.1%} / {r['ping_p50_us'] / base['ping_p50_us'] - 1:+.1%}"
+        print(f"{r['mode']:<20}{r['upload_mb_s']:>10.1f}{r['download_mb_s']:>11.1f}{r['ping_p50_us']:>13.1f}"
+              f"{rel:>18}{r['trace_bytes'] / 1024:>9.1f}")
+    print("=" * 78)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"hooks": hooks, "server": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()